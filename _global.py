@@ -1,4 +1,10 @@
-"""global variables for all modules"""
+"""global variables for all modules
+- models and clients are process-wide singletons created on first use, so importing a module stays fast
+"""
+
+import os
+import functools
+import threading
 
 # set up env
 from dotenv import load_dotenv
@@ -6,12 +12,69 @@ load_dotenv()
 
 # global variables
 path_to_resources = "./resources/"
+embedding_model_name = "BAAI/llm-embedder"
+embedding_backend = os.getenv("RAG_EMBEDDING_BACKEND", "torch") # torch, onnx or onnx-int8 (export: python onnx_embeddings.py)
+embedding_threads = int(os.getenv("RAG_EMBEDDING_THREADS", "0")) or None # onnx intra-op threads, None: all cores
+onnx_model_path = f"{path_to_resources}/onnx/{embedding_model_name.split('/')[-1]}"
+
+
+_singletons = {}
+_singletons_lock = threading.RLock() # reentrant: a factory can use other singletons
+
+
+def singleton(factory):
+    """decorator: factory runs once per process, on the first call (thread safe)"""
+    @functools.wraps(factory)
+    def get():
+        if factory not in _singletons:
+            with _singletons_lock:
+                if factory not in _singletons:
+                    _singletons[factory] = factory()
+        return _singletons[factory]
+
+    return get
+
+
+def set_singleton(get, instance):
+    """replaces the instance of a singleton (e.g. by fakes for offline benchmarks); get is the decorated function"""
+    with _singletons_lock:
+        _singletons[get.__wrapped__] = instance
 
 
 # set up embedding transformer
-from langchain_community.embeddings import HuggingFaceBgeEmbeddings
-hf_embed = HuggingFaceBgeEmbeddings(
-    model_name = "BAAI/llm-embedder", 
-    model_kwargs = {"device": "cpu"}, 
-    encode_kwargs = {"normalize_embeddings": True}
-)
\ No newline at end of file
+@singleton
+def get_hf_embed():
+    if embedding_backend in ("onnx", "onnx-int8"):
+        from onnx_embeddings import OnnxEmbeddings
+        return OnnxEmbeddings(onnx_model_path, quantized=embedding_backend == "onnx-int8", threads=embedding_threads, model_name=embedding_model_name)
+
+    from langchain_community.embeddings import HuggingFaceBgeEmbeddings
+    return HuggingFaceBgeEmbeddings(
+        model_name = embedding_model_name,
+        model_kwargs = {"device": "cpu"},
+        encode_kwargs = {"normalize_embeddings": True}
+    )
+
+
+class LazyEmbeddings:
+    """stands in for an embedding function that is only created (by factory) on first use"""
+    def __init__(self, factory, model_name):
+        self._factory = factory
+        self.model_name = model_name
+
+    def embed_documents(self, texts):
+        return self._factory().embed_documents(texts)
+
+    def embed_query(self, text):
+        return self._factory().embed_query(text)
+
+    def __getattr__(self, name): # anything else (e.g. query_instruction) comes from the real model
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self._factory(), name)
+
+
+# the backend and precision are part of the name so the embedding cache never mixes their vectors (also recorded in
+# index / snapshot exports)
+embedding_name = embedding_model_name if embedding_backend == "torch" else f"{embedding_model_name}+{embedding_backend}"
+hf_embed = LazyEmbeddings(get_hf_embed, embedding_name)
@@ -0,0 +1,91 @@
+"""Check of the diagnosis context cache with several diagnoses in a request (multi_diagnosis.py, section_dedup.py)
+- a request for "A and B" retrieves chunks for both diagnoses and compresses every shared chunk once; the contexts
+    cached for B must still be complete: a later request for B alone (a cache hit) must get the same sections as a
+    request for B on a cold cache
+- rag_bot: same compressed chunks per section, in the same order (the compressor is replaced by one that keeps the
+    first words of every chunk, so the compressed text of a chunk does not depend on the call it is in)
+- main_chain: every chunk a cold B request retrieved is in the cached contexts of B
+- synthetic collection of benchmarks.pipeline; exits with an error when a section differs
+
+run from the repo root: python -m benchmarks.context_cache [--chunks 2000] [--diagnoses croup bronchiolitis]
+"""
+
+import argparse
+from benchmarks.pipeline import build_collection
+from section_dedup import chunk_key
+
+
+def rag_bot_sections(db, emb_func, diagnoses_a_b):
+    """(sections of B after a request for A and B, sections of B on a cold cache) of RagBot"""
+    import templates
+    import rag_bot
+    from fakes import FakeChatModel
+    from retrieval import BatchRetriever
+    from response_cache import SemanticCache
+
+    def compress(q_c): # q_c[1]: the docs of the call (render_docs below keeps them as they are)
+        return rag_bot.CompressedDocs(contexts=[
+            rag_bot.CompressedDoc(id=i, context=" ".join(doc.page_content.split()[:12]), source=doc.metadata.get("source"))
+            for i, doc in enumerate(q_c[1])
+        ])
+
+    def sections(cache, diagnoses):
+        llm = FakeChatModel(response="\n".join(diagnoses))
+        bot = rag_bot.RagBot(BatchRetriever(db, emb_func, k=4), templates, llm=llm, cache=cache)
+        bot.compress_contexts = compress
+        prompt = bot.prompt_contexts(bot.compression_steps("assessment")["by_diagnosis"]) # what the handout prompt gets
+        return {k: [(doc.source, doc.context) for doc in v.contexts] for k, v in prompt[diagnoses[-1]].items()}
+
+    rag_bot.render_docs = lambda docs: docs
+    warm = SemanticCache()
+    sections(warm, diagnoses_a_b)
+    return sections(warm, diagnoses_a_b[1:]), sections(SemanticCache(), diagnoses_a_b[1:])
+
+
+def main_chain_sections(db, emb_func, diagnoses_a_b):
+    """(sections of B after a request for A and B, chunks retrieved per section by a cold B request) of main"""
+    import main
+    from _global import set_singleton, get_hf_embed
+    from retrieval import BatchRetriever
+    from response_cache import SemanticCache
+
+    set_singleton(get_hf_embed, emb_func)
+    set_singleton(main.get_retriever, BatchRetriever(db, emb_func, k=4))
+    set_singleton(main.get_partitioned, False)
+    set_singleton(main.get_context_cache, SemanticCache())
+    main._run_steps(main.context_steps(diagnoses_a_b))
+    warm = main._run_steps(main.context_steps(diagnoses_a_b[1:]))[diagnoses_a_b[1]]
+
+    docs = main.retrieve_step(main.diagnosis_queries(diagnoses_a_b, main.section_queries))
+    a, b = ({chunk_key(doc) for key, d in docs.items() if key[0] == diagnosis for doc in d} for diagnosis in diagnoses_a_b)
+    print(f"{len(a & b)} chunks retrieved for both {' and '.join(diagnoses_a_b)}")
+    return warm, {section: docs[(diagnoses_a_b[1], section)] for section in main.sections}
+
+
+if __name__ == "__main__":
+    from fakes import FakeEmbeddings
+
+    args = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    args.add_argument("--chunks", type=int, default=2000, help="size of the synthetic collection")
+    args.add_argument("--diagnoses", nargs=2, default=["croup", "bronchiolitis"], metavar=("A", "B"))
+    args = args.parse_args()
+
+    emb_func = FakeEmbeddings(dim=256)
+    db, _ = build_collection(args.chunks, emb_func)
+    failed = []
+
+    warm, cold = rag_bot_sections(db, emb_func, args.diagnoses)
+    for section in cold:
+        ok = warm[section] == cold[section]
+        print(f"rag_bot    {section:<14}{len(cold[section]):>4} chunks cold{len(warm[section]):>4} cached  {'ok' if ok else 'DIFFERENT'}")
+        failed += [] if ok else [f"rag_bot {section}"]
+
+    warm, cold = main_chain_sections(db, emb_func, args.diagnoses)
+    for section, docs in cold.items():
+        text = "\n".join(warm[section])
+        missing = [doc for doc in docs if repr(doc.page_content) not in text]
+        print(f"main_chain {section:<14}{len(docs):>4} chunks cold{len(docs) - len(missing):>4} cached  {'ok' if not missing else 'MISSING'}")
+        failed += [f"main_chain {section}"] if missing else []
+
+    if failed:
+        raise SystemExit(f"cached contexts of {args.diagnoses[1]} differ from a cold request: {', '.join(failed)}")
@@ -0,0 +1,93 @@
+"""Hit rate and latency saved by the local diagnosis extraction (diagnosis_dictionary.py) on the test cases
+- cases: the {"assessment", "plan"} .json files of --cases (test_set/cases, named after their diagnosis)
+- local: DiagnosisMatcher.extract on every assessment; hit = confident, so the llm call is skipped
+- llm: the extraction chain of main (gpt-3.5-turbo), or the fake llm with --llm-latency
+- agreement: share of the hits whose diagnoses match the llm's (one contains the other, after normalization)
+- saved: mean extraction latency per request without vs with the local stage (a miss costs the local attempt too)
+
+run from the repo root: python -m benchmarks.diagnosis_dictionary [--cases test_set/cases] [--db-dir DIR] [--llm-latency S]
+"""
+
+import os
+import json
+import time
+import argparse
+import numpy as np
+from collections import Counter
+from benchmarks.pipeline import percentiles
+from response_cache import normalize_diagnosis
+
+
+def load_cases(directory):
+    cases = {}
+    for filename in sorted(os.listdir(directory)):
+        if filename.endswith(".json"):
+            with open(os.path.join(directory, filename), "r") as f:
+                cases[filename.replace(".json", "")] = json.load(f)["assessment"]
+    return cases
+
+
+def agree(local, llm):
+    """every local diagnosis is in (or contains) one of the llm diagnoses"""
+    llm = [normalize_diagnosis(d) for d in llm]
+    return all(any(a in b or b in a for b in llm) for a in map(normalize_diagnosis, local))
+
+
+def timed(func, *args, repeat=1):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = func(*args)
+    return result, (time.perf_counter() - start) / repeat
+
+
+if __name__ == "__main__":
+    import main
+    from _global import set_singleton
+    from diagnosis_dictionary import DiagnosisMatcher
+
+    args = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    args.add_argument("--cases", default="test_set/cases")
+    args.add_argument("--db-dir", default=main.db_directory, help="collection with the diagnosis dictionary")
+    args.add_argument("--llm-latency", type=float, help="use the fake llm with this latency (s) instead of gpt-3.5-turbo")
+    args.add_argument("--verbose", action="store_true", help="print the diagnoses of every case")
+    args = args.parse_args()
+
+    path = os.path.join(args.db_dir, "diagnoses.json")
+    if os.path.exists(path):
+        matcher = DiagnosisMatcher.load(path)
+    else:
+        from database_helper import open_collection, build_diagnosis_dictionary
+        matcher = build_diagnosis_dictionary(open_collection(args.db_dir, None), args.db_dir)
+
+    if args.llm_latency is not None:
+        from fakes import FakeChatModel
+        set_singleton(main.get_llm_gpt, FakeChatModel(latency=args.llm_latency))
+    chain = main.get_chain_extract_diagnoses()
+
+    cases = load_cases(args.cases)
+    local_seconds, llm_seconds, hits, agreements, reasons = [], [], [], [], Counter()
+    for name, assessment in cases.items():
+        if args.llm_latency is not None:
+            main.get_llm_gpt().response = name.replace("_", " ") # the fake answers the case name
+        local, seconds = timed(matcher.extract, assessment, repeat=20)
+        local_seconds.append(seconds)
+        llm, seconds = timed(chain.invoke, assessment)
+        llm_seconds.append(seconds)
+
+        hits.append(local["confident"])
+        reasons[local["reason"] or "hit"] += 1
+        if local["confident"]:
+            agreements.append(agree(local["diagnoses"], llm))
+        if args.verbose:
+            print(f"{name}: local {local['diagnoses']} ({local['reason'] or 'hit'}), llm {llm}")
+
+    hits, local_seconds, llm_seconds = np.array(hits), np.array(local_seconds), np.array(llm_seconds)
+    with_local = np.where(hits, local_seconds, local_seconds + llm_seconds)
+    print(f"{len(cases)} cases, dictionary of {len(matcher)} names")
+    print(f"hit rate: {hits.mean():.1%} ({', '.join(f'{reason}: {n}' for reason, n in reasons.most_common())})")
+    if agreements:
+        print(f"agreement with the llm on hits: {np.mean(agreements):.1%}")
+    print("local: " + ", ".join(f"{key} {value*1000:.3f} ms" for key, value in percentiles(local_seconds).items()))
+    print("llm: " + ", ".join(f"{key} {value*1000:.0f} ms" for key, value in percentiles(llm_seconds).items()))
+    print(f"extraction per request: {llm_seconds.mean()*1000:.0f} ms -> {with_local.mean()*1000:.0f} ms "
+          f"({(llm_seconds.mean() - with_local.mean())*1000:.0f} ms saved)")
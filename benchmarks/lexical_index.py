@@ -0,0 +1,59 @@
+"""Benchmark of the bm25 index (lexical_index.py) and of hybrid vs dense retrieval
+- synthetic collection of benchmarks.pipeline (every chunk is about one diagnosis, in its "Title")
+- lookup: latency of BM25Index.search for the six section queries of a diagnosis
+- precision@k: share of the top k chunks that are about the diagnosis of the query, dense (BatchRetriever) vs
+    hybrid (HybridRetriever: dense + bm25 fused by reciprocal rank fusion)
+
+run from the repo root: python -m benchmarks.lexical_index [--chunks 20000] [--db-dir DIR] [--k 4]
+"""
+
+import time
+import argparse
+from benchmarks.pipeline import build_collection, diagnoses, percentiles
+from templates import queries_ddx
+from lexical_index import BM25Index
+from retrieval import BatchRetriever, HybridRetriever
+
+
+def precision(retriever, k):
+    relevant, total = 0, 0
+    for diagnosis in diagnoses:
+        docs = retriever.batch_search({section: query.format(diagnosis=diagnosis) for section, query in queries_ddx.items()})
+        for section_docs in docs.values():
+            relevant += sum(doc.metadata.get("Title", "").lower() == diagnosis for doc in section_docs[:k])
+            total += len(section_docs[:k])
+    return relevant / total
+
+
+if __name__ == "__main__":
+    from fakes import FakeEmbeddings
+
+    args = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    args.add_argument("--chunks", type=int, default=20000, help="size of the synthetic collection")
+    args.add_argument("--dim", type=int, default=768)
+    args.add_argument("--db-dir", help="where to keep the synthetic collection (default: in memory)")
+    args.add_argument("--k", type=int, default=4)
+    args.add_argument("--repeat", type=int, default=20, help="num of times every query is looked up")
+    args = args.parse_args()
+
+    emb_func = FakeEmbeddings(dim=args.dim)
+    db, _ = build_collection(args.chunks, emb_func, args.db_dir)
+
+    start = time.perf_counter()
+    lexical = BM25Index.from_collection(db)
+    build_seconds = time.perf_counter() - start
+
+    queries = [query.format(diagnosis=diagnosis) for diagnosis in diagnoses for query in queries_ddx.values()]
+    latencies = []
+    for _ in range(args.repeat):
+        for query in queries:
+            start = time.perf_counter()
+            lexical.search(query, 20)
+            latencies.append(time.perf_counter() - start)
+
+    dense = BatchRetriever(db, emb_func, k=args.k)
+    hybrid = HybridRetriever(dense, lexical, k=args.k)
+
+    print(f"{len(lexical)} chunks, {len(lexical.terms)} terms, {len(lexical.docs)} postings, built in {build_seconds:.1f} s")
+    print("bm25 lookup: " + ", ".join(f"{key} {value*1000:.2f} ms" for key, value in percentiles(latencies).items()))
+    print(f"precision@{args.k}: dense {precision(dense, args.k):.3f}, hybrid {precision(hybrid, args.k):.3f}")
@@ -0,0 +1,50 @@
+"""Latency of a handout request vs the num of diagnoses in the assessment (multi_diagnosis.py)
+- fake llm (fakes.py) answering --max-diagnoses diagnoses, one per line, with a set latency per call
+- main_chain and rag_bot (whose compression calls the llm) on the synthetic collection of benchmarks.pipeline
+- compares the p50 latency with n diagnoses to n sequential single diagnosis requests (what it took before)
+
+run from the repo root: python -m benchmarks.multi_diagnosis [--chunks 10000] [--max-diagnoses 4] [--llm-latency 0.2]
+"""
+
+import os
+import tempfile
+import argparse
+from benchmarks.pipeline import build_collection, synthetic_assessments, diagnoses, bench_main_chain, bench_rag_bot
+
+
+if __name__ == "__main__":
+    from fakes import FakeChatModel, FakeEmbeddings
+    from instrumentation import token_usage_handler
+
+    args = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    args.add_argument("--chunks", type=int, default=10000, help="size of the synthetic collection")
+    args.add_argument("--db-dir", help="where to keep the collection (default: in memory)")
+    args.add_argument("--requests", type=int, default=10, help="requests per num of diagnoses")
+    args.add_argument("--max-diagnoses", type=int, default=4)
+    args.add_argument("--llm-latency", type=float, default=0.2, help="seconds per fake llm call")
+    args.add_argument("--emb-latency", type=float, default=0.02, help="seconds per fake embedding call")
+    args.add_argument("--pipelines", nargs="+", default=["main_chain", "rag_bot"], choices=["main_chain", "rag_bot"])
+    args = args.parse_args()
+
+    emb_func = FakeEmbeddings(latency=args.emb_latency)
+    llm = FakeChatModel(latency=args.llm_latency, callbacks=[token_usage_handler])
+    db, _ = build_collection(args.chunks, emb_func, args.db_dir)
+    assessments = synthetic_assessments(args.requests)
+    plan = "- follow-up with family doctor if not improved by 2 days"
+    benches = {"main_chain": bench_main_chain, "rag_bot": bench_rag_bot}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in args.pipelines:
+            print(f"{name}:")
+            print(f"    {'diagnoses':>9}{'p50 (ms)':>10}{'p95 (ms)':>10}{'llm calls':>11}{'chunks':>8}{'vs sequential':>15}")
+            single = None
+            for n in range(1, args.max_diagnoses + 1):
+                llm.response = "\n".join(diagnoses[:n]) # extraction answers n diagnoses
+                calls = len(llm.calls)
+                result = benches[name](db, emb_func, llm, assessments, plan, 1, False, os.path.join(tmp, f"{name}-{n}.jsonl"))
+                p50 = result["latency"]["p50"]
+                single = single or p50
+                dedup = result["stages"].get("dedup", {})
+                print(f"    {n:>9}{p50*1000:>10.0f}{result['latency']['p95']*1000:>10.0f}"
+                      f"{(len(llm.calls) - calls) / args.requests:>11.1f}{dedup.get('chunks', 0) / args.requests:>8.0f}"
+                      f"{p50 / (n * single):>14.2f}x")
@@ -0,0 +1,79 @@
+"""Speed and accuracy of the near-duplicate detection at ingestion (near_duplicates.py, database_helper.dedup_collection)
+- corpus: synthetic chunks of benchmarks.pipeline plus copies of a share of them under another source, with a few
+    words replaced (the same guidance on two sites)
+- found: copies detected / copies added; false: chunks removed that were not copies
+- time of find_duplicates (signatures + lsh) for growing corpus sizes: near linear, vs the all pairs comparison it
+    replaces (timed on the smallest size)
+- index: size of the float32 vectors before / after removing the copies
+- incremental: a sync that adds --added chunks to the largest corpus only hashes them and matches them against the
+    stored signatures (match_signatures), vs hashing the whole corpus again
+
+run from the repo root: python -m benchmarks.near_duplicates [--chunks 5000 10000 20000] [--copies 0.2] [--edits 3] [--added 100]
+"""
+
+import time
+import argparse
+import numpy as np
+from benchmarks.pipeline import synthetic_chunks, vocabulary
+from near_duplicates import MinHasher, find_duplicates, match_signatures, threshold
+
+
+def corpus(n, copies, edits, seed=0):
+    """(texts, sources, is_copy) of n chunks + copies * n edited copies"""
+    rng = np.random.default_rng(seed)
+    texts, sources = map(list, zip(*((text, metadata["source"]) for text, metadata in synthetic_chunks(n, seed))))
+    is_copy = [False] * n
+    for i in rng.choice(n, size=int(copies * n), replace=False):
+        words = texts[i].split()
+        for position in rng.choice(len(words), size=edits, replace=False):
+            words[position] = rng.choice(vocabulary)
+        texts.append(" ".join(words))
+        sources.append(sources[i].replace("synthetic/", "copies/"))
+        is_copy.append(True)
+    return texts, sources, is_copy
+
+
+def all_pairs(signatures):
+    """the quadratic baseline: every pair of signatures compared"""
+    found = 0
+    for i in range(len(signatures)):
+        found += int(np.count_nonzero((signatures[i + 1:] == signatures[i]).mean(axis=1) >= threshold))
+    return found
+
+
+if __name__ == "__main__":
+    args = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    args.add_argument("--chunks", type=int, nargs="+", default=[5000, 10000, 20000], help="corpus sizes (before the copies)")
+    args.add_argument("--copies", type=float, default=0.2, help="share of the chunks copied")
+    args.add_argument("--edits", type=int, default=3, help="words replaced in a copy")
+    args.add_argument("--dim", type=int, default=768, help="embedding size, for the index size")
+    args.add_argument("--added", type=int, default=100, help="chunks added by the incremental run")
+    args = args.parse_args()
+
+    print(f"{'chunks':>8}{'copies':>8}{'found':>8}{'false':>7}{'seconds':>9}{'chunks/s':>10}{'index (MB)':>18}")
+    for n in args.chunks:
+        texts, sources, is_copy = corpus(n, args.copies, args.edits)
+        start = time.perf_counter()
+        found = find_duplicates(texts)
+        seconds = time.perf_counter() - start
+
+        removed = [row for _, rows in found for row in rows]
+        # the copy or its original may be the one removed (the longer one is kept): count removals per pair
+        true_removals = sum(1 for canonical, rows in found for row in rows if is_copy[row] or is_copy[canonical])
+        mb = lambda count: count * args.dim * 4 / 1e6
+        print(f"{len(texts):>8}{sum(is_copy):>8}{true_removals / max(1, sum(is_copy)):>8.1%}{len(removed) - true_removals:>7}"
+              f"{seconds:>9.2f}{len(texts) / seconds:>10.0f}{mb(len(texts)):>9.1f} -> {mb(len(texts) - len(removed)):.1f}")
+
+    # incremental run: the last chunks (copies) are the ones added, the signatures of the others are stored
+    hasher = MinHasher()
+    stored = hasher.signatures(texts[:-args.added])
+    start = time.perf_counter()
+    matches = match_signatures(hasher.signatures(texts[-args.added:]), stored)
+    print(f"incremental: {args.added} chunks added to {len(stored)}: {np.mean(matches >= 0):.1%} matched in "
+          f"{time.perf_counter() - start:.2f} s (full run: {seconds:.2f} s)")
+
+    texts, _, _ = corpus(args.chunks[0], args.copies, args.edits)
+    signatures = MinHasher().signatures(texts)
+    start = time.perf_counter()
+    all_pairs(signatures)
+    print(f"all pairs comparison of the {len(texts)} signatures: {time.perf_counter() - start:.2f} s (quadratic)")
@@ -0,0 +1,95 @@
+"""Parity and throughput of the onnx embedder (onnx_embeddings.py) against HuggingFaceBgeEmbeddings (pytorch)
+- parity: cosine between the onnx and the pytorch embedding of every text (documents and queries); fails (exit
+    code 1) when the min is below --min-cosine
+- throughput: sentences/sec on CPU for pytorch, onnx and onnx int8, for every --threads value
+- texts are the paragraphs of the .md files in --texts (e.g. ./resources/health_CA) or synthetic chunks
+
+run from the repo root (after python onnx_embeddings.py): python -m benchmarks.onnx_embeddings [--texts DIR] [--n 512]
+"""
+
+import os
+import sys
+import glob
+import time
+import argparse
+import numpy as np
+from benchmarks.pipeline import synthetic_chunks, diagnoses
+from templates import queries_ddx
+from onnx_embeddings import OnnxEmbeddings
+
+
+def load_texts(directory, n):
+    if not directory:
+        return [text for text, _ in synthetic_chunks(n)]
+    texts = []
+    for path in sorted(glob.glob(os.path.join(directory, "**", "*.md"), recursive=True)):
+        with open(path, "r") as f:
+            texts.extend(p.strip() for p in f.read().split("\n\n") if len(p.strip()) > 50)
+        if len(texts) >= n:
+            break
+    return texts[:n]
+
+
+def cosines(a, b):
+    a, b = np.asarray(a), np.asarray(b)
+    return np.sum(a * b, axis=1) / (np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1))
+
+
+def throughput(emb_func, texts, repeat=2):
+    """best sentences/sec over repeat runs"""
+    emb_func.embed_documents(texts[:8]) # warm up
+    best = 0.0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        emb_func.embed_documents(texts)
+        best = max(best, len(texts) / (time.perf_counter() - start))
+    return best
+
+
+if __name__ == "__main__":
+    from _global import onnx_model_path, embedding_model_name
+
+    args = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    args.add_argument("--model-dir", default=onnx_model_path)
+    args.add_argument("--texts", help="directory of .md files (default: synthetic chunks)")
+    args.add_argument("--n", type=int, default=512, help="num of texts")
+    args.add_argument("--threads", type=int, nargs="+", default=[1, os.cpu_count()])
+    args.add_argument("--min-cosine", type=float, default=0.99)
+    args = args.parse_args()
+
+    from langchain_community.embeddings import HuggingFaceBgeEmbeddings
+    reference = HuggingFaceBgeEmbeddings(model_name=embedding_model_name, model_kwargs={"device": "cpu"}, encode_kwargs={"normalize_embeddings": True})
+
+    texts = load_texts(args.texts, args.n)
+    queries = [query.format(diagnosis=diagnosis) for diagnosis in diagnoses for query in queries_ddx.values()]
+    expected_docs = reference.embed_documents(texts)
+    expected_queries = [reference.embed_query(query) for query in queries]
+    print(f"{len(texts)} texts, {len(queries)} queries")
+
+    failed = False
+    print(f"{'backend':<12}{'min cos':>9}{'mean cos':>10}")
+    for quantized in (False, True):
+        name = "onnx-int8" if quantized else "onnx"
+        if quantized and not os.path.exists(os.path.join(args.model_dir, "model_int8.onnx")):
+            print(f"{name:<12} not exported")
+            continue
+        emb_func = OnnxEmbeddings(args.model_dir, quantized=quantized)
+        sims = np.concatenate([
+            cosines(emb_func.embed_documents(texts), expected_docs),
+            cosines([emb_func.embed_query(query) for query in queries], expected_queries),
+        ])
+        failed |= bool(sims.min() < args.min_cosine)
+        print(f"{name:<12}{sims.min():>9.4f}{sims.mean():>10.4f}")
+
+    print(f"\n{'backend':<12}{'threads':>8}{'sentences/sec':>15}")
+    print(f"{'pytorch':<12}{'-':>8}{throughput(reference, texts):>15.1f}")
+    for quantized in (False, True):
+        if quantized and not os.path.exists(os.path.join(args.model_dir, "model_int8.onnx")):
+            continue
+        for threads in args.threads:
+            emb_func = OnnxEmbeddings(args.model_dir, quantized=quantized, threads=threads)
+            print(f"{'onnx-int8' if quantized else 'onnx':<12}{threads:>8}{throughput(emb_func, texts):>15.1f}")
+
+    if failed:
+        print(f"\nparity check failed: min cosine below {args.min_cosine}")
+        sys.exit(1)
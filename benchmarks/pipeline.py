@@ -0,0 +1,227 @@
+"""Offline end-to-end benchmark of the RAG pipeline (main_chain and RagBot.make_handout)
+- no OpenAI/Ollama/HuggingFace: FakeChatModel with a set latency and the FakeEmbeddings hashing embedder (fakes.py)
+- synthetic Chroma collection of --chunks chunks (1k - 1M); kept in --db-dir so it is only built once per size
+- main_chain searches the synthetic collection with main's settings: bm25 fusion (RAG_HYBRID_SEARCH) and the
+    diagnosis dictionary (RAG_LOCAL_EXTRACTION) are built from it, never read from main.db_directory
+- reports throughput, request and per stage latency percentiles (instrumentation.py traces) and peak RSS
+- results are saved as JSON (one file per commit and collection size) so runs of different commits can be compared;
+  --baseline FILE prints the change against an earlier result
+
+run from the repo root: python -m benchmarks.pipeline [--chunks 10000] [--requests 50] [--concurrency 4] [--llm-latency 0.0]
+"""
+
+import os
+import json
+import time
+import resource
+import tempfile
+import argparse
+import platform
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+results_dir = os.path.join(os.path.dirname(__file__), "results")
+
+diagnoses = [
+    "asthma exacerbation", "bronchiolitis", "croup", "community acquired pneumonia", "acute otitis media",
+    "gastroenteritis", "urinary tract infection", "febrile seizure", "concussion", "appendicitis",
+    "kawasaki disease", "diabetic ketoacidosis", "anaphylaxis", "cellulitis", "migraine", "streptococcal pharyngitis",
+]
+sections = ["Definition", "Signs and symptoms", "Causes", "Diagnosis", "Treatment", "Prognosis", "Epidemiology"]
+vocabulary = (
+    "patient child fever cough pain treatment dose daily hours days weeks symptoms signs infection inflammation "
+    "airway lung heart blood pressure oxygen therapy antibiotic steroid fluid hydration rest return emergency "
+    "department follow doctor chronic acute severe mild moderate risk factor diagnosis test imaging examination "
+    "management supportive care complication recovery onset history family medication allergy rash swelling"
+).split()
+
+
+def synthetic_chunks(n, seed=0):
+    """n (text, metadata) of md chunks with the header metadata of database_helper.split_md_document"""
+    rng = np.random.default_rng(seed)
+    for i in range(n):
+        diagnosis = diagnoses[i % len(diagnoses)]
+        section = sections[(i // len(diagnoses)) % len(sections)]
+        words = " ".join(rng.choice(vocabulary, size=60))
+        yield f"{diagnosis} {section.lower()}: {words}", {
+            "source": f"synthetic/{diagnosis.replace(' ', '_')}_{i // 100}.md",
+            "Title": diagnosis.title(),
+            "Header2": section,
+        }
+
+
+def build_collection(n_chunks, emb_func, db_dir=None, seed=0):
+    """Chroma collection with n_chunks synthetic chunks; an existing collection of the same size in db_dir is reused"""
+    from langchain_community.vectorstores import Chroma
+
+    db = Chroma(collection_name="main_collection", persist_directory=db_dir, embedding_function=emb_func)
+    if db._collection.count() == n_chunks:
+        return db, 0.0
+    if db._collection.count():
+        raise SystemExit(f"{db_dir} has a collection of {db._collection.count()} chunks, not {n_chunks}")
+
+    start = time.perf_counter()
+    batch_size = min(5000, db._client.get_max_batch_size())
+    texts, metadatas = [], []
+    for i, (text, metadata) in enumerate(synthetic_chunks(n_chunks, seed)):
+        texts.append(text)
+        metadatas.append(metadata)
+        if len(texts) == batch_size or i == n_chunks - 1:
+            db.add_texts(texts, metadatas, ids=[str(j) for j in range(i + 1 - len(texts), i + 1)])
+            texts, metadatas = [], []
+            print(f"\rbuilding collection: {i + 1}/{n_chunks}", end="", flush=True)
+    print()
+
+    return db, time.perf_counter() - start
+
+
+def synthetic_assessments(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return [f"{rng.integers(1, 17)} yo, {diagnoses[i % len(diagnoses)]}, {' '.join(rng.choice(vocabulary, size=10))}" for i in range(n)]
+
+
+def peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024**2 if platform.system() == "Darwin" else rss / 1024 # bytes on macOS, KB on linux
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def percentiles(values):
+    values = np.asarray(values)
+    return {f"p{q}": float(np.percentile(values, q)) for q in (50, 95, 99)}
+
+
+def run(func, assessments, plan, concurrency, trace_path):
+    """runs func(assessment, plan) for every assessment; throughput, request latencies and per stage summary"""
+    import instrumentation
+
+    def timed(assessment):
+        start = time.perf_counter()
+        func(assessment, plan)
+        return time.perf_counter() - start
+
+    instrumentation.configure(trace_path)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        latencies = list(pool.map(timed, assessments))
+    seconds = time.perf_counter() - start
+    instrumentation.configure(os.getenv("RAG_TRACE_FILE"))
+
+    return {
+        "requests": len(assessments),
+        "seconds": seconds,
+        "throughput": len(assessments) / seconds,
+        "latency": percentiles(latencies),
+        "stages": instrumentation.summarize(trace_path),
+    }
+
+
+def bench_main_chain(db, emb_func, llm, assessments, plan, concurrency, cache, trace_path):
+    import main
+    from _global import set_singleton, get_hf_embed
+    from retrieval import BatchRetriever, HybridRetriever
+    from lexical_index import BM25Index
+    from diagnosis_dictionary import DiagnosisMatcher
+    from response_cache import SemanticCache
+
+    set_singleton(get_hf_embed, emb_func)
+    set_singleton(main.get_llm_gpt, llm)
+    set_singleton(main.get_db, db)
+    # the retriever and dictionary of the synthetic collection, not the ones of main.db_directory (built at ingestion)
+    dense = BatchRetriever(db, emb_func, k=4)
+    set_singleton(main.get_retriever, HybridRetriever(dense, BM25Index.from_collection(db), k=4) if main.hybrid_search else dense)
+    set_singleton(main.get_diagnosis_matcher, DiagnosisMatcher.from_collection(db) if main.local_extraction else None)
+    set_singleton(main.get_partitioned, False) # the synthetic chunks have no section labels
+    # max_size=0 keeps nothing: every request is retrieved and compressed
+    set_singleton(main.get_context_cache, SemanticCache(emb_func) if cache else SemanticCache(max_size=0))
+
+    return run(main.generate, assessments, plan, concurrency, trace_path)
+
+
+def bench_rag_bot(db, emb_func, llm, assessments, plan, concurrency, cache, trace_path):
+    import templates
+    from rag_bot import RagBot
+    from retrieval import BatchRetriever
+    from rate_limiter import RateLimiter
+    from response_cache import SemanticCache
+
+    bot = RagBot(
+        BatchRetriever(db, emb_func, k=4), templates, llm=llm,
+        rate_limiter=RateLimiter(10**12, 10**12), # fake calls are free; measure the pipeline, not the api limits
+        cache=SemanticCache(emb_func) if cache else None,
+    )
+    return run(bot.make_handout, assessments, plan, concurrency, trace_path)
+
+
+def print_result(name, result, baseline=None):
+    line = f"{name}: {result['throughput']:.2f} req/s, p50 {result['latency']['p50']*1000:.1f} ms, p95 {result['latency']['p95']*1000:.1f} ms"
+    if baseline:
+        line += f" ({result['throughput'] / baseline['throughput']:.2f}x throughput of baseline)"
+    print(line)
+    for stage, s in result["stages"].items():
+        line = f"    {stage:<20} p50 {s['p50']*1000:>9.2f} ms  p95 {s['p95']*1000:>9.2f} ms"
+        if baseline and stage in baseline["stages"] and baseline["stages"][stage]["p50"]:
+            line += f"  ({s['p50'] / baseline['stages'][stage]['p50']:.2f}x baseline p50)"
+        print(line)
+
+
+if __name__ == "__main__":
+    from fakes import FakeChatModel, FakeEmbeddings
+    from instrumentation import token_usage_handler
+
+    args = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    args.add_argument("--chunks", type=int, default=10000, help="size of the synthetic collection")
+    args.add_argument("--dim", type=int, default=768, help="embedding size")
+    args.add_argument("--db-dir", help="where to keep the collection (default: in memory, rebuilt every run)")
+    args.add_argument("--requests", type=int, default=50)
+    args.add_argument("--concurrency", type=int, default=4)
+    args.add_argument("--llm-latency", type=float, default=0.0, help="seconds per fake llm call")
+    args.add_argument("--emb-latency", type=float, default=0.0, help="seconds per fake embedding call")
+    args.add_argument("--cache", action="store_true", help="use the diagnosis context cache")
+    args.add_argument("--pipelines", nargs="+", default=["main_chain", "rag_bot"], choices=["main_chain", "rag_bot"])
+    args.add_argument("--out", help="result JSON file (default: benchmarks/results/pipeline-<commit>-<chunks>.json)")
+    args.add_argument("--baseline", help="earlier result JSON to compare with")
+    args = args.parse_args()
+
+    emb_func = FakeEmbeddings(dim=args.dim, latency=args.emb_latency)
+    llm = FakeChatModel(response=diagnoses[0], latency=args.llm_latency, callbacks=[token_usage_handler])
+
+    db, build_seconds = build_collection(args.chunks, emb_func, args.db_dir)
+    rss_collection = peak_rss_mb()
+    assessments = synthetic_assessments(args.requests)
+    plan = "- continue q4h ventolin for the next 48hr then prn\n- follow-up with family doctor if not improved by 2 days"
+
+    commit = git_commit()
+    result = {
+        "commit": commit,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": vars(args),
+        "collection": {"chunks": args.chunks, "build_seconds": build_seconds, "peak_rss_mb": rss_collection},
+    }
+    benches = {"main_chain": bench_main_chain, "rag_bot": bench_rag_bot}
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in args.pipelines:
+            result[name] = benches[name](db, emb_func, llm, assessments, plan, args.concurrency, args.cache, os.path.join(tmp, f"{name}.jsonl"))
+    result["peak_rss_mb"] = peak_rss_mb()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+
+    print(f"collection: {args.chunks} chunks (built in {build_seconds:.1f} s), peak RSS {result['peak_rss_mb']:.0f} MB")
+    for name in args.pipelines:
+        print_result(name, result[name], baseline.get(name) if baseline else None)
+
+    out = args.out or os.path.join(results_dir, f"pipeline-{commit or 'local'}-{args.chunks}.json")
+    os.makedirs(os.path.dirname(out) or ".", exist_ok=True)
+    with open(out, "w") as f:
+        json.dump(result, f, indent=2)
+    print(f"saved to {out}")
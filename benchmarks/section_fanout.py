@@ -0,0 +1,82 @@
+"""Check of the concurrent section fan-out of RagBot (rag_bot._map_sections / _call_llm) with FakeChatModel
+- the six sections are compressed through _map_sections, every llm call goes through the rate limiter
+- from the (start, end) of every call recorded by the fake model:
+    - concurrent: the calls overlap (more than one in flight) and take about one call latency, not six
+    - rate limited: the calls still overlap while the bucket has room, and no interval between two call starts holds
+        more calls than the bucket allows (capacity + refill rate * interval)
+    - concurrent=False: one call at a time
+- the limits are per --period seconds instead of per minute so the check runs in seconds
+- exits with an error when a check fails
+
+run from the repo root: python -m benchmarks.section_fanout [--latency 0.2] [--requests 2] [--period 1.0]
+"""
+
+import time
+import argparse
+import templates
+from rag_bot import RagBot
+from fakes import FakeChatModel
+from rate_limiter import RateLimiter
+
+sections = ["definition", "presentation", "course", "management", "follow_up", "redflags"]
+
+
+def fan_out(latency, concurrent, rate_limiter):
+    """(start, end) of the llm calls of compressing the six sections, and the seconds it took"""
+    llm = FakeChatModel(response="compressed context", latency=latency)
+    bot = RagBot(None, templates, llm=llm, rate_limiter=rate_limiter, concurrent=concurrent)
+    items = {section: (f"{section} of croup", f"context of the {section} section") for section in sections}
+    start = time.monotonic()
+    bot._map_sections(bot.compress_contexts, items)
+    return sorted(llm.calls), time.monotonic() - start
+
+
+def max_in_flight(calls):
+    events = sorted([(start, 1) for start, _ in calls] + [(end, -1) for _, end in calls], key=lambda e: (e[0], e[1]))
+    in_flight = peak = 0
+    for _, change in events:
+        in_flight += change
+        peak = max(peak, in_flight)
+    return peak
+
+
+def over_limit(calls, capacity, period):
+    """(calls, seconds) of an interval between two call starts with more calls than the token bucket allows"""
+    starts = [start for start, _ in calls]
+    for i in range(len(starts)):
+        for j in range(i, len(starts)):
+            allowed = capacity + capacity / period * (starts[j] - starts[i])
+            if j - i + 1 > allowed + 1e-6:
+                return j - i + 1, starts[j] - starts[i]
+    return None
+
+
+if __name__ == "__main__":
+    args = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    args.add_argument("--latency", type=float, default=0.2, help="seconds per fake llm call")
+    args.add_argument("--requests", type=int, default=2, help="requests allowed per period by the rate limited run")
+    args.add_argument("--period", type=float, default=1.0, help="seconds of the rate limit budget")
+    args = args.parse_args()
+    failed = []
+
+    def check(name, ok, line):
+        print(f"{name:<14}{line}  {'ok' if ok else 'FAILED'}")
+        failed.extend([] if ok else [name])
+
+    calls, seconds = fan_out(args.latency, True, RateLimiter(10**12, 10**12))
+    peak = max_in_flight(calls)
+    check("concurrent", peak > 1 and seconds < len(sections) * args.latency,
+          f"{len(calls)} calls, {peak} in flight at most, {seconds:.2f} s (serial: {len(sections) * args.latency:.2f} s)")
+
+    calls, seconds = fan_out(args.latency, True, RateLimiter(args.requests, None, period=args.period))
+    peak, over = max_in_flight(calls), over_limit(calls, args.requests, args.period)
+    check("rate limited", peak > 1 and over is None and len(calls) == len(sections),
+          f"{len(calls)} calls, {peak} in flight at most, {seconds:.2f} s, limit {args.requests} per {args.period} s"
+          + (f", {over[0]} calls in {over[1]:.2f} s" if over else ""))
+
+    calls, seconds = fan_out(args.latency, False, RateLimiter(10**12, 10**12))
+    peak = max_in_flight(calls)
+    check("serial", peak == 1, f"{len(calls)} calls, {peak} in flight at most, {seconds:.2f} s")
+
+    if failed:
+        raise SystemExit(f"section fan-out checks failed: {', '.join(failed)}")
@@ -0,0 +1,74 @@
+"""Full vs section-partitioned search (section_partitions.py) on the synthetic collection of benchmarks.pipeline
+- the chunks are labelled by database_helper.tag_sections (Header2 of the synthetic chunks: Definition, Treatment, ...)
+- queries: the six section queries of every diagnosis (main.section_queries), embedded once up front
+- precision@k: share of the top k chunks about the diagnosis of the query
+- on section: share of the top k chunks from a partition of the query's section (search_partitions)
+- scanned: share of the rows searched (exported index: rows of the partitions; chroma filters by metadata)
+- latency: search of the six queries of a diagnosis, chroma (BatchRetriever) and exported exact index (IndexRetriever)
+
+run from the repo root: python -m benchmarks.section_partitions [--chunks 20000] [--db-dir DIR]
+"""
+
+import time
+import tempfile
+import argparse
+import numpy as np
+from benchmarks.pipeline import build_collection, diagnoses, percentiles
+from main import section_queries
+from section_partitions import search_partitions, general
+from retrieval import BatchRetriever, IndexRetriever
+
+
+def bench(retriever, batches, k, partitioned):
+    sections = list(section_queries) if partitioned else None
+    latencies, relevant, on_section, total = [], 0, 0, 0
+    for diagnosis, vectors in batches:
+        start = time.perf_counter()
+        docs = retriever.search_by_vectors(vectors, k=k, sections=sections)
+        latencies.append(time.perf_counter() - start)
+        for section, section_docs in zip(section_queries, docs):
+            relevant += sum(doc.metadata.get("Title", "").lower() == diagnosis for doc in section_docs)
+            on_section += sum(doc.metadata.get("section", general) in search_partitions[section] for doc in section_docs)
+            total += len(section_docs)
+    return {"precision": relevant / total, "on_section": on_section / total, **percentiles(latencies)}
+
+
+def scanned(index):
+    searched = [sum(end - start for start, end in index.partition_ranges(labels)) for labels in search_partitions.values()]
+    return np.mean(searched) / len(index)
+
+
+if __name__ == "__main__":
+    from fakes import FakeEmbeddings
+    from database_helper import tag_sections
+    from vector_index import export_collection, ExactIndex
+
+    args = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    args.add_argument("--chunks", type=int, default=20000, help="size of the synthetic collection")
+    args.add_argument("--dim", type=int, default=768)
+    args.add_argument("--db-dir", help="where to keep the synthetic collection (default: in memory)")
+    args.add_argument("--k", type=int, nargs="+", default=[2, 4])
+    args = args.parse_args()
+
+    emb_func = FakeEmbeddings(dim=args.dim)
+    db, _ = build_collection(args.chunks, emb_func, args.db_dir)
+    batches = [
+        (diagnosis, emb_func.embed_documents([query.format(diagnosis=diagnosis) for query in section_queries.values()]))
+        for diagnosis in diagnoses
+    ]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tag_sections(db, tmp)
+        export_collection(db, tmp)
+        index = ExactIndex(tmp)
+        retrievers = {"chroma": BatchRetriever(db, emb_func), "exact": IndexRetriever(index, emb_func)}
+
+        print(f"{len(index)} chunks, partitions: {', '.join(f'{label} {end - start}' for label, (start, end) in index.meta['partitions'].items())}")
+        print(f"scanned per query: full 100%, partitioned {scanned(index):.0%}")
+        print(f"{'backend':>8}{'k':>3}{'search':>13}{'precision':>11}{'on section':>12}{'p50 (ms)':>10}{'p95 (ms)':>10}")
+        for name, retriever in retrievers.items():
+            for k in args.k:
+                for partitioned in (False, True):
+                    result = bench(retriever, batches, k, partitioned)
+                    print(f"{name:>8}{k:>3}{'partitioned' if partitioned else 'full':>13}{result['precision']:>11.3f}"
+                          f"{result['on_section']:>12.3f}{result['p50']*1000:>10.2f}{result['p95']*1000:>10.2f}")
@@ -0,0 +1,133 @@
+"""Load test of the serving layer (server.py) with the fake llm and embedder (fakes.py)
+- starts the API in process (uvicorn, random port) over a synthetic collection (benchmarks.pipeline)
+- --clients closed loop clients post /generate back to back for --duration seconds; with more clients than
+    workers + queue size the extra requests get 429s, which should stay fast
+- reports sustained req/s, latency percentiles of the completed requests and of the 429s, and how many
+    embedding calls the micro-batching saved
+
+run from the repo root: python -m benchmarks.server [--clients 32] [--workers 4] [--queue-size 16] [--llm-latency 0.2]
+"""
+
+import json
+import time
+import socket
+import argparse
+import threading
+import urllib.error
+import urllib.request
+from benchmarks.pipeline import build_collection, synthetic_assessments, diagnoses, percentiles
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(app, port):
+    import uvicorn
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    return server, thread
+
+
+def post(url, body, timeout):
+    """(status code, seconds)"""
+    request = urllib.request.Request(url, json.dumps(body).encode(), {"Content-Type": "application/json"})
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            response.read()
+            status = response.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    return status, time.perf_counter() - start
+
+
+def load(url, assessments, plan, clients, duration, timeout):
+    """closed loop clients until duration; list of (status, seconds) of every request"""
+    results, lock = [], threading.Lock()
+    stop = time.perf_counter() + duration
+
+    def client(i):
+        n = i
+        while time.perf_counter() < stop:
+            result = post(url, {"assessment": assessments[n % len(assessments)], "plan": plan}, timeout)
+            with lock:
+                results.append(result)
+            n += clients
+            if result[0] == 429:
+                time.sleep(0.05) # a real client would honour Retry-After; keep the test from spinning
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+if __name__ == "__main__":
+    import main
+    from _global import set_singleton, get_hf_embed
+    from fakes import FakeChatModel, FakeEmbeddings
+    from instrumentation import token_usage_handler
+    from response_cache import SemanticCache
+    from server import RequestQueue, MicroBatchEmbeddings, create_app
+
+    args = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    args.add_argument("--chunks", type=int, default=10000, help="size of the synthetic collection")
+    args.add_argument("--db-dir", help="where to keep the collection (default: in memory)")
+    args.add_argument("--clients", type=int, default=32)
+    args.add_argument("--duration", type=float, default=20.0, help="seconds")
+    args.add_argument("--workers", type=int, default=4)
+    args.add_argument("--queue-size", type=int, default=16)
+    args.add_argument("--timeout", type=float, default=30.0, help="request timeout (s)")
+    args.add_argument("--batch-window-ms", type=float, default=5.0, help="0 turns micro-batching off")
+    args.add_argument("--llm-latency", type=float, default=0.2, help="seconds per fake llm call")
+    args.add_argument("--emb-latency", type=float, default=0.02, help="seconds per fake embedding call")
+    args = args.parse_args()
+
+    emb_func = FakeEmbeddings(latency=args.emb_latency)
+    llm = FakeChatModel(response=diagnoses[0], latency=args.llm_latency, callbacks=[token_usage_handler])
+    db, _ = build_collection(args.chunks, emb_func, args.db_dir)
+
+    served_emb = MicroBatchEmbeddings(emb_func, args.batch_window_ms / 1000) if args.batch_window_ms > 0 else emb_func
+    set_singleton(get_hf_embed, served_emb)
+    set_singleton(main.get_llm_gpt, llm)
+    set_singleton(main.get_db, db)
+    set_singleton(main.get_context_cache, SemanticCache(max_size=0)) # every request is retrieved and compressed
+    main.warm_up()
+
+    requests = RequestQueue(main.generate_stream, args.workers, args.queue_size, args.timeout)
+    port = free_port()
+    server, thread = start_server(create_app(requests, ui=False), port)
+
+    emb_calls = emb_func.calls
+    start = time.perf_counter()
+    results = load(f"http://127.0.0.1:{port}/generate", synthetic_assessments(200), "- follow-up with family doctor",
+                   args.clients, args.duration, args.timeout + 5)
+    seconds = time.perf_counter() - start
+    emb_calls = emb_func.calls - emb_calls
+
+    server.should_exit = True
+    thread.join()
+    requests.shutdown()
+
+    ok = [s for status, s in results if status == 200]
+    rejected = [s for status, s in results if status == 429]
+    others = {status: sum(1 for st, _ in results if st == status) for status, _ in results if status not in (200, 429)}
+    print(f"{args.clients} clients, {args.workers} workers, queue of {args.queue_size}, {seconds:.1f} s")
+    print(f"completed: {len(ok)} ({len(ok) / seconds:.2f} req/s sustained)")
+    if ok:
+        print("    latency: " + ", ".join(f"{key} {value*1000:.0f} ms" for key, value in percentiles(ok).items()))
+    print(f"429: {len(rejected)}")
+    if rejected:
+        print("    latency: " + ", ".join(f"{key} {value*1000:.1f} ms" for key, value in percentiles(rejected).items()))
+    if others:
+        print(f"other status codes: {others}")
+    print(f"embedding calls: {emb_calls} for {len(ok)} completed requests" +
+          (f" ({served_emb.texts} texts in {served_emb.calls} micro-batches)" if served_emb is not emb_func else " (no micro-batching)"))
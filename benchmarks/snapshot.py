@@ -0,0 +1,91 @@
+"""Cold start of a serving worker: chroma store vs vector_index export (directory) vs single-file snapshot (snapshot.py)
+- synthetic collection of benchmarks.pipeline (FakeEmbeddings), persisted in --db-dir or a temporary directory
+- every backend is opened in --workers fresh processes (spawn), like the workers of a node
+- open: time to open the store / index, imports included (chroma + langchain for the store); first search: the six
+    section queries of a diagnosis right after (the first touch of the memory-mapped pages)
+- private / shared: anonymous memory of the worker vs file pages it maps (shared with the other workers through the
+    page cache), from /proc/self/status (linux)
+
+run from the repo root: python -m benchmarks.snapshot [--chunks 100000] [--workers 4]
+"""
+
+import os
+import time
+import tempfile
+import argparse
+import multiprocessing
+import numpy as np
+
+
+def memory_mb():
+    """(private, shared) resident memory of this process in MB; zeros where /proc is not available"""
+    fields = {}
+    if os.path.exists("/proc/self/status"):
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key in ("RssAnon", "RssFile"):
+                    fields[key] = value.split()[0]
+    return int(fields.get("RssAnon", 0)) / 1024, int(fields.get("RssFile", 0)) / 1024
+
+
+def open_backend(backend, path):
+    """search function of the opened store / index: vectors -> ids"""
+    if backend == "chroma":
+        from database_helper import open_collection
+        collection = open_collection(path, None)._collection
+        collection.count()
+        return lambda vectors: collection.query(query_embeddings=vectors.tolist(), n_results=4, include=["documents"])["ids"]
+    from vector_index import ExactIndex
+    from snapshot import SnapshotIndex
+    index = ExactIndex(path) if backend == "export" else SnapshotIndex(path)
+    return lambda vectors: [[index.ids[i] for i in row] + [index.texts[i] for i in row] for row in index.search(vectors, 4)[0].tolist()]
+
+
+def worker(backend, path, vectors):
+    start = time.perf_counter()
+    search = open_backend(backend, path)
+    opened = time.perf_counter()
+    search(vectors)
+    searched = time.perf_counter()
+    return opened - start, searched - opened, *memory_mb()
+
+
+def size_mb(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path) / 1e6
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names) / 1e6
+
+
+if __name__ == "__main__":
+    from fakes import FakeEmbeddings
+    from benchmarks.pipeline import build_collection
+    from templates import queries_ddx
+    from vector_index import export_collection
+    from snapshot import write_snapshot
+
+    args = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    args.add_argument("--chunks", type=int, default=100000, help="size of the synthetic collection")
+    args.add_argument("--dim", type=int, default=768)
+    args.add_argument("--db-dir", help="where to keep the synthetic collection (default: temporary directory)")
+    args.add_argument("--workers", type=int, default=4)
+    args = args.parse_args()
+
+    emb_func = FakeEmbeddings(dim=args.dim)
+    vectors = np.asarray(emb_func.embed_documents([query.format(diagnosis="croup") for query in queries_ddx.values()]), dtype=np.float32)
+    with tempfile.TemporaryDirectory() as tmp:
+        db_dir = args.db_dir or os.path.join(tmp, "db")
+        db, _ = build_collection(args.chunks, emb_func, db_dir)
+        start = time.perf_counter()
+        export_collection(db, os.path.join(tmp, "index"))
+        exported = time.perf_counter()
+        write_snapshot(os.path.join(tmp, "index"), os.path.join(tmp, "corpus.snapshot"))
+        print(f"export {exported - start:.1f} s, snapshot {time.perf_counter() - exported:.1f} s")
+
+        paths = {"chroma": db_dir, "export": os.path.join(tmp, "index"), "snapshot": os.path.join(tmp, "corpus.snapshot")}
+        print(f"{'backend':>9}{'size (MB)':>11}{'open (ms)':>11}{'1st search (ms)':>17}{'private (MB)':>14}{'shared (MB)':>13}")
+        for backend, path in paths.items():
+            with multiprocessing.get_context("spawn").Pool(args.workers, maxtasksperchild=1) as pool: # fresh processes
+                results = np.array(pool.starmap(worker, [(backend, path, vectors)] * args.workers, chunksize=1))
+            opened, searched, private, shared = np.median(results, axis=0)
+            print(f"{backend:>9}{size_mb(path):>11.1f}{opened*1000:>11.1f}{searched*1000:>17.1f}{private:>14.1f}{shared:>13.1f}")
@@ -0,0 +1,106 @@
+"""Check of the incremental sync (database_helper.sync_directory_md) against a full rebuild
+- a directory of .md files where some sections are copied in two files (near-duplicate clusters, one canonical chunk
+    with the urls of the copies in its "sources" metadata)
+- syncs: first run, rerun without changes, an edit of another section of the file of a canonical chunk (the canonical
+    chunk is upserted again, unchanged), an edit of a copy, a removed file, a new file
+- after every sync: the "sources" of every canonical chunk hold the urls of its copies, and the section counts, the
+    bm25 index and the diagnosis dictionary updated by the sync are the same as built from the whole collection
+- exits with an error when something differs
+
+run from the repo root: python -m benchmarks.sync
+"""
+
+import os
+import json
+import tempfile
+from collections import Counter
+from fakes import FakeEmbeddings
+import database_helper
+from lexical_index import BM25Index
+from diagnosis_dictionary import DiagnosisMatcher
+
+queries = ["dexamethasone steroid dose", "wheeze cough inhaler", "humidified air", "fever rash conjunctivitis"]
+
+
+def page(title, sections, url):
+    return f"# {title}\n\n" + "".join(f"## {header}\n\n{text}\n\n" for header, text in sections.items()) + f"## Source\n\n{url}\n"
+
+
+def differences(db, db_directory):
+    """what the sync left different from a full rebuild"""
+    chunks = db._collection.get(include=["documents", "metadatas"])
+    found = []
+
+    duplicates = database_helper.load_duplicates(db_directory)
+    for chunk_id, metadata in zip(chunks["ids"], chunks["metadatas"]):
+        copies = duplicates.get(chunk_id, {})
+        missing = set(copies.values()).difference(metadata.get("sources", "").split())
+        if missing:
+            found.append(f"sources of {metadata['source']} miss {sorted(missing)}")
+
+    with open(os.path.join(db_directory, "sections.json"), "r") as f:
+        if json.load(f) != dict(Counter(metadata["section"] for metadata in chunks["metadatas"])):
+            found.append("section counts")
+
+    saved, full = BM25Index.load(os.path.join(db_directory, "bm25")), BM25Index.from_collection(db)
+    rows = dict(zip(saved.ids or [], range(len(saved))))
+    if sorted(rows) != sorted(full.ids):
+        found.append("bm25 chunks")
+    else:
+        for query in queries:
+            scores = saved.scores(query)
+            if any(abs(scores[rows[chunk_id]] - score) > 1e-5 for chunk_id, score in zip(full.ids, full.scores(query))):
+                found.append(f"bm25 scores of {query!r}")
+        if any(saved.metadatas[rows[chunk_id]] != metadata for chunk_id, metadata in zip(full.ids, full.metadatas)):
+            found.append("bm25 metadatas")
+
+    if DiagnosisMatcher.load(os.path.join(db_directory, "diagnoses.json")).names != DiagnosisMatcher.from_collection(db).names:
+        found.append("diagnosis dictionary")
+    return found
+
+
+if __name__ == "__main__":
+    emb_func = FakeEmbeddings(dim=32)
+    steroids = " ".join(f"step{i} dexamethasone steroid dose" for i in range(40))
+    wheeze = "Asthma, also known as reactive airway disease, is " + " ".join(f"term{i} wheeze cough inhaler" for i in range(40))
+    failed = []
+
+    with tempfile.TemporaryDirectory() as tmp:
+        directory, db_directory = os.path.join(tmp, "md"), os.path.join(tmp, "db")
+        os.makedirs(directory)
+        files = {
+            "a.md": page("Croup", {"Treatment": steroids, "Causes": "parainfluenza virus " * 20}, "https://a.example/croup"),
+            "b.md": page("Croup", {"Treatment": steroids.replace("step3 ", "stepx "), "Prognosis": "recovery in days " * 20}, "https://b.example/croup"),
+            "c.md": page("Asthma", {"Signs and symptoms": wheeze}, "https://c.example/asthma"),
+            "d.md": page("Asthma", {"Signs and symptoms": wheeze.replace("term5 ", "termy ")}, "https://d.example/asthma"),
+            "e.md": page("Bronchiolitis", {"Causes": "rsv virus infants " * 30}, "https://e.example/bronchiolitis"),
+        }
+
+        def sync(name, edits=None, remove=None):
+            for file, text in (edits or {}).items():
+                with open(os.path.join(directory, file), "w") as f:
+                    f.write(text)
+            if remove:
+                os.remove(os.path.join(directory, remove))
+            database_helper.sync_directory_md(directory, db_directory, emb_func, cache_path=None)
+            db = database_helper.open_collection(db_directory, emb_func)
+            found = differences(db, db_directory)
+            print(f"{name:<38}{db._collection.count():>4} chunks  {'ok' if not found else 'DIFFERENT: ' + ', '.join(found)}")
+            failed.extend(f"{name}: {difference}" for difference in found)
+            return db
+
+        db = sync("first run", files)
+        sync("rerun")
+
+        duplicates = database_helper.load_duplicates(db_directory)
+        canonicals = db._collection.get(ids=sorted(duplicates), include=["metadatas"])["metadatas"]
+        croup = next(f"{m['source'][8]}.md" for m in canonicals if m["Title"] == "Croup") # https://a.example/...: a.md
+        other = {"a.md": "b.md", "b.md": "a.md"}[croup]
+        print(f"canonical croup treatment chunk in {croup}")
+        sync("other section of the canonical file", {croup: files[croup].replace("days", "weeks").replace("virus", "viruses")})
+        sync("other section of the copy file", {other: files[other].replace("days", "weeks").replace("virus", "viruses")})
+        sync("file removed", remove="e.md")
+        sync("file added", {"f.md": page("Kawasaki disease", {"Diagnosis": "fever rash conjunctivitis " * 20}, "https://f.example/kawasaki")})
+
+    if failed:
+        raise SystemExit("incremental sync differs from a full rebuild: " + "; ".join(failed))
@@ -0,0 +1,130 @@
+"""Recall/latency/memory benchmark of the vector search backends: chroma collection vs vector_index ExactIndex /
+HNSWIndex / QuantizedIndex (float16, int8; with and without full precision rescoring)
+- the collection is synthetic (FakeEmbeddings, see benchmarks.pipeline) or an existing one with --collection
+- query batches are the six section queries of a diagnosis (templates.queries_ddx), embedded once up front,
+  so only the search is timed
+- recall@k of every backend is against the exact top k
+- open: seconds to open the collection / load the index (cold start of a worker)
+- memory: size of the arrays the index searches (what each worker keeps in memory)
+
+run from the repo root: python -m benchmarks.vector_index [--chunks 100000] [--db-dir DIR] [--k 4]
+"""
+
+import os
+import time
+import tempfile
+import argparse
+import numpy as np
+from benchmarks.pipeline import build_collection, diagnoses, percentiles
+from templates import queries_ddx
+from quantization import dtypes
+from vector_index import export_collection, ExactIndex, HNSWIndex, QuantizedIndex
+
+
+def query_batches(emb_func, n):
+    """n batches of the embedded section queries of a diagnosis"""
+    batches = []
+    for i in range(n):
+        diagnosis = f"{diagnoses[i % len(diagnoses)]} {i // len(diagnoses)}"
+        queries = [query.format(diagnosis=diagnosis) for query in queries_ddx.values()]
+        batches.append(np.asarray(emb_func.embed_documents(queries), dtype=np.float32))
+    return batches
+
+
+def chroma_search(db, k):
+    def search(vectors):
+        return db._collection.query(query_embeddings=vectors.tolist(), n_results=k, include=[])["ids"]
+    return search
+
+
+def index_search(index, k):
+    def search(vectors):
+        indices, _ = index.search(vectors, k)
+        return [[index.ids[i] for i in row] for row in indices.tolist()]
+    return search
+
+
+def bench(search, batches, truth):
+    latencies, found = [], 0
+    for vectors, expected in zip(batches, truth):
+        start = time.perf_counter()
+        ids = search(vectors)
+        latencies.append(time.perf_counter() - start)
+        found += sum(len(set(row) & set(expected_row)) for row, expected_row in zip(ids, expected))
+    total = sum(len(row) for expected in truth for row in expected)
+    return {"recall": found / total, **{key: value * 1000 for key, value in percentiles(latencies).items()}}
+
+
+if __name__ == "__main__":
+    from fakes import FakeEmbeddings
+
+    args = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    args.add_argument("--chunks", type=int, default=100000, help="size of the synthetic collection")
+    args.add_argument("--dim", type=int, default=768)
+    args.add_argument("--db-dir", help="where to keep the synthetic collection (default: in memory)")
+    args.add_argument("--collection", help="benchmark an existing collection (embedded with _global.hf_embed) instead")
+    args.add_argument("--index-dir", help="where to export the index (default: temporary directory)")
+    args.add_argument("--batches", type=int, default=200, help="num of query batches (diagnoses)")
+    args.add_argument("--k", type=int, default=4)
+    args.add_argument("--ef", type=int, default=64, help="hnsw ef at query time")
+    args.add_argument("--rescore", type=int, default=4, help="quantized indexes rescore k * rescore candidates")
+    args = args.parse_args()
+
+    if args.collection:
+        from _global import hf_embed as emb_func
+        from database_helper import open_collection
+        db_dir = args.collection
+        start = time.perf_counter()
+        db = open_collection(db_dir, emb_func)
+        db._collection.count()
+    else:
+        emb_func = FakeEmbeddings(dim=args.dim)
+        db_dir = args.db_dir
+        db, _ = build_collection(args.chunks, emb_func, db_dir)
+        start = time.perf_counter()
+        if db_dir: # reopen to time a cold open from disk
+            db = type(db)(collection_name="main_collection", persist_directory=db_dir, embedding_function=emb_func)
+            db._collection.count()
+    chroma_open = time.perf_counter() - start if db_dir else None
+
+    with tempfile.TemporaryDirectory() as tmp:
+        index_dir = args.index_dir or tmp
+        start = time.perf_counter()
+        count = export_collection(db, index_dir, quantization=dtypes)
+        export_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        exact = ExactIndex(index_dir)
+        exact_open = time.perf_counter() - start
+
+        batches = query_batches(emb_func, args.batches)
+        truth = [index_search(exact, args.k)(vectors) for vectors in batches]
+
+        results = {
+            "chroma": (chroma_open, None, bench(chroma_search(db, args.k), batches, truth)),
+            "exact": (exact_open, exact.memory_bytes(), bench(index_search(exact, args.k), batches, truth)),
+        }
+        for dtype in dtypes:
+            for rescore in (0, args.rescore):
+                start = time.perf_counter()
+                index = QuantizedIndex(index_dir, dtype=dtype, rescore=rescore)
+                name = f"{dtype}" + (f"+rescore{rescore}" if rescore else "")
+                results[name] = (time.perf_counter() - start, index.memory_bytes(), bench(index_search(index, args.k), batches, truth))
+        if HNSWIndex.available:
+            start = time.perf_counter()
+            HNSWIndex(index_dir) # builds and saves the graph
+            build_seconds = time.perf_counter() - start
+            start = time.perf_counter()
+            hnsw = HNSWIndex(index_dir, ef=args.ef)
+            results["hnsw"] = (time.perf_counter() - start, hnsw.memory_bytes(), bench(index_search(hnsw, args.k), batches, truth))
+        else:
+            build_seconds = None
+            print("hnswlib is not installed, skipping hnsw")
+
+    print(f"{count} chunks, dim {exact.vectors.shape[1]}, k={args.k}, {args.batches} batches of {len(queries_ddx)} queries")
+    print(f"export: {export_seconds:.1f} s" + (f", hnsw build: {build_seconds:.1f} s" if build_seconds is not None else ""))
+    print(f"{'backend':<18}{'open (s)':>10}{'memory (MB)':>13}{'recall':>9}{'p50 (ms)':>10}{'p95 (ms)':>10}{'p99 (ms)':>10}")
+    for name, (open_seconds, memory, r) in results.items():
+        opened = f"{open_seconds:>10.2f}" if open_seconds is not None else f"{'-':>10}"
+        memory = f"{memory / 1e6:>13.1f}" if memory is not None else f"{'-':>13}"
+        print(f"{name:<18}{opened}{memory}{r['recall']:>9.3f}{r['p50']:>10.2f}{r['p95']:>10.2f}{r['p99']:>10.2f}")
@@ -0,0 +1,90 @@
+"""Check of the WikiCrawler reruns (preprocess_wiki.py) against a local stand-in of the MediaWiki api
+- the server answers categorymembers, prop=info (lastrevid / touched) and prop=extracts queries for a few canned
+    pages, and sends no ETag / Last-Modified (like many api responses)
+- first run: one page fails (http 500), every other page is written; rerun: only the failed page is fetched and
+    written; rerun: 0 pages written and no page fetched again; after one page gets a new revision: only that page is
+    written
+- exits with an error when a run writes or fetches more than it should
+
+run from the repo root: python -m benchmarks.wiki_crawler [--pages 20]
+"""
+
+import os
+import json
+import argparse
+import tempfile
+import threading
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from preprocess_wiki import WikiCrawler
+
+
+class StandIn(BaseHTTPRequestHandler):
+    """canned MediaWiki api; server.pages: title: {"lastrevid", "html"}, server.fetched: titles of extract queries,
+    server.failing: titles whose extract query gets a 500"""
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        query = dict(urllib.parse.parse_qsl(urllib.parse.urlparse(self.path).query))
+        pages = self.server.pages
+        if query.get("list") == "categorymembers":
+            members = [{"ns": 0, "title": title} for title in pages] + [{"ns": 14, "title": "Category:Pediatrics"}]
+            body = {"query": {"categorymembers": members}}
+        else:
+            result = {}
+            if "extracts" in query["prop"] and query["titles"] in self.server.failing:
+                self.send_error(500)
+                return
+            for i, title in enumerate(query["titles"].split("|")):
+                page = pages[title]
+                result[str(i)] = {"title": title, "lastrevid": page["lastrevid"], "touched": f"2024-01-01T00:00:{page['lastrevid'] % 60:02d}Z",
+                                  "canonicalurl": f"https://en.wikipedia.org/wiki/{title.replace(' ', '_')}"}
+                if "extracts" in query["prop"]:
+                    result[str(i)]["extract"] = page["html"]
+                    self.server.fetched.append(title)
+            body = {"query": {"pages": result}}
+
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def check(name, written, fetched, expected):
+    print(f"{name:<22}{written:>8} written{len(fetched):>8} fetched")
+    if written != expected or len(fetched) != expected:
+        raise SystemExit(f"{name}: expected {expected} pages written and fetched")
+
+
+if __name__ == "__main__":
+    args = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    args.add_argument("--pages", type=int, default=20)
+    args = args.parse_args()
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandIn)
+    server.pages = {
+        f"Disease {i}": {"lastrevid": 1000 + i, "html": f"<p>Disease {i} is a condition.</p><h2>Treatment</h2><p>Rest and fluids.</p>"}
+        for i in range(args.pages)
+    }
+    server.fetched = []
+    server.failing = {"Disease 5"}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        out = os.path.join(tmp, "wiki")
+        os.makedirs(out)
+        crawler = WikiCrawler(api_url=f"http://127.0.0.1:{server.server_port}/w/api.php", cache_dir=os.path.join(tmp, "cache"), concurrency=4)
+
+        check("first run, one failing", crawler.download_md(["Pediatrics"], out), server.fetched, args.pages - 1)
+        server.fetched.clear()
+        server.failing.clear()
+        check("rerun, failed page", crawler.download_md(["Pediatrics"], out), server.fetched, 1)
+        server.fetched.clear()
+        check("rerun", crawler.download_md(["Pediatrics"], out), server.fetched, 0)
+        server.fetched.clear()
+        server.pages["Disease 3"] = {"lastrevid": 5000, "html": "<p>Disease 3 was edited.</p>"}
+        check("one page edited", crawler.download_md(["Pediatrics"], out), server.fetched, 1)
+    server.shutdown()
@@ -0,0 +1,106 @@
+"""Benchmark of html -> md conversion of wikipedia pages (preprocess_wiki.parser)
+- before: new html2text converter per page + BeautifulSoup parse/serialize round trip
+- after: shared lxml based MarkdownConverter that drops the sections while converting
+- fixtures are saved page html (one .html file per page, a few committed in benchmarks/fixtures/wiki_html); use
+    --fetch to save more from a category
+- parity: html_to_md must give the md of the html2text fallback (same text and escapes; whitespace only differences,
+    like html2text's trailing spaces and extra blank lines after lists, are normalized); the diff of every page that
+    differs is printed and the run fails
+
+run from the repo root: python -m benchmarks.wiki_parser [--fixtures DIR] [--fetch CATEGORY --n 50]
+"""
+
+import os
+import re
+import time
+import difflib
+import argparse
+from bs4 import BeautifulSoup
+from preprocess_wiki import WikiCrawler, html2text_maker, html_to_md, remove_sections_html
+
+fixtures_dir = os.path.join(os.path.dirname(__file__), "fixtures", "wiki_html")
+
+
+def parser_before(html):
+    """the previous parser(): sections removed, then a new converter and a soup round trip per page"""
+    text_maker = html2text_maker()
+    soup = BeautifulSoup(remove_sections_html(html), "html.parser")
+    return text_maker.handle(str(soup))
+
+
+def save_fixtures(category, n, path):
+    """save the html of the first n pages of a category"""
+    os.makedirs(path, exist_ok=True)
+    crawler = WikiCrawler(concurrency=4)
+    for title in crawler.crawl([category])[:n]:
+        title, url, html, _ = crawler.fetch_page(title)
+        with open(os.path.join(path, f"{title.replace('/', '_')}.html"), "w") as f:
+            f.write(html)
+
+
+def load_fixtures(path):
+    """dict of filename: page html"""
+    pages = {}
+    for filename in sorted(os.listdir(path)):
+        if filename.endswith(".html"):
+            with open(os.path.join(path, filename), "r") as f:
+                pages[filename] = f.read()
+    return pages
+
+
+def normalize(md):
+    """md without trailing spaces and with single blank lines between blocks"""
+    lines = [line.rstrip() for line in md.strip().split("\n")]
+    return re.sub(r"\n{3,}", "\n\n", "\n".join(lines)) + "\n"
+
+
+def parity(pages):
+    """names of the pages whose html_to_md differs from html2text (the diffs are printed)"""
+    differ = []
+    for name, html in pages.items():
+        expected = normalize(html2text_maker().handle(remove_sections_html(html))).splitlines(keepends=True)
+        got = normalize(html_to_md(html)).splitlines(keepends=True)
+        if got != expected:
+            differ.append(name)
+            print("".join(difflib.unified_diff(expected, got, f"{name} (html2text)", f"{name} (html_to_md)")))
+    return differ
+
+
+def bench(func, pages, repeat=3):
+    """best pages/sec over repeat runs"""
+    best = 0.0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for html in pages:
+            func(html)
+        best = max(best, len(pages) / (time.perf_counter() - start))
+    return best
+
+
+if __name__ == "__main__":
+    args = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    args.add_argument("--fixtures", default=fixtures_dir)
+    args.add_argument("--fetch", metavar="CATEGORY", help="save fixtures from this category first")
+    args.add_argument("--n", type=int, default=50, help="num of pages to fetch")
+    args.add_argument("--repeat", type=int, default=3)
+    args = args.parse_args()
+
+    if args.fetch:
+        save_fixtures(args.fetch, args.n, args.fixtures)
+
+    pages = load_fixtures(args.fixtures)
+    if not pages:
+        raise SystemExit(f"no .html fixtures in {args.fixtures}; use --fetch CATEGORY to save some")
+
+    differ = parity(pages)
+    print(f"parity: {len(pages) - len(differ)}/{len(pages)} pages give the md of html2text")
+    if differ:
+        raise SystemExit(f"html_to_md differs from html2text on {', '.join(differ)}")
+
+    pages = list(pages.values())
+    size = sum(len(html) for html in pages) / 1e6
+    before = bench(parser_before, pages, args.repeat)
+    after = bench(html_to_md, pages, args.repeat)
+    print(f"{len(pages)} pages ({size:.1f} MB)")
+    print(f"before: {before:.1f} pages/sec")
+    print(f"after:  {after:.1f} pages/sec ({after/before:.1f}x)")
@@ -0,0 +1,107 @@
+"""Token-budgeted assembly of the section contexts of the final handout prompt
+- tokens are counted with tiktoken (cl100k_base, the gpt-3.5 tokenizer) or estimated from the length when the
+    encoding is not available locally
+- the md plan, diagnosis and template are always kept; what is left of the budget is shared by the sections
+    (by weight, a section that needs less than its share leaves the rest to the others)
+- within a section chunks are kept best ranked first; the chunk that crosses the share is trimmed (or dropped if
+    too little would be left) and the lower ranked ones are dropped
+- every cut is returned so it can be logged (main / rag_bot record them on the context_assembly stage) and counted
+    per section in instrumentation.metrics (rag_section_dropped_chunks_total{section=...}, ...)
+"""
+
+from _global import singleton
+from rate_limiter import estimate_tokens
+from instrumentation import metrics
+
+context_token_budget = 6000 # prompt tokens of the handout prompt (gpt-3.5-turbo-1106: 16k, llama2:13b: 4k)
+min_chunk_tokens = 32 # a chunk is dropped instead of trimmed below this
+
+
+@singleton
+def get_tokenizer():
+    """tiktoken encoding, None when tiktoken or its encoding file (downloaded once, then cached) is not available"""
+    try:
+        import tiktoken
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception: # not installed or offline without the cached encoding
+        return None
+
+
+def count_tokens(text):
+    tokenizer = get_tokenizer()
+    if tokenizer is None:
+        return estimate_tokens(text)
+    return len(tokenizer.encode(text, disallowed_special=()))
+
+
+def trim_to_tokens(text, max_tokens):
+    tokenizer = get_tokenizer()
+    if tokenizer is None:
+        return text[:max_tokens * 4] + " ..."
+    return tokenizer.decode(tokenizer.encode(text, disallowed_special=())[:max_tokens]) + " ..."
+
+
+def allocate(available, demands, weights=None):
+    """shares of available tokens for sections that need demands[section] tokens (water filling by weight)"""
+    weights = weights or {}
+    shares = {section: 0.0 for section in demands}
+    active = {section for section, demand in demands.items() if demand > 0}
+    remaining = float(max(available, 0))
+    while active and remaining >= 1:
+        total_weight = sum(weights.get(section, 1.0) for section in active)
+        given = 0.0
+        for section in list(active):
+            take = min(remaining * weights.get(section, 1.0) / total_weight, demands[section] - shares[section])
+            shares[section] += take
+            given += take
+            if shares[section] >= demands[section]:
+                active.remove(section)
+        remaining -= given
+
+    return {section: int(share) for section, share in shares.items()}
+
+
+def fit_to_budget(sections, budget=context_token_budget, reserved_tokens=0, weights=None, extra_tokens=None):
+    """keeps the chunks of every section that fit in the budget
+
+        -sections: dict of section: list of chunk texts, best ranked first
+        -reserved_tokens: tokens of the parts of the prompt that are always kept (md plan, template, ...)
+        -extra_tokens: dict of section: tokens each chunk takes in the prompt besides its text (formatting, source)
+        -returns (dict of section: list of (chunk position, text), cuts); trimmed chunks have a shorter text
+        -cuts: list of {"section", "rank", "tokens", "kept_tokens"} of the dropped (kept_tokens 0) and trimmed chunks
+    """
+    extra_tokens = extra_tokens or {}
+    extra = {section: extra_tokens.get(section) or [0] * len(texts) for section, texts in sections.items()}
+    tokens = {section: [count_tokens(text) + e for text, e in zip(texts, extra[section])] for section, texts in sections.items()}
+    shares = allocate(budget - reserved_tokens, {section: sum(t) for section, t in tokens.items()}, weights)
+
+    kept, cuts = {}, []
+    for section, texts in sections.items():
+        kept[section] = []
+        left = shares[section]
+        for rank, (text, n, e) in enumerate(zip(texts, tokens[section], extra[section])):
+            if n <= left:
+                kept[section].append((rank, text))
+                left -= n
+            elif left - e >= min_chunk_tokens:
+                kept[section].append((rank, trim_to_tokens(text, left - e)))
+                cuts.append({"section": section, "rank": rank, "tokens": n, "kept_tokens": left})
+                left = 0
+            else:
+                cuts.append({"section": section, "rank": rank, "tokens": n, "kept_tokens": 0})
+
+    return kept, cuts
+
+
+def cut_stats(cuts, stage="context_assembly"):
+    """totals of the cuts (for the stage record); the cuts are also added to the per section counters of metrics"""
+    for cut in cuts:
+        section = cut["section"][-1] if isinstance(cut["section"], tuple) else cut["section"] # (diagnosis, section) keys
+        metrics.inc("section_dropped_chunks" if not cut["kept_tokens"] else "section_trimmed_chunks", stage, section=section)
+        metrics.inc("section_cut_tokens", stage, cut["tokens"] - cut["kept_tokens"], section=section)
+    return {
+        "dropped_chunks": sum(1 for cut in cuts if not cut["kept_tokens"]),
+        "trimmed_chunks": sum(1 for cut in cuts if cut["kept_tokens"]),
+        "cut_tokens": sum(cut["tokens"] - cut["kept_tokens"] for cut in cuts),
+        "cuts": cuts,
+    }
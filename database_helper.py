@@ -1,23 +1,486 @@
 """ functions to add collection to the vector database 
     -collection is called main_collection
-    -from_documents will append embeddings to existing collection, including duplicates
+    -chunks are upserted with a deterministic id (hash of file + content), so re-running does not add duplicates
+    -embeddings are cached on disk (embedding_cache.py); only new chunks are embedded
     -the .md files should have a ## Source at the bottom of the file to use as metadata
+    -.md ingestion is a streaming pipeline: parse/split in a process pool, embed + write in fixed size batches
+    -sync_directory_md only re-ingests files that changed since the last run (tracked in a manifest)
+    -every change to the collection bumps the corpus version (used to invalidate response caches)
+    -and recalibrates the int8 quantization of the embeddings once enough chunks changed (quantization.json, used by
+        vector_index exports)
+    -and updates the bm25 index of the chunks with the added and deleted ones (db_directory/bm25, used by
+        retrieval.HybridRetriever)
+    -and the dictionary of diagnosis names of the titles (db_directory/diagnoses.json, used by main to skip the llm
+        diagnosis extraction), reading only the chunks of the titles that changed
+    -every chunk has a section metadata (section_partitions.py) so each query only searches the chunks of its sections;
+        collections ingested before are labelled on the next change (or with tag_sections)
+    -near-duplicate chunks (same text in several sources or files) are removed after every change (near_duplicates.py):
+        one chunk per cluster is kept with the urls of all the copies in its "sources" metadata
 """
 
+import os
 import re
+import glob
+import json
+import time
+import uuid
+import hashlib
+import numpy as np
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from _global import path_to_resources, hf_embed
+from embedding_cache import CachedEmbeddings, content_hash
+from quantization import calibrate, save_calibration, load_calibration
+from lexical_index import BM25Index
+from diagnosis_dictionary import DiagnosisMatcher, title_key, collection_chunks, save_title_entries, load_title_entries
+from section_partitions import classify_section
+from near_duplicates import MinHasher, canonical_clusters, match_signatures
 from langchain_community.document_loaders import TextLoader, DirectoryLoader
 from langchain_community.vectorstores import Chroma
 from langchain.text_splitter import RecursiveCharacterTextSplitter, MarkdownHeaderTextSplitter
 
+embedding_cache_path = f"{path_to_resources}/embedding_cache.sqlite"
+recalibrate_share = 0.05 # the quantization is calibrated again when this share of the chunks changed since the last time
 
+headers_to_split_on = [
+    ("#", "Title"),
+    ("##", "Header2"),
+    ("###", "Header3"),
+    ("####", "Header4"),
+]
 
-def create_collection_from_directory_txt(directory_path, db_directory, emb_func):
+
+def chunk_id(file_source, text):
+    """deterministic id of a chunk: same file and same content -> same id
+
+        -the path is made absolute first, so create_collection_* (path as given) and sync_directory_md (absolute
+            path) give the same id to the same chunk
+    """
+    return content_hash(f"{os.path.abspath(file_source)}\n{text}")
+
+
+def open_collection(db_directory, emb_func):
+    return Chroma(collection_name="main_collection", embedding_function=emb_func, persist_directory=db_directory)
+
+
+def upsert_chunks(chunks, ids, db, skip_ids=(), added_ids=None):
+    """add chunks to main_collection under ids; chunks whose id is already in the collection are skipped
+
+        -skip_ids: ids not to add (the near-duplicate copies removed by dedup_collection)
+        -added_ids: list the ids of the added chunks are appended to
+        returns (num added, num skipped)
+    """
+    unique = dict(zip(ids, chunks)) # identical chunks within a file share an id
+    skipped = [i for i in unique if i in skip_ids]
+    for i in skipped:
+        del unique[i]
+    if not unique:
+        return 0, len(skipped)
+
+    existing = set(db.get(ids=list(unique), include=[])["ids"])
+    new_ids = [i for i in unique if i not in existing]
+
+    if new_ids:
+        db.add_texts(
+            texts = [unique[i].page_content for i in new_ids],
+            metadatas = [unique[i].metadata for i in new_ids],
+            ids = new_ids, # add_texts upserts when ids are given
+        )
+        if added_ids is not None:
+            added_ids.extend(new_ids)
+
+    return len(new_ids), len(existing) + len(skipped)
+
+
+def get_corpus_version(db_directory):
+    """id that changes every time chunks are added to or deleted from the collection in db_directory"""
+    path = os.path.join(db_directory, "corpus_version")
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return f.read().strip()
+
+
+def bump_corpus_version(db_directory):
+    """called after the collection changed; caches keyed on the corpus version are invalidated"""
+    os.makedirs(db_directory, exist_ok=True)
+    with open(os.path.join(db_directory, "corpus_version"), "w") as f:
+        f.write(uuid.uuid4().hex)
+
+
+def calibrate_collection(db, db_directory, sample_size=100000, batch_size=1000, changed=None):
+    """computes the int8 quantization calibration of the embeddings in the collection (quantization.json)
+
+        -collections larger than sample_size are calibrated on random batches of batch_size chunks
+        -changed: num of chunks added / deleted since the last run; the saved calibration is kept (the quantiles of a
+            few new chunks barely move) until the chunks changed since it was computed reach recalibrate_share of the
+            collection
+    """
+    collection = db._collection
+    count = collection.count()
+    if not count:
+        return None
+
+    path = os.path.join(db_directory, "quantization.json")
+    saved = load_calibration(path) if changed is not None else None
+    if saved is not None:
+        saved["changed"] = saved.get("changed", 0) + changed
+        save_calibration(saved, path)
+        if saved["changed"] < recalibrate_share * count:
+            return saved
+
+    offsets = range(0, count, batch_size)
+    if count > sample_size:
+        offsets = sorted(np.random.default_rng(0).choice(offsets, size=sample_size // batch_size, replace=False))
+    vectors = [collection.get(offset=int(offset), limit=batch_size, include=["embeddings"])["embeddings"] for offset in offsets]
+
+    calibration = calibrate(np.concatenate([np.asarray(v, dtype=np.float32) for v in vectors]))
+    save_calibration(calibration, path)
+    return calibration
+
+
+def build_lexical_index(db, db_directory, ids=None, deleted_ids=(), batch_size=5000):
+    """bm25 index of all the chunks in the collection, saved in db_directory/bm25
+
+        -ids / deleted_ids: chunks added (or whose metadata changed) / deleted since the last run; the saved index is
+            updated with them (BM25Index.update). ids None (or no saved index with chunk ids): built from every chunk
+    """
+    start = time.perf_counter()
+    path = os.path.join(db_directory, "bm25")
+    index = None
+    if ids is not None and os.path.exists(os.path.join(path, "meta.json")):
+        index = BM25Index.load(path)
+        if index.ids is None or index.tfs is None: # saved by an older version
+            index = None
+        else:
+            index = index.update(*_get_chunks(db._collection, list(ids), batch_size), deleted_ids)
+    if index is None:
+        index = BM25Index.from_collection(db)
+    index.save(path)
+    print(f"bm25 index: {len(index)} chunks, {len(index.terms)} terms ({time.perf_counter() - start:.1f}s)")
+    return index
+
+
+def build_diagnosis_dictionary(db, db_directory, ids=None, deleted=(), batch_size=5000):
+    """diagnosis names of the titles of the collection, saved in db_directory/diagnoses.json
+
+        -ids / deleted: ids of the chunks added / metadatas of the chunks deleted since the last run; only the names
+            and words of their titles are read again (db_directory/diagnosis_titles.json keeps them for every title).
+            ids None (or no saved titles): every chunk is read
+    """
+    start = time.perf_counter()
+    path = os.path.join(db_directory, "diagnosis_titles.json")
+    if ids is not None and os.path.exists(path):
+        entries = load_title_entries(path)
+        titles = {(metadata or {}).get(title_key) for metadata in deleted}
+        for i in range(0, len(ids), batch_size):
+            titles.update((metadata or {}).get(title_key) for metadata in db._collection.get(ids=ids[i:i + batch_size], include=["metadatas"])["metadatas"])
+        titles = sorted(title for title in titles if title)
+        for title in titles:
+            entries.pop(title, None)
+        for i in range(0, len(titles), 100):
+            entries.update(DiagnosisMatcher.title_entries(collection_chunks(db, batch_size, where={title_key: {"$in": titles[i:i + 100]}})))
+    else:
+        entries = DiagnosisMatcher.title_entries(collection_chunks(db, batch_size))
+    os.makedirs(db_directory, exist_ok=True)
+    save_title_entries(entries, path)
+    matcher = DiagnosisMatcher.from_titles(entries)
+    matcher.save(os.path.join(db_directory, "diagnoses.json"))
+    print(f"diagnosis dictionary: {len(matcher)} names ({time.perf_counter() - start:.1f}s)")
+    return matcher
+
+
+def tag_sections(db, db_directory, batch_size=5000, ids=None, deleted=()):
+    """adds the section label to the chunks that have none (or another label than classify_section gives now, after
+    a change of the rules); counts per label saved in db_directory/sections.json
+
+        -ids: only these chunks are labelled (the chunks added since the last run) and the saved counts are updated,
+            deleted: metadatas of the chunks deleted since the last run. ids None (or no saved counts): every chunk
+    """
+    collection = db._collection
+    path = os.path.join(db_directory, "sections.json")
+    counts = {}
+    if ids is not None and os.path.exists(path):
+        with open(path, "r") as f:
+            counts = json.load(f)
+        for metadata in deleted:
+            section = (metadata or {}).get("section") or classify_section(metadata or {})
+            counts[section] = counts.get(section, 0) - 1
+    else:
+        ids = None
+
+    if ids is None:
+        batches = (collection.get(offset=offset, limit=batch_size, include=["metadatas"]) for offset in range(0, collection.count(), batch_size))
+    else:
+        batches = (collection.get(ids=ids[i:i + batch_size], include=["metadatas"]) for i in range(0, len(ids), batch_size))
+    tagged = 0
+    for batch in batches:
+        update_ids, metadatas = [], []
+        for chunk_id, metadata in zip(batch["ids"], batch["metadatas"]):
+            metadata = metadata or {}
+            section = classify_section(metadata)
+            if metadata.get("section") != section:
+                metadata["section"] = section
+                update_ids.append(chunk_id)
+                metadatas.append(metadata)
+            counts[metadata["section"]] = counts.get(metadata["section"], 0) + 1
+        if update_ids:
+            collection.update(ids=update_ids, metadatas=metadatas) # metadata only, the embeddings are kept
+            tagged += len(update_ids)
+
+    counts = {section: count for section, count in counts.items() if count > 0}
+    os.makedirs(db_directory, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(counts, f, indent=2)
+    print(f"section labels: {tagged} chunks labelled, {counts}")
+    return counts
+
+
+def load_duplicates(db_directory):
+    """near-duplicate clusters removed from the collection: {canonical id: {duplicate id: source}}"""
+    path = os.path.join(db_directory, "duplicates.json")
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def duplicate_ids(db_directory):
+    """ids of the chunks removed as near-duplicate copies (not added again at ingestion)"""
+    return {copy for copies in load_duplicates(db_directory).values() for copy in copies}
+
+
+def save_duplicates(duplicates, db_directory):
+    os.makedirs(db_directory, exist_ok=True)
+    with open(os.path.join(db_directory, "duplicates.json"), "w") as f:
+        json.dump(duplicates, f)
+
+
+def load_signatures(db_directory):
+    """(ids, minhash signatures) of the kept chunks of the collection, None if never computed"""
+    path = os.path.join(db_directory, "minhash.npz")
+    if not os.path.exists(path):
+        return None
+    arrays = np.load(path)
+    return arrays["ids"].tolist(), arrays["signatures"]
+
+
+def save_signatures(ids, signatures, db_directory):
+    os.makedirs(db_directory, exist_ok=True)
+    np.savez(os.path.join(db_directory, "minhash.npz"), ids=np.asarray(ids, dtype=str), signatures=signatures)
+
+
+def _get_chunks(collection, ids, batch_size):
+    """(ids, texts, metadatas) of the chunks of ids that are in the collection (all the chunks if ids is None)"""
+    found = ([], [], [])
+    if ids is None:
+        batches = (collection.get(offset=offset, limit=batch_size, include=["documents", "metadatas"]) for offset in range(0, collection.count(), batch_size))
+    else:
+        batches = (collection.get(ids=ids[i:i + batch_size], include=["documents", "metadatas"]) for i in range(0, len(ids), batch_size))
+    for batch in batches:
+        found[0].extend(batch["ids"])
+        found[1].extend(batch["documents"])
+        found[2].extend(metadata or {} for metadata in batch["metadatas"])
+    return found
+
+
+def dedup_collection(db, db_directory, added_ids=None, deleted_ids=(), batch_size=5000):
+    """removes the near-duplicate chunks of the collection (near_duplicates.py)
+
+        -added_ids / deleted_ids: chunks added / deleted since the last run; only the added chunks are hashed and
+            matched against the stored signatures of the kept chunks (db_directory/minhash.npz), a chunk already in
+            the collection stays canonical. added_ids None (or no stored signatures): every chunk is hashed
+        -the canonical chunk of a cluster keeps the urls of all the copies in its "sources" metadata (space separated);
+            they are merged again into every added chunk that is canonical (upserted again with its changed file)
+        -clusters are recorded in db_directory/duplicates.json: ingestion skips the copies, and sync_directory_md
+            restores them when the file of a canonical chunk changes
+    """
+    start = time.perf_counter()
+    collection = db._collection
+    duplicates = load_duplicates(db_directory)
+    stored = load_signatures(db_directory) if added_ids is not None else None
+    full = stored is None
+
+    # forget the deleted chunks
+    gone = set(deleted_ids)
+    stored_ids, stored_signatures = stored or ([], np.zeros((0, 0), dtype=np.uint32))
+    if gone and stored_ids:
+        keep = np.array([chunk_id not in gone for chunk_id in stored_ids], dtype=bool)
+        stored_ids, stored_signatures = [i for i, k in zip(stored_ids, keep) if k], stored_signatures[keep]
+    touched = set() # canonical chunks whose sources changed
+    for canonical in list(duplicates):
+        if canonical in gone:
+            del duplicates[canonical]
+        elif gone.intersection(duplicates[canonical]):
+            duplicates[canonical] = {c: source for c, source in duplicates[canonical].items() if c not in gone}
+            touched.add(canonical)
+
+    # hash the new chunks, match them to the kept ones, then to each other
+    known = set(stored_ids)
+    ids, texts, metadatas = _get_chunks(collection, None if full else [i for i in dict.fromkeys(added_ids) if i not in known], batch_size)
+    signatures = MinHasher().signatures(texts)
+    if full:
+        stored_signatures = signatures[:0]
+    matches = match_signatures(signatures, stored_signatures)
+    copies = {row: stored_ids[match] for row, match in enumerate(matches) if match >= 0} # new row: canonical id
+    unmatched = np.flatnonzero(matches < 0)
+    for canonical, rows in canonical_clusters(signatures[unmatched], [len(texts[row]) for row in unmatched]):
+        copies.update((int(unmatched[row]), ids[unmatched[canonical]]) for row in rows)
+
+    removed = []
+    for row, canonical in copies.items():
+        record = duplicates.setdefault(canonical, {})
+        record.update(duplicates.pop(ids[row], {})) # a canonical chunk of an earlier run is a copy now
+        record[ids[row]] = metadatas[row].get("source")
+        removed.append(ids[row])
+        touched.add(canonical)
+    # added again (a changed file keeps the ids of its unchanged chunks): upserted without the sources of its copies
+    touched.update(chunk_id for chunk_id in (ids if full else added_ids) if chunk_id in duplicates)
+    if full:
+        touched.update(duplicates)
+
+    kept = [row for row in range(len(ids)) if row not in copies]
+    stored_ids = stored_ids + [ids[row] for row in kept]
+    stored_signatures = np.concatenate([stored_signatures.reshape(-1, signatures.shape[1]), signatures[kept]])
+
+    # sources of the canonical chunks whose clusters changed
+    update_ids, update_metadatas = [], []
+    canonical_ids, _, canonical_metadatas = _get_chunks(collection, sorted(touched), batch_size)
+    for canonical in touched.difference(canonical_ids): # no longer in the collection
+        duplicates.pop(canonical, None)
+    for canonical, metadata in zip(canonical_ids, canonical_metadatas):
+        record = duplicates.get(canonical, {})
+        sources = " ".join(dict.fromkeys(source for source in [metadata.get("source"), *record.values()] if source))
+        if metadata.get("sources", "") != sources and (record or "sources" in metadata):
+            metadata["sources"] = sources
+            update_ids.append(canonical)
+            update_metadatas.append(metadata)
+    for i in range(0, len(update_ids), batch_size):
+        collection.update(ids=update_ids[i:i + batch_size], metadatas=update_metadatas[i:i + batch_size])
+    for i in range(0, len(removed), batch_size):
+        collection.delete(ids=removed[i:i + batch_size])
+    save_duplicates(duplicates, db_directory)
+    save_signatures(stored_ids, stored_signatures, db_directory)
+
+    elapsed = time.perf_counter() - start
+    stats = {"hashed": len(ids), "chunks": len(stored_ids), "removed": len(removed), "seconds": elapsed,
+             "removed_ids": removed, "updated_ids": update_ids}
+    print(f"near duplicates: {len(ids)} chunks hashed, {len(removed)} removed ({len(removed) / max(1, len(ids)):.1%}), "
+          f"{len(stored_ids)} kept in the collection ({elapsed:.1f}s)")
+    return stats
+
+
+def _restore_duplicates(db, db_directory, deleted_ids, manifest, added_ids):
+    """the copies of deleted canonical chunks are upserted again from their files (dedup_collection then picks a new
+    canonical chunk); returns the num of chunks added (their ids are appended to added_ids)"""
+    duplicates = load_duplicates(db_directory)
+    deleted = set(deleted_ids)
+    restore = set()
+    for canonical in list(duplicates):
+        for copy in deleted.intersection(duplicates[canonical]):
+            del duplicates[canonical][copy]
+        if canonical in deleted:
+            restore.update(duplicates.pop(canonical))
+    if not restore:
+        return 0
+    save_duplicates(duplicates, db_directory)
+
+    added = 0
+    for path, entry in manifest.items():
+        if restore.intersection(entry["ids"]) and os.path.exists(path):
+            chunks, ids = split_md_document(TextLoader(path).load()[0])
+            added += upsert_chunks(chunks, ids, db, added_ids=added_ids)[0] # only the missing copies are added
+    return added
+
+
+def _delete_chunks(db, ids, deleted):
+    """deletes the chunks of ids from the collection; the metadatas of the ones that were in it are added to deleted
+    (id: metadata), for _collection_changed"""
+    if not ids:
+        return
+    found = db._collection.get(ids=ids, include=["metadatas"])
+    deleted.update((chunk_id, metadata or {}) for chunk_id, metadata in zip(found["ids"], found["metadatas"]))
+    db.delete(ids=ids)
+
+
+def _collection_changed(db, db_directory, added_ids=None, deleted_ids=(), deleted=None):
+    """updates what is derived from the collection after chunks were added / deleted
+
+        -added_ids: ids of the added chunks; None: everything is rebuilt from the whole collection
+        -deleted_ids: deleted chunks that were not added back (for dedup_collection), deleted: {id: metadata} of all
+            the chunks deleted from the collection
+        -only the added and deleted chunks are labelled / indexed / read for the dictionary; nothing is done if the
+            collection did not change
+    """
+    stats = dedup_collection(db, db_directory, added_ids, deleted_ids)
+    removed = set(stats["removed_ids"])
+    if added_ids is None or removed.difference(added_ids): # chunks of earlier runs removed: first dedup run
+        tag_sections(db, db_directory) # first: the indexes below keep the labels
+        bump_corpus_version(db_directory)
+        calibrate_collection(db, db_directory)
+        build_lexical_index(db, db_directory)
+        build_diagnosis_dictionary(db, db_directory)
+        return
+
+    deleted = deleted or {}
+    added_ids = [chunk_id for chunk_id in dict.fromkeys(added_ids) if chunk_id not in removed]
+    if not added_ids and not deleted and not stats["updated_ids"]:
+        return
+    tag_sections(db, db_directory, ids=added_ids, deleted=deleted.values())
+    bump_corpus_version(db_directory)
+    calibrate_collection(db, db_directory, changed=len(added_ids) + len(deleted))
+    build_lexical_index(db, db_directory, list(dict.fromkeys(added_ids + stats["updated_ids"])), list(deleted)) # updated: new sources
+    build_diagnosis_dictionary(db, db_directory, added_ids, deleted.values())
+
+
+def _with_cache(emb_func, cache_path):
+    if cache_path and not isinstance(emb_func, CachedEmbeddings):
+        return CachedEmbeddings(emb_func, cache_path)
+    return emb_func
+
+
+def _print_stats(added, skipped, emb_func):
+    print("num of chunks added: ", added)
+    print("num of chunks already in collection: ", skipped)
+    if isinstance(emb_func, CachedEmbeddings):
+        print("embedding cache: ", emb_func.stats())
+
+
+def split_md_document(doc):
+    """split one .md document by headers; the ## Source url at the bottom becomes the source metadata
+
+        returns (chunks, ids)
+    """
+    # find and extract the URL
+    url_pattern = r"\s*## Source\s*\n\s*(https?://[^\s]+)"
+    match = re.search(url_pattern, doc.page_content, flags=re.MULTILINE)
+    url = None
+
+    if match:
+        url = match.group(1)
+        # Remove the matched section from the doc.page_content
+        doc.page_content = re.sub(url_pattern, "", doc.page_content, flags=re.MULTILINE)
+
+    split = MarkdownHeaderTextSplitter(headers_to_split_on=headers_to_split_on).split_text(doc.page_content)
+
+    # add source metadata
+    if url:
+        for chunk in split:
+            chunk.metadata["source"] = url
+    for chunk in split:
+        chunk.metadata["section"] = classify_section(chunk.metadata)
+
+    return split, [chunk_id(doc.metadata["source"], chunk.page_content) for chunk in split]
+
+
+def create_collection_from_directory_txt(directory_path, db_directory, emb_func, cache_path=embedding_cache_path):
     """create a new/add to collection and add all the files of .txt in the directory to the collection
     
         -collection cotains evidence from all the source from one file type (dont need to create different
             collections for different sources as they will need to use the same retriever)
+        -cache_path: sqlite embedding cache; None to always embed
     """
+    emb_func = _with_cache(emb_func, cache_path)
     doc_splitter = RecursiveCharacterTextSplitter(
         chunk_size = 1000,
         chunk_overlap  = 200,
@@ -34,104 +497,221 @@ def create_collection_from_directory_txt(directory_path, db_directory, emb_func)
     docs = loader.load()
 
     splits = doc_splitter.split_documents(docs)
+    ids = [chunk_id(chunk.metadata["source"], chunk.page_content) for chunk in splits]
 
     # add source metadata
     for chunk in splits:
         chunk.metadata["source"] = chunk.metadata["source"].split("/")[-1].replace(".txt","")
 
-    # append to collection_name in db (wont overwrite existing collection)
-    db = Chroma.from_documents(
-        collection_name = "main_collection",
-        documents = splits,
-        embedding = emb_func,
-        persist_directory=db_directory
-    )
+    # upsert to collection_name in db (wont overwrite existing collection)
+    db = open_collection(db_directory, emb_func)
+    added_ids = []
+    added, skipped = upsert_chunks(splits, ids, db, duplicate_ids(db_directory), added_ids)
+    if added:
+        _collection_changed(db, db_directory, added_ids)
+    _print_stats(added, skipped, emb_func)
+
 
+def _split_md_file(path):
+    """runs in a worker process: load and split one .md file"""
+    return split_md_document(TextLoader(path).load()[0])
 
-def create_collection_from_directory_md(directory_path, db_directory, emb_func):
+
+def _iter_split_files(paths, workers, max_pending):
+    """split files in a process pool and yield (chunks, ids) per file in order
+
+        -at most max_pending files are in flight so memory does not grow with the corpus
+    """
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for path in paths:
+            pending.append(pool.submit(_split_md_file, path))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def create_collection_from_directory_md(directory_path, db_directory, emb_func, cache_path=embedding_cache_path,
+                                        workers=None, batch_size=64, max_pending=256, max_batches=4):
     """create a new/add to collection and add all the files of .md in the directory to the collection
     
         -collection cotains evidence from all the source from one file type (dont need to create different
             collections for different sources as they will need to use the same retriever)
         -files will have their source url at the end of the file
+        -cache_path: sqlite embedding cache; None to always embed
+        -streaming: files are discovered lazily, parsed/split in a process pool (workers), chunks are embedded in
+            batches of batch_size and added to one open collection by a writer thread
+        -max_pending files and max_batches chunk batches are in flight at most, so memory stays flat
     """
-    headers_to_split_on = [
-        ("#", "Title"),
-        ("##", "Header2"),
-        ("###", "Header3"),
-        ("####", "Header4"),
-    ]
+    emb_func = _with_cache(emb_func, cache_path)
+    db = open_collection(db_directory, emb_func)
+    skip_ids = duplicate_ids(db_directory)
+    added_ids = []
+    paths = glob.iglob(os.path.join(directory_path, "**", "*.md"), recursive=True)
 
-    # load docs
-    loader = DirectoryLoader(
-        path = directory_path, 
-        glob = f"**/*.md", # all files of type in directory and subdirectories
-        show_progress = True,
-        loader_cls = TextLoader,
-    )
-    docs = loader.load()
-  
-    # add to db
+    start = time.perf_counter()
     count = 0
+    num_chunks = 0
+    added = 0
+    skipped = 0
     splits = []
-    for doc in docs:
-        
-        # find and extract the URL
-        url_pattern = r"\s*## Source\s*\n\s*(https?://[^\s]+)"
-        match = re.search(url_pattern, doc.page_content, flags=re.MULTILINE)
-        url = None
-
-        if match:
-            url = match.group(1)
-            # Remove the matched section from the doc.page_content
-            doc.page_content = re.sub(url_pattern, "", doc.page_content, flags=re.MULTILINE)
-
-        split = MarkdownHeaderTextSplitter(headers_to_split_on=headers_to_split_on).split_text(doc.page_content)
-
-        # add source metadata
-        if url:
-            for chunk in split:
-                chunk.metadata["source"] = url
-
-        splits.extend(split)
-
-        count += 1
-        if count%100 == 0: # save to disk every 100 documents
-            db = Chroma.from_documents(
-                collection_name = "main_collection",
-                documents = splits,
-                embedding = emb_func,
-                persist_directory=db_directory
-            )
-            splits = []
-
-    # to capture the remainder split <100 docs
-    db = Chroma.from_documents(
-                collection_name = "main_collection",
-                documents = splits,
-                embedding = emb_func,
-                persist_directory=db_directory
-            )
+    ids = []
+    with ThreadPoolExecutor(max_workers=1) as writer: # embedding + db writes overlap with parsing
+        batches = deque()
+
+        def flush(batch, batch_ids):
+            nonlocal added, skipped
+            batches.append(writer.submit(upsert_chunks, batch, batch_ids, db, skip_ids, added_ids))
+            while len(batches) > max_batches or (batches and batches[0].done()):
+                n_added, n_skipped = batches.popleft().result()
+                added += n_added
+                skipped += n_skipped
+
+        for split, split_ids in _iter_split_files(paths, workers, max_pending):
+            splits.extend(split)
+            ids.extend(split_ids)
+            num_chunks += len(split)
+            count += 1
+
+            while len(splits) >= batch_size:
+                flush(splits[:batch_size], ids[:batch_size])
+                splits = splits[batch_size:]
+                ids = ids[batch_size:]
 
+            if count%100 == 0:
+                elapsed = time.perf_counter() - start
+                print(f"{count} files, {num_chunks} chunks, {count/elapsed:.1f} docs/sec, {num_chunks/elapsed:.1f} chunks/sec")
+
+        # to capture the remainder batch
+        if splits:
+            flush(splits, ids)
+        while batches:
+            n_added, n_skipped = batches.popleft().result()
+            added += n_added
+            skipped += n_skipped
+
+    elapsed = time.perf_counter() - start
     print("num of files added: ", count)
+    print(f"{count/elapsed:.1f} docs/sec, {num_chunks/elapsed:.1f} chunks/sec ({elapsed:.1f}s)")
+    if added:
+        _collection_changed(db, db_directory, added_ids)
+    _print_stats(added, skipped, emb_func)
+
+    return {"files": count, "chunks": num_chunks, "added": added, "skipped": skipped, "seconds": elapsed}
+
+
+
+def _file_hash(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def load_manifest(manifest_path):
+    """manifest of ingested files: {path: {"mtime", "size", "hash", "ids"}}"""
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, "r") as f:
+        return json.load(f)
+
+
+def save_manifest(manifest, manifest_path):
+    os.makedirs(os.path.dirname(manifest_path) or ".", exist_ok=True)
+    tmp_path = f"{manifest_path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, manifest_path) # dont leave a half written manifest if interrupted
+
+
+def sync_directory_md(directory_path, db_directory, emb_func, cache_path=embedding_cache_path, manifest_path=None):
+    """incremental version of create_collection_from_directory_md
+
+        -keeps a manifest (path, mtime, size, hash, chunk ids) of every ingested file
+        -only new or changed files are split and embedded
+        -chunks of changed or removed files are deleted from the collection (and the near-duplicate copies of those
+            chunks restored from their own files)
+        -manifest_path: defaults to manifest.json in db_directory (shared by all directories in the db)
+    """
+    emb_func = _with_cache(emb_func, cache_path)
+    manifest_path = manifest_path or os.path.join(db_directory, "manifest.json")
+    manifest = load_manifest(manifest_path)
+    db = open_collection(db_directory, emb_func)
+    skip_ids = duplicate_ids(db_directory)
+
+    directory_path = os.path.abspath(directory_path)
+    paths = sorted(glob.glob(os.path.join(directory_path, "**", "*.md"), recursive=True))
+
+    new, changed, unchanged = 0, 0, 0
+    added, deleted = 0, 0
+    added_ids, deleted_ids = [], []
+    deleted_chunks = {} # id: metadata of the chunks deleted from the collection
+    for path in paths:
+        stat = os.stat(path)
+        entry = manifest.get(path)
+        if entry and entry["mtime"] == stat.st_mtime and entry["size"] == stat.st_size:
+            unchanged += 1
+            continue
+
+        file_hash = _file_hash(path)
+        if entry and entry["hash"] == file_hash: # touched but not modified
+            entry.update(mtime=stat.st_mtime, size=stat.st_size)
+            unchanged += 1
+            continue
+
+        if entry:
+            _delete_chunks(db, entry["ids"], deleted_chunks)
+            deleted += len(entry["ids"])
+            deleted_ids.extend(entry["ids"])
+            changed += 1
+        else:
+            new += 1
+
+        chunks, ids = split_md_document(TextLoader(path).load()[0])
+        n_added, _ = upsert_chunks(chunks, ids, db, skip_ids, added_ids)
+        added += n_added
+        manifest[path] = {"mtime": stat.st_mtime, "size": stat.st_size, "hash": file_hash, "ids": list(dict.fromkeys(ids))}
+        if (new + changed)%100 == 0: # save progress every 100 ingested files
+            save_manifest(manifest, manifest_path)
+
+    # files that were ingested from this directory but no longer exist
+    found = set(paths)
+    removed = [p for p in manifest if p.startswith(directory_path + os.sep) and p not in found]
+    for path in removed:
+        _delete_chunks(db, manifest[path]["ids"], deleted_chunks)
+        deleted += len(manifest[path]["ids"])
+        deleted_ids.extend(manifest[path]["ids"])
+        del manifest[path]
+
+    save_manifest(manifest, manifest_path)
+    # deleted chunks that were not added back (a changed file keeps the ids of its unchanged chunks)
+    gone = set(deleted_ids).difference(*(entry["ids"] for entry in manifest.values()))
+    if gone:
+        added += _restore_duplicates(db, db_directory, gone, manifest, added_ids)
+
+    print(f"files: {new} new, {changed} changed, {len(removed)} removed, {unchanged} unchanged")
+    if added or deleted:
+        _collection_changed(db, db_directory, added_ids, gone, deleted_chunks)
+    print(f"chunks: {added} added, {deleted} deleted")
+    if isinstance(emb_func, CachedEmbeddings):
+        print("embedding cache: ", emb_func.stats())
 
 
 
 if __name__ == "__main__":
-    create_collection_from_directory_md(
+    sync_directory_md(
         directory_path = f"{path_to_resources}/health_CA",
         db_directory = f"{path_to_resources}/db_main", 
         emb_func = hf_embed
     )
 
     
-    create_collection_from_directory_md(
+    sync_directory_md(
         directory_path = "/Users/a_wei/Downloads/programming/llm/OLD_ED_Counseling_Generator/resources/caringforkids",
         db_directory = f"{path_to_resources}/db_main", 
         emb_func = hf_embed
     )
 
-    create_collection_from_directory_md(
+    sync_directory_md(
         directory_path = "/Users/a_wei/Downloads/programming/llm/OLD_ED_Counseling_Generator/resources/cps_statements/",
         db_directory = f"{path_to_resources}/db_main", 
         emb_func = hf_embed
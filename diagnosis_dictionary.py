@@ -0,0 +1,246 @@
+"""Local diagnosis extraction: a dictionary of the diagnosis names in the corpus matched with an Aho-Corasick automaton
+- names come from the titles of the corpus (# Title metadata of database_helper.split_md_document), without their
+    parentheses, plus the abbreviation in the parentheses and the "also known as" / "also called" synonyms of the
+    chunks of the title (up to the first comma or verb, noun phrases only)
+- single word names and synonyms whose words are all mentioned by many titles are generic (fever, pain, respiratory
+    infection) and left out
+- all the names are matched in one pass over the assessment (word boundaries, longest match first); matches in a
+    negated context (no, without, denies, ...) are ignored
+- confident when 1 to max_diagnoses titles match unambiguously and the assessment has no differential (vs, r/o, ?);
+    otherwise the llm extracts the diagnoses (main.extract_diagnoses_step)
+- built at ingestion (database_helper) and saved in db_directory/diagnoses.json; the names and words of every title
+    are kept in db_directory/diagnosis_titles.json so a sync only reads the chunks of the titles it changed
+
+build from the repo root: python diagnosis_dictionary.py [--db-dir ./resources/db_wiki]
+"""
+
+import re
+import json
+import argparse
+from collections import defaultdict, deque
+from response_cache import normalize_diagnosis
+from multi_diagnosis import max_diagnoses
+
+title_key = "Title" # metadata of the # header (database_helper.headers_to_split_on)
+generic_title_share = 0.05 # single word names mentioned by more than this share of the titles are generic
+min_generic_titles = 20 # ... and by at least this many titles (small corpora)
+negation_window = 4 # words before a match where a negation cue applies
+
+negation_cues = {"no", "not", "without", "denies", "denied", "negative", "absent", "unlikely", "excluded"}
+_differential = re.compile(r"\?|\b(vs|versus|r/o|rule out|ruled out|ddx|differential)\b", re.IGNORECASE)
+_synonyms = re.compile(r"\balso (?:known as|called|referred to as) ([^.;:,()]+)", re.IGNORECASE)
+_verbs = {"is", "are", "was", "were", "be", "been", "has", "have", "had", "can", "may", "will", "which", "that", "who"}
+_articles = {"a", "an", "the"}
+_function_words = _verbs | _articles | {"it", "its", "this", "these", "their", "of", "to", "in", "on", "for", "with", "by", "and", "or"}
+_parentheses = re.compile(r"\s*\(([^)]*)\)")
+_clauses = re.compile(r"[.;:,()\[\]\n]")
+
+
+class AhoCorasick:
+    """multi-pattern string matcher: every occurrence of every pattern in one pass over the text"""
+    def __init__(self, patterns):
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [[]]
+        for pattern in patterns:
+            state = 0
+            for char in pattern:
+                if char not in self._goto[state]:
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append([])
+                    self._goto[state][char] = len(self._goto) - 1
+                state = self._goto[state][char]
+            self._out[state].append(pattern)
+
+        queue = deque(self._goto[0].values()) # breadth first: the fail state of a node is set before its children
+        while queue:
+            state = queue.popleft()
+            for char, child in self._goto[state].items():
+                queue.append(child)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(char, 0)
+                self._out[child] = self._out[child] + self._out[self._fail[child]]
+
+    def iter(self, text):
+        """(start, end, pattern) of every occurrence"""
+        state = 0
+        for i, char in enumerate(text):
+            while state and char not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(char, 0)
+            for pattern in self._out[state]:
+                yield i + 1 - len(pattern), i + 1, pattern
+
+
+def title_names(title):
+    """names of a title: without its parentheses, and the abbreviation in them (e.g. COPD)"""
+    names = {normalize_diagnosis(_parentheses.sub("", title))}
+    for inside in _parentheses.findall(title):
+        if re.fullmatch(r"[A-Z][A-Za-z0-9-]{1,7}", inside.strip()):
+            names.add(normalize_diagnosis(inside))
+    return {name for name in names if name}
+
+
+def _noun_phrase(name):
+    """the name without a leading article if it looks like a noun phrase (not "is a respiratory infection"), else None"""
+    words = name.split()
+    while words and words[0] in _articles:
+        words = words[1:]
+    if not words or len(words) > 5 or words[0] in _function_words or words[-1] in _function_words or _verbs.intersection(words):
+        return None
+    return " ".join(words)
+
+
+def synonym_names(text):
+    """names after 'also known as' / 'also called' in a chunk ("X, also known as Y or Z, is ..."), up to the first
+    comma or verb"""
+    names = set()
+    for match in _synonyms.findall(text):
+        words = normalize_diagnosis(match).split()
+        end = next((i for i, word in enumerate(words) if word in _verbs), len(words))
+        for name in re.split(r"\bor\b|\band\b", " ".join(words[:end])):
+            name = _noun_phrase(name)
+            if name:
+                names.add(name)
+    return names
+
+
+def collection_chunks(db, batch_size=5000, where=None):
+    """(text, metadata) of the chunks of a chroma vector store (only the ones matching the where filter)"""
+    offset = 0
+    while True:
+        batch = db._collection.get(where=where, offset=offset, limit=batch_size, include=["documents", "metadatas"])
+        yield from zip(batch["documents"], batch["metadatas"])
+        if len(batch["ids"]) < batch_size:
+            return
+        offset += batch_size
+
+
+def save_title_entries(entries, path):
+    with open(path, "w") as f:
+        json.dump({title: {key: sorted(values) for key, values in entry.items()} for title, entry in entries.items()}, f)
+
+
+def load_title_entries(path):
+    with open(path, "r") as f:
+        return {title: {key: set(values) for key, values in entry.items()} for title, entry in json.load(f).items()}
+
+
+class DiagnosisMatcher:
+    """dictionary of diagnosis names -> corpus titles; extract(assessment) finds the titles in the text
+
+        -names: dict of normalized name: list of titles
+    """
+    def __init__(self, names):
+        self.names = names
+        self._automaton = AhoCorasick(f" {name} " for name in names) # spaces: whole words only
+
+    def __len__(self):
+        return len(self.names)
+
+    @staticmethod
+    def title_entries(chunks):
+        """names (of the title and synonyms) and normalized words of the chunks of every title, from (text, metadata)
+        of chunks: {title: {"names": set, "words": set}}"""
+        entries = defaultdict(lambda: {"names": set(), "words": set()})
+        for text, metadata in chunks:
+            title = (metadata or {}).get(title_key)
+            if not title:
+                continue
+            entries[title]["names"].update(title_names(title) | synonym_names(text))
+            entries[title]["words"].update(normalize_diagnosis(text).split())
+        return dict(entries)
+
+    @classmethod
+    def from_titles(cls, entries):
+        """from the title_entries of the corpus"""
+        names = defaultdict(set)
+        of_titles = set() # multi word names of titles are kept, even if common
+        titles_by_word = defaultdict(set) # word: titles mentioning it
+        for title, entry in entries.items():
+            of_titles.update(title_names(title))
+            for name in entry["names"]:
+                names[name].add(title)
+            for word in entry["words"]:
+                titles_by_word[word].add(title)
+
+        def mentions(name):
+            """num of titles mentioning all the words of name"""
+            word_titles = sorted((titles_by_word[word] for word in name.split()), key=len)
+            return len(set.intersection(*word_titles))
+
+        generic = max(min_generic_titles, generic_title_share * len(entries))
+        return cls({
+            name: sorted(titles) for name, titles in names.items()
+            if (" " in name and name in of_titles) or mentions(name) <= generic
+        })
+
+    @classmethod
+    def build(cls, chunks):
+        """from (text, metadata) of the chunks of the corpus"""
+        return cls.from_titles(cls.title_entries(chunks))
+
+    @classmethod
+    def from_collection(cls, db, batch_size=5000):
+        return cls.build(collection_chunks(db, batch_size))
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump({"names": self.names}, f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "r") as f:
+            return cls(json.load(f)["names"])
+
+    def matches(self, text):
+        """non negated, non overlapping (longest first) matches: list of (position, name, titles)"""
+        found = []
+        offset = 0
+        for clause in _clauses.split(text):
+            padded = f" {normalize_diagnosis(clause)} "
+            spans = sorted(self._automaton.iter(padded), key=lambda m: (-(m[1] - m[0]), m[0]))
+            taken = []
+            for start, end, pattern in spans:
+                if any(start < e - 1 and s < end - 1 for s, e in taken): # overlap (the spaces are shared)
+                    continue
+                taken.append((start, end))
+                before = padded[:start].split()[-negation_window:]
+                if not negation_cues.intersection(before):
+                    found.append((offset + start, pattern.strip(), self.names[pattern.strip()]))
+            offset += len(clause) + 1
+        return sorted(found)
+
+    def extract(self, assessment):
+        """{"diagnoses": titles in order of appearance, "confident": bool, "reason": why not confident}"""
+        titles, ambiguous = [], False
+        for _, name, name_titles in self.matches(assessment):
+            ambiguous |= len(name_titles) > 1
+            for title in name_titles:
+                if title not in titles:
+                    titles.append(title)
+
+        reason = None
+        if not titles:
+            reason = "no match"
+        elif ambiguous:
+            reason = "name of several titles"
+        elif len(titles) > max_diagnoses:
+            reason = "too many matches"
+        elif _differential.search(assessment):
+            reason = "differential diagnosis"
+        return {"diagnoses": titles, "confident": reason is None, "reason": reason}
+
+
+if __name__ == "__main__":
+    from _global import path_to_resources
+    from database_helper import open_collection, build_diagnosis_dictionary
+
+    args = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    args.add_argument("--db-dir", default=f"{path_to_resources}/db_wiki")
+    args = args.parse_args()
+
+    build_diagnosis_dictionary(open_collection(args.db_dir, None), args.db_dir)
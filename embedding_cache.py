@@ -0,0 +1,78 @@
+"""On-disk embedding cache
+- sqlite table keyed by (model name, sha256 of the text)
+- wraps an embedding function (e.g. hf_embed) so only unseen texts are embedded
+- keeps hit/miss counts to see how much work a rebuild did
+"""
+
+import hashlib
+import sqlite3
+import threading
+from array import array
+from langchain_core.embeddings import Embeddings
+
+
+def content_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class CachedEmbeddings(Embeddings):
+    """embedding function that looks up embed_documents results in a sqlite cache before embedding
+
+        -emb_func: the embedding function doing the actual work
+        -path: sqlite file for the cache
+        -model_name: part of the key so different models never share vectors
+    """
+    def __init__(self, emb_func, path, model_name=None):
+        self.emb_func = emb_func
+        self.model_name = model_name or getattr(emb_func, "model_name", type(emb_func).__name__)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (model TEXT, hash TEXT, vector BLOB, PRIMARY KEY (model, hash))"
+        )
+        self._conn.commit()
+
+    def _lookup(self, hashes):
+        found = {}
+        with self._lock:
+            for i in range(0, len(hashes), 500): # stay below sqlite's max number of variables
+                batch = hashes[i:i+500]
+                rows = self._conn.execute(
+                    f"SELECT hash, vector FROM embeddings WHERE model = ? AND hash IN ({','.join('?'*len(batch))})",
+                    [self.model_name, *batch],
+                )
+                for h, blob in rows:
+                    found[h] = array("f", blob).tolist()
+        return found
+
+    def _store(self, hashes, vectors):
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, hash, vector) VALUES (?, ?, ?)",
+                [(self.model_name, h, array("f", v).tobytes()) for h, v in zip(hashes, vectors)],
+            )
+            self._conn.commit()
+
+    def embed_documents(self, texts):
+        hashes = [content_hash(text) for text in texts]
+        found = self._lookup(list(set(hashes)))
+
+        # embed each missing text once, even if it is repeated in texts
+        missing = {h: text for h, text in zip(hashes, texts) if h not in found}
+        if missing:
+            vectors = self.emb_func.embed_documents(list(missing.values()))
+            self._store(list(missing), vectors)
+            found.update(zip(missing, vectors))
+
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+
+        return [found[h] for h in hashes]
+
+    def embed_query(self, text):
+        return self.emb_func.embed_query(text)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
@@ -0,0 +1,106 @@
+"""Fake models for running the pipeline offline
+- no OpenAI/Ollama/HuggingFace calls, deterministic outputs
+- records the timing of every call so concurrency can be checked
+"""
+
+import re
+import time
+import zlib
+import typing
+import functools
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.pydantic_v1 import BaseModel, Field
+from langchain_core.runnables import RunnableLambda
+
+
+def fake_structured_output(schema, text):
+    """builds an instance of the pydantic schema with every field filled in from text
+
+        -a list of strings gets one item per line of text (e.g. multi_diagnosis.Diagnoses)
+    """
+    values = {}
+    for name, field in schema.__fields__.items():
+        if isinstance(field.type_, type) and issubclass(field.type_, BaseModel):
+            value = fake_structured_output(field.type_, text)
+        elif field.type_ is int:
+            value = 0
+        else:
+            value = text
+        if typing.get_origin(field.outer_type_) is not list:
+            values[name] = value
+        elif field.type_ is str:
+            values[name] = [line for line in text.splitlines() if line.strip()]
+        else:
+            values[name] = [value]
+
+    return schema(**values)
+
+
+class FakeChatModel(BaseChatModel):
+    """chat model that always answers with response after sleeping latency seconds
+
+        -calls: list of (start, end) time.monotonic() of every call
+    """
+    response: str = "fake response"
+    latency: float = 0.0
+    calls: list = Field(default_factory=list)
+
+    @property
+    def _llm_type(self):
+        return "fake-chat"
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        start = time.monotonic()
+        time.sleep(self.latency)
+        self.calls.append((start, time.monotonic()))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self.response))])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        """streams the response word by word; latency is spread over the words"""
+        start = time.monotonic()
+        words = self.response.split(" ")
+        for i, word in enumerate(words):
+            time.sleep(self.latency / len(words))
+            yield ChatGenerationChunk(message=AIMessageChunk(content=word if i == 0 else " " + word))
+        self.calls.append((start, time.monotonic()))
+
+    def with_structured_output(self, schema, **kwargs):
+        return self | RunnableLambda(lambda message: fake_structured_output(schema, message.content))
+
+
+@functools.lru_cache(maxsize=1 << 20)
+def _hash_token(token, dim):
+    h = zlib.crc32(token.encode()) # stable across processes, unlike hash()
+    return h % dim, 1.0 if h & (1 << 31) else -1.0
+
+
+class FakeEmbeddings(Embeddings):
+    """hashing trick embedder: texts that share words get similar vectors, no model download
+
+        -dim: size of the vectors (BAAI/llm-embedder is 768)
+        -latency: seconds slept per call (not per text) to mimic a model forward pass
+    """
+    def __init__(self, dim=768, latency=0.0):
+        self.dim = dim
+        self.latency = latency
+        self.query_instruction = "" # like HuggingFaceBgeEmbeddings, used by BatchRetriever
+        self.calls = 0
+
+    def _embed(self, text):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for token in re.findall(r"\w+", text.lower()):
+            index, sign = _hash_token(token, self.dim)
+            vector[index] += sign
+        return (vector / (np.linalg.norm(vector) or 1.0)).tolist()
+
+    def embed_documents(self, texts):
+        self.calls += 1
+        time.sleep(self.latency)
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
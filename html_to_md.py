@@ -0,0 +1,141 @@
+"""Fast html to md conversion for wikipedia pages
+- one lxml parse per page, sections are dropped and md is written in the same walk over the tree
+- output follows the html2text settings used in preprocess_wiki (no links, emphasis or images, no line wrapping,
+    special characters escaped, tables as md tables)
+- the converter keeps no state between pages, so one instance can be shared by threads
+"""
+
+import re
+
+try:
+    import lxml.html
+except ImportError: # preprocess_wiki falls back to html2text
+    lxml = None
+
+
+_whitespace = re.compile(r"\s+")
+# the escapes of html2text's escape_snob: a backslash before a special character, the special characters, and list
+# markers at the start of a line
+_escape_backslash = re.compile(r"(\\)(?=[\\`*_{}\[\]()#+\-.!])")
+_escape_chars = re.compile(r"([`*_{}\[\]()#!])")
+_escape_line_start = re.compile(r"^(\s*)(-(?=[\s-])|\+(?=\s)|\d+\.(?=\s))", flags=re.MULTILINE)
+
+_headings = {"h1": 1, "h2": 2, "h3": 3, "h4": 4, "h5": 5, "h6": 6}
+_skip_tags = {"script", "style", "img", "noscript"}
+_block_tags = {"p", "div", "ul", "ol", "table", "dl", "blockquote", "pre", "section", *_headings}
+
+
+class MarkdownConverter:
+    """converts page html to md
+
+        -skip_sections: heading titles whose section (until the next heading of the same or higher level) is dropped
+        -escape: escape md special characters like html2text's escape_snob
+    """
+    available = lxml is not None
+
+    def __init__(self, skip_sections=(), escape=True):
+        self.skip_sections = set(skip_sections)
+        self.escape = escape
+
+    def convert(self, html):
+        if not html or not html.strip():
+            return ""
+        root = lxml.html.fragment_fromstring(html, create_parent="div")
+        blocks = []
+        self._blocks(root, blocks, {"skip_level": None})
+
+        return "\n\n".join(block for block in blocks if block.strip()) + "\n"
+
+    def _text(self, text):
+        text = _whitespace.sub(" ", text)
+        return _escape_chars.sub(r"\\\1", _escape_backslash.sub(r"\\\1", text)) if self.escape else text
+
+    def _inline(self, el, skip_tags=_skip_tags):
+        """text of an element and its children on one line (br gives a line break)"""
+        parts = [self._text(el.text or "")]
+        for child in el:
+            if not isinstance(child.tag, str) or child.tag in skip_tags:
+                pass
+            elif child.tag == "br":
+                parts.append("\n")
+            else:
+                parts.append(self._inline(child))
+            parts.append(self._text(child.tail or ""))
+
+        return "".join(parts)
+
+    def _paragraph(self, text):
+        text = "\n".join(line.strip() for line in text.strip().split("\n"))
+        return _escape_line_start.sub(r"\1\\\2", text) if self.escape else text
+
+    def _blocks(self, el, out, state, indent=""):
+        """appends the md blocks of the children of el to out"""
+        inline = [self._text(el.text or "")] # text and inline children are gathered until the next block
+
+        def flush():
+            text = self._paragraph("".join(inline))
+            if text:
+                out.append(indent + text.replace("\n", "\n" + indent))
+            inline.clear()
+
+        for child in el:
+            tag = child.tag if isinstance(child.tag, str) else None
+            level = _headings.get(tag)
+            if level:
+                title = _whitespace.sub(" ", child.text_content()).strip()
+                if state["skip_level"] and level <= state["skip_level"]:
+                    state["skip_level"] = None
+                if title in self.skip_sections:
+                    state["skip_level"] = level
+
+            if state["skip_level"]:
+                continue
+
+            if tag is None or tag in _skip_tags:
+                pass
+            elif tag not in _block_tags:
+                inline.append(self._inline(child) if tag != "br" else "\n")
+            else:
+                flush()
+                if level:
+                    out.append("#"*level + " " + self._paragraph(self._inline(child)).replace("\n", " "))
+                elif tag in ("ul", "ol"):
+                    out.append("\n".join(self._list(child, indent + "  ")))
+                elif tag == "table":
+                    out.append(self._table(child))
+                elif tag == "blockquote":
+                    quote = []
+                    self._blocks(child, quote, state)
+                    out.append("\n".join("> " + line for block in quote for line in block.split("\n")))
+                elif tag == "pre":
+                    out.append("\n".join(indent + "    " + line for line in child.text_content().split("\n")))
+                elif any(isinstance(c.tag, str) and c.tag in _block_tags for c in child):
+                    self._blocks(child, out, state, indent)
+                else:
+                    inline.append(self._inline(child))
+                    flush()
+            inline.append(self._text(child.tail or ""))
+
+        flush()
+
+    def _list(self, el, indent):
+        lines = []
+        for i, item in enumerate(el.iterchildren("li"), start=1):
+            bullet = f"{i}. " if el.tag == "ol" else "* "
+            nested = [sub for sub in item if isinstance(sub.tag, str) and sub.tag in ("ul", "ol")]
+            text = self._paragraph(self._inline(item, _skip_tags | {"ul", "ol"})).replace("\n", " ")
+            lines.append(indent + bullet + text)
+            for sub in nested:
+                lines.extend(self._list(sub, indent + "  "))
+
+        return lines
+
+    def _table(self, el):
+        rows = []
+        for tr in el.iter("tr"):
+            cells = [self._paragraph(self._inline(cell)).replace("\n", " ") for cell in tr if cell.tag in ("td", "th")]
+            rows.append(" | ".join(cells))
+            if len(rows) == 1:
+                rows.append("---|" * (len(cells) - 1) + "---")
+
+        return "\n".join(rows)
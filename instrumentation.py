@@ -0,0 +1,208 @@
+"""Local, in-process instrumentation of the RAG pipeline (no external tracing service)
+- stage(name): times a stage of a request; chunk counts, cache hits etc. can be added to it
+- TokenUsageHandler: langchain callback that adds prompt/completion tokens of llm calls to the current stage
+- metrics are kept as prometheus style counters/histograms (metrics.to_prometheus())
+- every stage is written as one json line to the trace file (RAG_TRACE_FILE env variable or configure())
+- report: python -m instrumentation traces.jsonl  -> count, p50, p95, tokens per stage
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import argparse
+import threading
+import contextlib
+import contextvars
+from collections import defaultdict
+from langchain_core.callbacks import BaseCallbackHandler
+from rate_limiter import estimate_tokens
+
+
+latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+_trace_id = contextvars.ContextVar("trace_id", default=None)
+_current_stage = contextvars.ContextVar("current_stage", default=None)
+
+
+class Metrics:
+    """counters and latency histograms labelled by stage"""
+    def __init__(self, buckets=latency_buckets):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self.counters = defaultdict(float) # (name, stage, ((label, value), ...)): value
+        self.histograms = {} # stage: [bucket counts..., sum, count]
+
+    def inc(self, name, stage, value=1, **labels):
+        """labels: more prometheus labels of the counter besides the stage (e.g. section=...)"""
+        with self._lock:
+            self.counters[(name, stage, tuple(sorted(labels.items())))] += value
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            hist = self.histograms.setdefault(stage, [0] * len(self.buckets) + [0.0, 0])
+            for i, le in enumerate(self.buckets):
+                if seconds <= le:
+                    hist[i] += 1
+            hist[-2] += seconds
+            hist[-1] += 1
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def to_prometheus(self, prefix="rag"):
+        """metrics in the prometheus text exposition format"""
+        with self._lock:
+            lines = [f"# TYPE {prefix}_stage_seconds histogram"]
+            for stage, hist in sorted(self.histograms.items()):
+                for le, count in zip(self.buckets, hist):
+                    lines.append(f'{prefix}_stage_seconds_bucket{{stage="{stage}",le="{le}"}} {count}')
+                lines.append(f'{prefix}_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {hist[-1]}')
+                lines.append(f'{prefix}_stage_seconds_sum{{stage="{stage}"}} {hist[-2]}')
+                lines.append(f'{prefix}_stage_seconds_count{{stage="{stage}"}} {hist[-1]}')
+
+            for name in sorted({name for name, _, _ in self.counters}):
+                lines.append(f"# TYPE {prefix}_{name}_total counter")
+                for (n, stage, labels), value in sorted(self.counters.items()):
+                    if n == name:
+                        labels = "".join(f',{label}="{v}"' for label, v in labels)
+                        lines.append(f'{prefix}_{name}_total{{stage="{stage}"{labels}}} {value:g}')
+
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+_trace = {"path": os.getenv("RAG_TRACE_FILE"), "lock": threading.Lock()}
+
+
+def configure(trace_path=None):
+    """set (or with None, turn off) the json lines trace file"""
+    _trace["path"] = trace_path
+
+
+def _write_trace(record):
+    if not _trace["path"]:
+        return
+    with _trace["lock"]:
+        with open(_trace["path"], "a") as f:
+            f.write(json.dumps(record, default=str) + "\n")
+
+
+@contextlib.contextmanager
+def trace(trace_id=None):
+    """groups the stages of one request under one trace id"""
+    token = _trace_id.set(trace_id or uuid.uuid4().hex)
+    try:
+        yield _trace_id.get()
+    finally:
+        _trace_id.reset(token)
+
+
+@contextlib.contextmanager
+def stage(name, **fields):
+    """times a stage; yields a dict where counts (chunks, cache_hit, ...) can be added
+
+        -numeric fields are also added to the counters of the stage
+        -llm token counts of calls made inside the stage are added by TokenUsageHandler
+    """
+    record = {"stage": name, **fields}
+    token = _current_stage.set(record)
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        seconds = time.perf_counter() - start
+        _current_stage.reset(token)
+        metrics.observe(name, seconds)
+        for key, value in record.items():
+            if key == "cache_hit":
+                metrics.inc("cache_hits" if value else "cache_misses", name)
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                metrics.inc(key, name, value)
+        _write_trace({"trace_id": _trace_id.get(), "time": time.time(), "seconds": seconds, **record})
+
+
+def add(**fields):
+    """adds counts to the current stage (e.g. from code that does not know which stage it is in)"""
+    record = _current_stage.get()
+    if record is not None:
+        for key, value in fields.items():
+            record[key] = record.get(key, 0) + value if isinstance(value, (int, float)) and not isinstance(value, bool) else value
+
+
+class TokenUsageHandler(BaseCallbackHandler):
+    """adds prompt/completion tokens of every llm call to the current stage
+
+        -uses the token usage reported by the api, or an estimate from the text when there is none
+    """
+    def __init__(self):
+        self._prompt_estimates = {}
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self._prompt_estimates[run_id] = sum(estimate_tokens(m.content) for batch in messages for m in batch)
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        self._prompt_estimates[run_id] = sum(estimate_tokens(p) for p in prompts)
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        estimate = self._prompt_estimates.pop(run_id, 0)
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        if not usage:
+            text = "".join(g.text for gens in response.generations for g in gens)
+            usage = {"prompt_tokens": estimate, "completion_tokens": estimate_tokens(text) if text else 0}
+        add(prompt_tokens=usage.get("prompt_tokens", 0), completion_tokens=usage.get("completion_tokens", 0))
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._prompt_estimates.pop(run_id, None)
+
+
+token_usage_handler = TokenUsageHandler()
+
+
+def _percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def summarize(trace_path):
+    """stage: {count, p50, p95, total seconds, tokens, chunks, cache hits} from a trace file"""
+    stages = defaultdict(list)
+    totals = defaultdict(lambda: defaultdict(float))
+    with open(trace_path, "r") as f:
+        for line in f:
+            record = json.loads(line)
+            stages[record["stage"]].append(record["seconds"])
+            for key in ("prompt_tokens", "completion_tokens", "chunks"):
+                totals[record["stage"]][key] += record.get(key, 0)
+            if "cache_hit" in record:
+                totals[record["stage"]]["cache_hits"] += bool(record["cache_hit"])
+
+    summary = {}
+    for name, seconds in sorted(stages.items(), key=lambda item: -sum(item[1])):
+        summary[name] = {
+            "count": len(seconds),
+            "p50": _percentile(seconds, 0.5),
+            "p95": _percentile(seconds, 0.95),
+            "total": sum(seconds),
+            **{key: totals[name][key] for key in ("prompt_tokens", "completion_tokens", "chunks", "cache_hits")},
+        }
+    return summary
+
+
+def report(trace_path, file=sys.stdout):
+    """p50/p95 latency and token counts per stage from a trace file"""
+    print(f"{'stage':<24}{'count':>7}{'p50 (s)':>10}{'p95 (s)':>10}{'total (s)':>11}{'prompt tok':>12}{'compl tok':>11}{'chunks':>8}{'cache hits':>12}", file=file)
+    for name, t in summarize(trace_path).items():
+        print(f"{name:<24}{t['count']:>7}{t['p50']:>10.3f}{t['p95']:>10.3f}{t['total']:>11.2f}"
+              f"{t['prompt_tokens']:>12.0f}{t['completion_tokens']:>11.0f}{t['chunks']:>8.0f}{t['cache_hits']:>12.0f}", file=file)
+
+
+if __name__ == "__main__":
+    args = argparse.ArgumentParser(description="per stage latency report from a RAG trace file")
+    args.add_argument("trace_file", nargs="?", default=os.getenv("RAG_TRACE_FILE", "traces.jsonl"))
+    args = args.parse_args()
+    report(args.trace_file)
@@ -0,0 +1,205 @@
+"""BM25 inverted index over the chunks of main_collection (lexical half of retrieval.HybridRetriever)
+- built from the collection at the first ingestion (database_helper) and saved in db_directory/bm25; later syncs
+    update it: the rows of the deleted chunks are dropped, only the added chunks are tokenized and the weights of all
+    the postings are recomputed from the stored term frequencies and doc lengths (idf and average length change)
+- postings are stored as flat arrays (csr layout): term -> doc rows and their precomputed bm25 weights,
+    so a query is one vectorized add per query term + one argpartition
+- tokens: lower case words without stop words
+- search(..., labels=[...]) only returns chunks of those section partitions (section_partitions.py); the mask of
+    each set of partitions is computed on its first search and kept
+"""
+
+import os
+import re
+import json
+from collections import Counter
+import numpy as np
+from langchain_core.documents import Document
+from section_partitions import general
+
+_token = re.compile(r"\w+")
+stop_words = set("""
+a an and are as at be by for from has have in is it its of on or that the their this to was were will with
+what which who how when where than then there these those can may also other such into not no do does
+""".split())
+
+
+def tokenize(text):
+    return [token for token in _token.findall(text.lower()) if token not in stop_words]
+
+
+class BM25Index:
+    """inverted index of chunks; search(query, k, labels=None) -> list of Documents, best first
+
+        -k1, b: bm25 parameters
+    """
+    def __init__(self, texts, metadatas, terms, offsets, docs, weights, k1=1.2, b=0.75, ids=None, tfs=None, lengths=None):
+        self.texts = texts
+        self.metadatas = metadatas
+        self.terms = {term: i for i, term in enumerate(terms)}
+        self.offsets = offsets
+        self.docs = docs
+        self.weights = weights
+        self.k1 = k1
+        self.b = b
+        self.ids = ids # chunk id, term frequency of every posting and length of every doc: for update()
+        self.tfs = tfs
+        self.lengths = lengths
+        self._labels = None
+        self._excluded = {} # frozenset of labels: mask of the chunks outside those partitions
+
+    def __len__(self):
+        return len(self.texts)
+
+    @staticmethod
+    def _tokenize(texts, first_row=0):
+        """(term, doc row, term frequency) of the postings of texts and their lengths"""
+        terms, rows, tfs = [], [], []
+        lengths = np.zeros(len(texts), dtype=np.float32)
+        for row, text in enumerate(texts):
+            counts = Counter(tokenize(text))
+            lengths[row] = sum(counts.values())
+            terms.extend(counts)
+            rows.extend([first_row + row] * len(counts))
+            tfs.extend(counts.values())
+        return terms, np.asarray(rows, dtype=np.int32), np.asarray(tfs, dtype=np.int32), lengths
+
+    @classmethod
+    def _from_postings(cls, texts, metadatas, ids, vocabulary, term_ids, rows, tfs, lengths, k1, b):
+        """index of the postings (term_ids: ids of vocabulary, term: id); terms without postings are left out"""
+        terms = sorted(vocabulary)
+        order = np.empty(len(vocabulary), dtype=np.int64)
+        order[[vocabulary[term] for term in terms]] = np.arange(len(terms))
+        term_ids = order[term_ids]
+        counts = np.bincount(term_ids, minlength=len(terms))
+        used = counts > 0
+        terms = [term for term, u in zip(terms, used) if u]
+        term_ids = (np.cumsum(used) - 1)[term_ids]
+        counts = counts[used]
+
+        postings = np.lexsort((rows, term_ids))
+        term_ids, rows, tfs = term_ids[postings], rows[postings], tfs[postings]
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(counts)
+
+        avg_length = float(lengths.mean()) if len(texts) else 0.0
+        idf = np.log(1 + (len(texts) - counts + 0.5) / (counts + 0.5))
+        weights = idf[term_ids] * tfs * (k1 + 1) / (tfs + k1 * (1 - b + b * lengths[rows] / avg_length))
+        return cls(texts, metadatas, terms, offsets, rows.astype(np.int32), weights.astype(np.float32), k1, b, ids, tfs, lengths)
+
+    @classmethod
+    def build(cls, texts, metadatas, k1=1.2, b=0.75, ids=None):
+        texts = list(texts)
+        terms, rows, tfs, lengths = cls._tokenize(texts)
+        vocabulary = {}
+        term_ids = np.asarray([vocabulary.setdefault(term, len(vocabulary)) for term in terms], dtype=np.int64)
+        return cls._from_postings(texts, list(metadatas), ids, vocabulary, term_ids, rows, tfs, lengths, k1, b)
+
+    def update(self, ids, texts, metadatas, deleted_ids=()):
+        """new index without the chunks of deleted_ids and with the chunks of ids (replaced if already in it)
+
+            -only texts are tokenized; the postings of the other chunks are kept
+        """
+        if self.ids is None or self.tfs is None:
+            raise ValueError("index saved without chunk ids and term frequencies, build it again")
+        drop = set(deleted_ids).union(ids)
+        keep = np.fromiter((chunk_id not in drop for chunk_id in self.ids), dtype=bool, count=len(self))
+        kept_postings = keep[self.docs]
+        rows = (np.cumsum(keep) - 1)[self.docs[kept_postings]]
+        term_ids = np.repeat(np.arange(len(self.terms)), np.diff(self.offsets))[kept_postings]
+
+        vocabulary = dict(self.terms)
+        terms, new_rows, new_tfs, new_lengths = self._tokenize(texts, int(keep.sum()))
+        new_term_ids = np.asarray([vocabulary.setdefault(term, len(vocabulary)) for term in terms], dtype=np.int64)
+        return self._from_postings(
+            [text for text, k in zip(self.texts, keep) if k] + list(texts),
+            [metadata for metadata, k in zip(self.metadatas, keep) if k] + list(metadatas),
+            [chunk_id for chunk_id, k in zip(self.ids, keep) if k] + list(ids),
+            vocabulary,
+            np.concatenate([term_ids, new_term_ids]),
+            np.concatenate([rows, new_rows]).astype(np.int32),
+            np.concatenate([self.tfs[kept_postings], new_tfs]),
+            np.concatenate([self.lengths[keep], new_lengths]),
+            self.k1, self.b,
+        )
+
+    @classmethod
+    def from_collection(cls, db, batch_size=5000, **kwargs):
+        """index of all the chunks of a chroma vector store"""
+        collection = db._collection
+        ids, texts, metadatas = [], [], []
+        for offset in range(0, collection.count(), batch_size):
+            batch = collection.get(offset=offset, limit=batch_size, include=["documents", "metadatas"])
+            ids.extend(batch["ids"])
+            texts.extend(batch["documents"])
+            metadatas.extend(metadata or {} for metadata in batch["metadatas"])
+        return cls.build(texts, metadatas, ids=ids, **kwargs)
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        terms = sorted(self.terms, key=self.terms.get)
+        arrays = {"terms": np.asarray(terms, dtype=str), "offsets": self.offsets, "docs": self.docs, "weights": self.weights}
+        if self.tfs is not None:
+            arrays.update(tfs=self.tfs, lengths=self.lengths)
+        np.savez(os.path.join(path, "index.npz"), **arrays)
+        with open(os.path.join(path, "docs.jsonl"), "w") as f:
+            for i, (text, metadata) in enumerate(zip(self.texts, self.metadatas)):
+                doc = {"text": text, "metadata": metadata}
+                if self.ids is not None:
+                    doc["id"] = self.ids[i]
+                f.write(json.dumps(doc) + "\n")
+        with open(os.path.join(path, "meta.json"), "w") as f:
+            json.dump({"count": len(self), "terms": len(terms), "k1": self.k1, "b": self.b}, f)
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, "meta.json"), "r") as f:
+            meta = json.load(f)
+        ids, texts, metadatas = [], [], []
+        with open(os.path.join(path, "docs.jsonl"), "r") as f:
+            for line in f:
+                doc = json.loads(line)
+                ids.append(doc.get("id"))
+                texts.append(doc["text"])
+                metadatas.append(doc["metadata"])
+        arrays = np.load(os.path.join(path, "index.npz"))
+        return cls(
+            texts, metadatas, arrays["terms"].tolist(), arrays["offsets"], arrays["docs"], arrays["weights"], meta["k1"], meta["b"],
+            ids if None not in ids else None, arrays["tfs"] if "tfs" in arrays else None, arrays["lengths"] if "lengths" in arrays else None,
+        )
+
+    def scores(self, query):
+        """bm25 score of every chunk for the query"""
+        scores = np.zeros(len(self), dtype=np.float32)
+        for term, count in Counter(tokenize(query)).items():
+            i = self.terms.get(term)
+            if i is not None: # a term occurs once per doc in its postings, so no np.add.at needed
+                start, end = self.offsets[i], self.offsets[i + 1]
+                scores[self.docs[start:end]] += count * self.weights[start:end]
+        return scores
+
+    def labels(self):
+        """section label of every chunk"""
+        if self._labels is None:
+            self._labels = np.asarray([metadata.get("section", general) for metadata in self.metadatas])
+        return self._labels
+
+    def excluded(self, labels):
+        """mask of the chunks outside the section partitions labels, computed once per set of partitions (the queries
+        only use the few sets of section_partitions.search_partitions)"""
+        key = frozenset(labels)
+        mask = self._excluded.get(key)
+        if mask is None:
+            mask = self._excluded[key] = ~np.isin(self.labels(), list(key))
+        return mask
+
+    def search(self, query, k=4, labels=None):
+        scores = self.scores(query)
+        if labels is not None:
+            scores[self.excluded(labels)] = 0
+        k = min(k, int(np.count_nonzero(scores)))
+        if not k:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [Document(page_content=self.texts[i], metadata=self.metadatas[i]) for i in top]
@@ -1,93 +1,439 @@
-"""main application"""
+"""main application
+- llm clients, db and retriever are created on first use (get_* singletons), warm_up() creates them up front
+- all the diagnoses of the assessment go in one handout; their retrieval and compression are done together
+    (multi_diagnosis.py)
+"""
 
-import gradio as gr
+import os
+import queue
+import threading
+import contextvars
 from operator import itemgetter
-from _global import path_to_resources, hf_embed
-from templates import discharge_instructions, discharge_instructions_2, queries_ddx, extract_diagnosis, compress_context
-from langchain_community.vectorstores import Chroma
-from langchain_openai import ChatOpenAI
-from langchain_community.llms import Ollama
+from _global import path_to_resources, embedding_model_name, hf_embed, singleton
+from templates import discharge_instructions, discharge_instructions_2, queries_ddx, extract_diagnoses, compress_context
+from retrieval import BatchRetriever, IndexRetriever, HybridRetriever
+from response_cache import SemanticCache
+from instrumentation import stage, trace, token_usage_handler
+from section_dedup import dedup_sections, group_query, render_docs, gather, drop_repeats, dedup_stats
+from context_budget import context_token_budget, count_tokens, fit_to_budget, cut_stats
+from multi_diagnosis import Diagnoses, clean_diagnoses, merge_diagnoses, diagnosis_queries, merge_section, no_diagnosis_message
 from langchain_core.prompts import ChatPromptTemplate, PromptTemplate
 from langchain_core.output_parsers.string import StrOutputParser
-from langchain_core.runnables import RunnablePassthrough, RunnableParallel
-from langchain.callbacks.tracers import LangChainTracer
+from langchain_core.runnables import RunnableLambda, RunnableGenerator
+
+
+db_directory = f"{path_to_resources}/db_wiki"
+index_directory = f"{path_to_resources}/index_wiki" # export of the collection: python vector_index.py
+snapshot_path = os.getenv("RAG_SNAPSHOT_PATH", f"{path_to_resources}/wiki.snapshot") # single file export: python snapshot.py export
+retriever_backend = os.getenv("RAG_RETRIEVER_BACKEND", "chroma") # chroma, exact, hnsw, float16, int8 or snapshot
+hybrid_search = os.getenv("RAG_HYBRID_SEARCH", "1") == "1" # fuse with bm25 (db_directory/bm25, built at ingestion)
+local_extraction = os.getenv("RAG_LOCAL_EXTRACTION", "1") == "1" # diagnosis dictionary before the llm (db_directory/diagnoses.json)
+semantic_cache = os.getenv("RAG_SEMANTIC_CACHE", "1") == "1" # context cache also matches near-duplicate diagnoses by embedding
+partitioned_search = os.getenv("RAG_PARTITIONED_SEARCH", "1") == "1" # section queries search their partitions only (db_directory/sections.json)
 
 
 # set up LLM
-llm_gpt = ChatOpenAI(model_name="gpt-3.5-turbo-1106", temperature=0)
-llm_llama = Ollama(model="llama2:13b", temperature=0)
+@singleton
+def get_llm_gpt():
+    from langchain_openai import ChatOpenAI
+    return ChatOpenAI(model_name="gpt-3.5-turbo-1106", temperature=0, callbacks=[token_usage_handler])
+
+
+@singleton
+def get_llm_llama():
+    from langchain_community.llms import Ollama
+    return Ollama(model="llama2:13b", temperature=0, callbacks=[token_usage_handler])
+
 
 # set up db
-db = Chroma(collection_name="main_collection", persist_directory=f"{path_to_resources}/db_wiki", embedding_function=hf_embed)
-retriever = db.as_retriever(
-                search_type = "similarity",
-                search_kwargs = {"k":4},
-            )
+@singleton
+def get_db():
+    from langchain_community.vectorstores import Chroma
+    return Chroma(collection_name="main_collection", persist_directory=db_directory, embedding_function=hf_embed)
+
+
+@singleton
+def get_snapshot():
+    """memory-mapped snapshot of the collection (snapshot.py), shared by all the workers through the page cache"""
+    from snapshot import SnapshotIndex
+    index = SnapshotIndex(snapshot_path)
+    _check_embedding(index.meta, snapshot_path)
+    return index
+
+
+def _check_embedding(meta, path):
+    """the vectors of an export were embedded by the model of the queries; model_name of the export is the model, with
+    the backend and precision when not torch (_global.embedding_name)"""
+    exported = meta.get("model_name")
+    if not exported:
+        return
+    if exported.split("+")[0] != embedding_model_name:
+        raise ValueError(f"{path} was embedded with {exported}, not {embedding_model_name}")
+    if exported != hf_embed.model_name: # same model, the vectors are close but not the same
+        print(f"warning: {path} was embedded with {exported}, the queries are embedded with {hf_embed.model_name}")
+
+
+def corpus_version():
+    """version of the chunks searched (keys the context cache)"""
+    if retriever_backend == "snapshot":
+        return get_snapshot().meta["corpus_version"]
+    from database_helper import get_corpus_version
+    return get_corpus_version(db_directory)
+
+
+def _get_dense_retriever():
+    if retriever_backend == "chroma":
+        return BatchRetriever(get_db(), hf_embed, k=4)
+    if retriever_backend == "snapshot":
+        return IndexRetriever(get_snapshot(), hf_embed, k=4)
+
+    from vector_index import open_index
+    from database_helper import get_corpus_version
+    index = open_index(index_directory, mode=retriever_backend)
+    _check_embedding(index.meta, index_directory)
+    if index.meta["corpus_version"] != get_corpus_version(db_directory):
+        print(f"warning: {index_directory} is older than the collection in {db_directory}, export it again with: python vector_index.py")
+    return IndexRetriever(index, hf_embed, k=4)
+
+
+@singleton
+def get_retriever():
+    """all six queries are embedded and searched in one batch; the other backends search the exported index instead of chroma
+
+        -with hybrid_search, dense results are fused with bm25 results (same k, better precision)
+        -the snapshot backend uses the bm25 index stored in the snapshot, never the one of db_directory (it may be of
+            another corpus version)
+    """
+    dense = _get_dense_retriever()
+    lexical_path = os.path.join(db_directory, "bm25")
+    if not hybrid_search:
+        return dense
+    if retriever_backend == "snapshot":
+        return HybridRetriever(dense, get_snapshot().lexical_index(), k=4)
+    if not os.path.exists(lexical_path):
+        print(f"no bm25 index in {db_directory} (built at ingestion), using dense retrieval only")
+        return dense
+
+    from lexical_index import BM25Index
+    return HybridRetriever(dense, BM25Index.load(lexical_path), k=4)
+
+
+@singleton
+def get_diagnosis_matcher():
+    """dictionary of the diagnosis names of the corpus (diagnosis_dictionary.py); None if off or not built"""
+    path = os.path.join(db_directory, "diagnoses.json")
+    if not local_extraction:
+        return None
+    if retriever_backend == "snapshot": # built from the chunks of the snapshot
+        return get_snapshot().diagnosis_matcher()
+    if not os.path.exists(path):
+        print(f"no diagnosis dictionary in {db_directory} (built at ingestion), diagnoses are extracted by the llm")
+        return None
+
+    from diagnosis_dictionary import DiagnosisMatcher
+    return DiagnosisMatcher.load(path)
+
+
+@singleton
+def get_context_cache():
+    """compressed contexts of diagnoses seen before; cleared when the collection changes"""
+    return SemanticCache(hf_embed if semantic_cache else None, threshold=0.9, version_func=corpus_version)
 
 # compress context
 prompt_compress = PromptTemplate.from_template(compress_context)
 compressor =  prompt_compress #| llm_llama | StrOutputParser()
 
 # set up prompts
-prompt_extract_diagnosis = PromptTemplate.from_template(extract_diagnosis)
+prompt_extract_diagnoses = PromptTemplate.from_template(extract_diagnoses)
 prompt_main = ChatPromptTemplate.from_messages([("system",discharge_instructions_2)])
 
 
-# set up parallel chain components
-chain_extract_diagnosis = prompt_extract_diagnosis | llm_gpt
+# query template of every section of the handout prompt (filled in with each diagnosis)
+section_queries = {
+    "definition": queries_ddx["definition"],
+    "presentation": queries_ddx["presentation"],
+    "course": queries_ddx["course"],
+    "management": queries_ddx["management_supportive"],
+    "follow_up": queries_ddx["follow_up"],
+    "redflags": queries_ddx["redflags"],
+}
+sections = list(section_queries)
 
-fill_queries = RunnableParallel( # fill in queries with the diagnosis 
-    query_definition = lambda x: queries_ddx["definition"].format(diagnosis=x["diagnosis"]),
-    query_presentation = lambda x: queries_ddx["presentation"].format(diagnosis=x["diagnosis"]),
-    query_course = lambda x: queries_ddx["course"].format(diagnosis=x["diagnosis"]),
-    query_management = lambda x: queries_ddx["management_supportive"].format(diagnosis=x["diagnosis"]),
-    query_follow_up = lambda x: queries_ddx["follow_up"].format(diagnosis=x["diagnosis"]),
-    query_redflags = lambda x: queries_ddx["redflags"].format(diagnosis=x["diagnosis"]),
-    md_plan = itemgetter("md_plan"),    
-)
 
+@singleton
+def get_chain_extract_diagnoses():
+    """assessment -> list of diagnoses (multi_diagnosis.py)"""
+    return prompt_extract_diagnoses | get_llm_gpt().with_structured_output(Diagnoses) | RunnableLambda(lambda d: clean_diagnoses(d.diagnoses))
 
-get_cotext = {
-    "definition": {"context": itemgetter("query_definition") | retriever, "query": itemgetter("query_definition")} | compressor,
-    "presentation": {"context": itemgetter("query_presentation") | retriever, "query": itemgetter("query_presentation")} | compressor,
-    "course": {"context": itemgetter("query_course") | retriever, "query": itemgetter("query_course")} | compressor,
-    "management": {"context": itemgetter("query_management") | retriever, "query": itemgetter("query_management")} | compressor,
-    "follow_up": {"context": itemgetter("query_follow_up") | retriever, "query": itemgetter("query_follow_up")} | compressor,
-    "redflags": {"context": itemgetter("query_redflags") | retriever, "query": itemgetter("query_redflags")} | compressor,
-}
+
+@singleton
+def get_chain_handout():
+    """final generation step: section contexts + md plan -> handout"""
+    return prompt_main | get_llm_gpt() | StrOutputParser()
+
+
+# pipeline steps, each timed as a stage (instrumentation.py)
+def extract_diagnoses_step(assessment):
+    """diagnoses from the dictionary of the corpus when it is confident (no llm round trip), else from the llm"""
+    with stage("extract_diagnosis") as s:
+        matcher = get_diagnosis_matcher()
+        local = matcher.extract(assessment) if matcher else None
+        s["local_hit"] = int(bool(local and local["confident"]))
+        if s["local_hit"]:
+            diagnoses = clean_diagnoses(local["diagnoses"])
+        else:
+            diagnoses = get_chain_extract_diagnoses().invoke(assessment)
+        s["diagnoses"] = len(diagnoses)
+    return diagnoses
+
+
+@singleton
+def get_partitioned():
+    """partitioned search is on and the chunks of the collection are labelled (database_helper.tag_sections); exported
+    indexes search every row when they have no partitions, so only chroma needs the labels"""
+    if partitioned_search and retriever_backend == "chroma" and not os.path.exists(os.path.join(db_directory, "sections.json")):
+        print(f"chunks of {db_directory} have no section labels (tagged at ingestion), searching every section")
+        return False
+    return partitioned_search
+
+
+def retrieve_step(queries):
+    """retrieves the docs of all the (diagnosis, section) queries in one batch"""
+    with stage("retrieval") as s:
+        sections = {key: key[1] for key in queries} if get_partitioned() else None
+        docs = get_retriever().batch_search(queries, sections=sections)
+        s["chunks"] = sum(len(d) for d in docs.values())
+    return docs
+
+
+def _to_text(compressed):
+    return compressed.to_string() if hasattr(compressed, "to_string") else str(compressed)
+
+
+def compress_step(queries, docs):
+    """compresses each unique chunk once (section_dedup.py)
+
+        -returns dict of (diagnosis, section): list of compressed texts of every call that compressed one of its
+            chunks, best ranked first: the full context of the section, whatever the other diagnoses of the request
+            (cached per diagnosis; assemble_step drops the repeats of the request)
+    """
+    with stage("dedup") as s:
+        groups = dedup_sections(docs)
+        s.update(dedup_stats(docs, groups))
+
+    with stage("compression"):
+        results = compressor.batch([
+            {"context": render_docs(group["docs"]), "query": group_query(group, queries)} for group in groups
+        ])
+
+    gathered = gather(groups, results, list(docs))
+    return {key: [_to_text(result) for result in gathered[key]] for key in docs}
+
+
+def context_steps(diagnoses):
+    """compressed contexts of every diagnosis (dict of diagnosis: dict of section: texts)
+
+        -generator of the generate_stream progress events; the contexts are its return value
+        -diagnoses seen before (or near duplicates) skip retrieval and compression
+        -the others are retrieved in one batch and compressed together, so the work grows with the unique chunks,
+            not with the num of diagnoses
+    """
+    context_cache = get_context_cache()
+    contexts = {}
+    for diagnosis in diagnoses:
+        with stage("context_cache") as s:
+            cached = context_cache.get(diagnosis)
+            s["cache_hit"] = cached is not None
+        if cached is not None:
+            contexts[diagnosis] = cached
+
+    missing = [diagnosis for diagnosis in diagnoses if diagnosis not in contexts]
+    if missing:
+        queries = diagnosis_queries(missing, section_queries)
+        docs = retrieve_step(queries)
+        yield {"stage": "retrieved", "num_docs": sum(len(d) for d in docs.values())}
+        compressed = compress_step(queries, docs)
+        for diagnosis in missing:
+            contexts[diagnosis] = {section: compressed[(diagnosis, section)] for section in sections}
+            context_cache.put(diagnosis, contexts[diagnosis])
+    yield {"stage": "compressed", "cached": not missing}
+
+    return {diagnosis: contexts[diagnosis] for diagnosis in diagnoses}
+
+
+def _run_steps(steps):
+    """runs a generator of progress events to the end; returns its return value"""
+    while True:
+        try:
+            next(steps)
+        except StopIteration as done:
+            return done.value
+
+
+def assemble_step(contexts, diagnoses, md_plan, budget=None):
+    """handout prompt inputs with the section contexts of all diagnoses cut to the token budget (context_budget.py)
+
+        -every diagnosis x section gets a fair share of the budget; md_plan is always kept
+        -the contexts of a section are merged into one, labelled by diagnosis when there are several
+        -a text shared by sections (or diagnoses) is only kept in the first one
+    """
+    budget = budget or context_token_budget
+    diagnosis = merge_diagnoses(diagnoses)
+    with stage("context_assembly", budget=budget) as s:
+        empty = {f"context_{section}": merge_section({d: "" for d in diagnoses}) for section in sections} # labels only
+        reserved = count_tokens(prompt_main.invoke({**empty, "diagnosis": diagnosis, "context_md_plan": md_plan}).to_string())
+        texts = drop_repeats({(d, section): contexts[d][section] for d in diagnoses for section in sections})
+        kept, cuts = fit_to_budget(texts, budget, reserved)
+        s.update(cut_stats(cuts))
+        inputs = {
+            f"context_{section}": merge_section({d: "\n\n".join(text for _, text in kept[(d, section)]) for d in diagnoses})
+            for section in sections
+        }
+        inputs.update(diagnosis=diagnosis, context_md_plan=md_plan)
+        s["prompt_tokens_estimate"] = count_tokens(prompt_main.invoke(inputs).to_string())
+
+    return inputs
+
+
+def get_section_contexts(x):
+    """compressed contexts of all sections and diagnoses, cut to the token budget"""
+    contexts = _run_steps(context_steps(x["diagnoses"]))
+    return assemble_step(contexts, x["diagnoses"], x["md_plan"])
+
+
+def generate_handout_step(inputs):
+    """streams the handout tokens (inputs is an iterator with the one dict of handout prompt inputs)"""
+    for x in inputs:
+        with stage("generation"):
+            yield from get_chain_handout().stream(x)
 
 
 # main chain
-main_chain = (
-    {
-        "diagnosis": itemgetter("assessment") | RunnablePassthrough() | chain_extract_diagnosis,
-        "md_plan": itemgetter("md_plan"),
-    }
-    | fill_queries
-    | {
-        "context_definition": get_cotext["definition"],
-        "context_presentation": get_cotext["presentation"],
-        "context_course": get_cotext["course"],
-        "context_management": get_cotext["management"],
-        "context_follow_up": get_cotext["follow_up"],
-        "context_redflags": get_cotext["redflags"],
-        "context_md_plan": itemgetter("md_plan"),
-    }
-    | prompt_main
-    | llm_gpt
-    | StrOutputParser()
-)
+@singleton
+def get_main_chain():
+    return (
+        {
+            "diagnoses": itemgetter("assessment") | RunnableLambda(extract_diagnoses_step),
+            "md_plan": itemgetter("md_plan"),
+        }
+        | RunnableLambda(get_section_contexts)
+        | RunnableGenerator(generate_handout_step)
+    )
+
+
+_lazy_attributes = {
+    "main_chain": get_main_chain,
+    "llm_gpt": get_llm_gpt,
+    "llm_llama": get_llm_llama,
+    "db": get_db,
+    "retriever": get_retriever,
+    "context_cache": get_context_cache,
+}
+
+
+def __getattr__(name):
+    """main.main_chain, main.db, ... still work; they are created on first access"""
+    if name in _lazy_attributes:
+        return _lazy_attributes[name]()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def warm_up():
+    """create the models, db and chain up front (e.g. when a server worker starts) instead of on the first request"""
+    hf_embed.embed_query("warm up") # loads the embedding model weights
+    get_retriever()
+    get_partitioned()
+    get_diagnosis_matcher()
+    get_context_cache()
+    get_main_chain()
 
 
 def generate(assessment, plan):
-    return main_chain.invoke({"assessment": assessment, "md_plan": plan})
+    with trace(), stage("request"):
+        return get_main_chain().invoke({"assessment": assessment, "md_plan": plan})
 
 
-    
+def _stream_events(assessment, plan):
+    diagnoses = extract_diagnoses_step(assessment)
+    yield {"stage": "diagnosis", "diagnosis": merge_diagnoses(diagnoses), "diagnoses": diagnoses}
+
+    contexts = yield from context_steps(diagnoses)
+
+    text = ""
+    for token in generate_handout_step(iter([assemble_step(contexts, diagnoses, plan)])):
+        text += token
+        yield {"stage": "handout", "text": text}
+
+
+def generate_stream(assessment, plan):
+    """streaming version of generate; yields events as the pipeline progresses
+
+        -{"stage": "diagnosis", "diagnosis": ..., "diagnoses": [...]}: diagnoses extracted (diagnosis: all of them in one
+            string); no diagnoses: generic handout from the md plan only
+        -{"stage": "retrieved", "num_docs": ...}: contexts retrieved (skipped when cached)
+        -{"stage": "compressed", "cached": ...}: section contexts ready
+        -{"stage": "handout", "text": ...}: handout so far, once per streamed token
+        -the pipeline runs in a thread of its own and hands the events over a queue: the trace / stage context
+            variables are set and reset in one context, whichever threads resume this generator (gradio, server.py);
+            closing the generator stops the pipeline at its next event
+    """
+    events = queue.Queue()
+    stopped = threading.Event()
+
+    def run():
+        try:
+            with trace(), stage("request"):
+                for event in _stream_events(assessment, plan):
+                    events.put(event)
+                    if stopped.is_set():
+                        return
+        except Exception as e:
+            events.put(e)
+        finally:
+            events.put(None)
+
+    threading.Thread(target=contextvars.copy_context().run, args=(run,), daemon=True).start()
+    try:
+        for event in iter(events.get, None):
+            if isinstance(event, Exception):
+                raise event
+            yield event
+    finally:
+        stopped.set()
+
+
+def ui_update(status, event):
+    """(progress, handout) for the gradio outputs after a generate_stream event; status: progress lines so far"""
+    if event["stage"] == "diagnosis" and not event["diagnoses"]:
+        status.append(no_diagnosis_message)
+    elif event["stage"] == "diagnosis":
+        status.append(f"diagnosis extracted: {event['diagnosis']}")
+    elif event["stage"] == "retrieved":
+        status.append(f"contexts retrieved: {event['num_docs']} chunks")
+    elif event["stage"] == "compressed":
+        status.append("compression done" + (" (cached)" if event["cached"] else ""))
+    elif event["stage"] == "handout":
+        return "\n".join(status + ["generating handout..."]), event["text"]
+    return "\n".join(status), ""
+
+
+def _stream_to_ui(assessment, plan):
+    """maps generate_stream events to (status, handout) for the gradio outputs"""
+    status, handout = [], ""
+    for event in generate_stream(assessment, plan):
+        progress, handout = ui_update(status, event)
+        yield progress, handout
+
+    yield "\n".join(status + ["done"]), handout
+
+
+def build_demo(stream_func=_stream_to_ui):
+    """gradio UI; the handout is rendered while it is being generated
+
+        -stream_func(assessment, plan) yields (status, handout); server.py passes one that goes through its request queue
+    """
+    import gradio as gr
 
-if __name__ == "__main__":
-    # UI
-    '''import gradio as gr
     eg_assessment = """\
     5 yo M, first asthma exacerbation. 
     """
@@ -97,7 +443,6 @@ if __name__ == "__main__":
     - follow-up with family doctor if not improved by 2 days
     """
 
-
     with gr.Blocks() as demo:
         gr.Markdown("""
             # Discharge Instruction Generator
@@ -112,15 +457,22 @@ if __name__ == "__main__":
                                value=eg_plan)
                 btn_gen = gr.Button("Generate", variant="primary")
             with gr.Column():
+                status = gr.Text(label="Progress", lines=4)
                 output = gr.Text(label="Generated Discharge Instructions", lines=20)
-        
-        btn_gen.click(generate, inputs=[assessment, plan], outputs=[output])
+
+        # no gradio concurrency limit: server.py's request queue does the limiting
+        btn_gen.click(stream_func, inputs=[assessment, plan], outputs=[status, output], concurrency_limit=None)
+
+    return demo
+
+
     
-    demo.launch(inbrowser=True)
-    '''
+
+if __name__ == "__main__":
+    # UI + HTTP API: python server.py
 
     # test
-    result = main_chain.invoke({
+    result = get_main_chain().invoke({
         "assessment": "5 yo M, first asthma exacerbation of the year likely secondary to a viral infection, responded well to asthma protocol, now stable in room air on q4h venolin. Reduced fluid intake due to sore throat (likely viral pharyngitis) but euvolemic on exam and no signs of bacterial infection of the throat.",
         "md_plan":"continue q4h ventolin for the next 24hours. follow-up with your family doctor in the next few days."
     })
@@ -0,0 +1,58 @@
+"""Several diagnoses in one handout request
+- the diagnoses of the assessment are extracted as a list (structured output, Diagnoses), most important first
+- every diagnosis x section query is retrieved in one batched search and compressed together (section_dedup.py),
+    so a chunk retrieved for several diagnoses is compressed once
+- the contexts of a section are merged into one (labelled by diagnosis) and a single handout is generated
+- with one diagnosis the prompts are the same as before
+- with none (nothing that reads as a diagnosis in the assessment) nothing is retrieved and a generic handout is made
+    from the md plan, for no_diagnosis
+"""
+
+from typing import List
+from langchain_core.pydantic_v1 import BaseModel, Field
+from response_cache import normalize_diagnosis
+
+max_diagnoses = 4 # more than that and the handout is no longer readable (and the prompt gets too long)
+no_diagnosis = "your child's condition" # the {diagnosis} of the prompts when no diagnosis was found
+no_diagnosis_message = "no diagnosis found in the assessment: generic handout from the plan"
+
+
+class Diagnoses(BaseModel):
+    """The diagnoses found in a physician's assessment of a patient."""
+    diagnoses: List[str] = Field(description="Every distinct diagnosis of the assessment, most important first, in a few words each.")
+
+
+def clean_diagnoses(diagnoses):
+    """stripped, without duplicates (same normalized diagnosis), at most max_diagnoses; empty if none"""
+    cleaned, seen = [], set()
+    for diagnosis in diagnoses:
+        diagnosis = diagnosis.strip().strip("-*.").strip()
+        key = normalize_diagnosis(diagnosis)
+        if key and key not in seen:
+            seen.add(key)
+            cleaned.append(diagnosis)
+    return cleaned[:max_diagnoses]
+
+
+def merge_diagnoses(diagnoses):
+    """'a', 'a and b', 'a, b and c': the {diagnosis} of the prompts (no_diagnosis if there are none)"""
+    if not diagnoses:
+        return no_diagnosis
+    if len(diagnoses) == 1:
+        return diagnoses[0]
+    return ", ".join(diagnoses[:-1]) + " and " + diagnoses[-1]
+
+
+def diagnosis_queries(diagnoses, section_queries):
+    """dict of (diagnosis, section): query for every diagnosis x section (section_queries: section: query template)"""
+    return {
+        (diagnosis, section): query.format(diagnosis=diagnosis)
+        for diagnosis in diagnoses for section, query in section_queries.items()
+    }
+
+
+def merge_section(contexts):
+    """one context for a section from dict of diagnosis: context; labelled by diagnosis when there are several"""
+    if len(contexts) == 1:
+        return next(iter(contexts.values()))
+    return "\n\n".join(f"{diagnosis}:\n{context}" for diagnosis, context in contexts.items())
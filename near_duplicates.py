@@ -0,0 +1,128 @@
+"""Near-duplicate chunks of the collection (the same guidance copied across health_CA, caringforkids, cps statements
+and wikipedia, or the same file ingested twice under another path)
+- MinHash signature of every chunk: num_perm min hashes of its word shingles (shingle_size words), so the share of
+    equal min hashes of two chunks estimates the jaccard similarity of their shingles
+- LSH: the signature is cut in bands; chunks sharing one band are candidates (sub-quadratic: no pair is compared
+    unless they collide), a candidate is a duplicate when its estimated similarity is >= threshold
+- clusters are the connected duplicates; the longest chunk of a cluster is kept (canonical), the sources of the
+    others are merged in its "sources" metadata
+- run at ingestion (database_helper.dedup_collection); the clusters are kept in db_directory/duplicates.json and the
+    signatures of the kept chunks in db_directory/minhash.npz, so later runs only hash the chunks they add
+    (match_signatures: band keys of the stored signatures are sorted and searched, no python loop over the corpus)
+"""
+
+import re
+import zlib
+import numpy as np
+
+num_perm = 128
+bands = 32 # of num_perm // bands rows; a pair of similarity s is a candidate with probability 1 - (1 - s ** rows) ** bands
+shingle_size = 3
+threshold = 0.7 # e.g. 3 words replaced in a 60 word chunk: ~0.73
+
+_prime = (1 << 31) - 1 # crc32 shingle hashes mod prime, a * x + b fits in uint64
+_word = re.compile(r"\w+")
+
+
+def shingles(text, size=shingle_size):
+    """hashes of the word shingles of a text (a text shorter than size is one shingle)"""
+    words = _word.findall(text.lower())
+    grams = {" ".join(words[i:i + size]) for i in range(max(1, len(words) - size + 1))}
+    return np.fromiter((zlib.crc32(gram.encode()) for gram in grams), dtype=np.uint64, count=len(grams))
+
+
+class MinHasher:
+    """num_perm universal hash functions (a * x + b) mod prime; signature = min of each over the shingles"""
+    def __init__(self, num_perm=num_perm, seed=0):
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, _prime, size=num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, _prime, size=num_perm, dtype=np.uint64)
+
+    def signature(self, text):
+        hashes = shingles(text) % _prime
+        return ((hashes[:, None] * self.a + self.b) % _prime).min(axis=0).astype(np.uint32)
+
+    def signatures(self, texts):
+        return np.stack([self.signature(text) for text in texts]) if texts else np.zeros((0, len(self.a)), dtype=np.uint32)
+
+
+def similarity(signatures, i, j):
+    """estimated jaccard similarity of chunks i and j"""
+    return float(np.mean(signatures[i] == signatures[j]))
+
+
+def _find(parents, i):
+    while parents[i] != i:
+        parents[i] = parents[parents[i]]
+        i = parents[i]
+    return i
+
+
+def clusters(signatures, bands=bands, threshold=threshold):
+    """groups of row indices of near-duplicate signatures (only groups of 2 or more), in row order
+
+        -every bucket of a band is compared to its first row, so a band costs one pass over the rows
+    """
+    parents = list(range(len(signatures)))
+    rows = signatures.shape[1] // bands
+    for band in range(bands):
+        first = {}
+        for i, key in enumerate(map(bytes, signatures[:, band * rows:(band + 1) * rows])):
+            j = first.setdefault(key, i)
+            if j != i and _find(parents, i) != _find(parents, j) and similarity(signatures, i, j) >= threshold:
+                parents[_find(parents, i)] = _find(parents, j)
+
+    groups = {}
+    for i in range(len(signatures)):
+        groups.setdefault(_find(parents, i), []).append(i)
+    return [group for group in groups.values() if len(group) > 1]
+
+
+def canonical_clusters(signatures, lengths, bands=bands, threshold=threshold):
+    """list of (canonical row, duplicate rows) of the clusters; canonical: the longest text of a cluster"""
+    found = []
+    for group in clusters(signatures, bands, threshold):
+        canonical = max(group, key=lambda i: (lengths[i], -i))
+        found.append((canonical, [i for i in group if i != canonical]))
+    return found
+
+
+def find_duplicates(texts, hasher=None, bands=bands, threshold=threshold):
+    """list of (canonical row, duplicate rows) of the near-duplicate texts"""
+    signatures = (hasher or MinHasher()).signatures(texts)
+    return canonical_clusters(signatures, [len(text) for text in texts], bands, threshold)
+
+
+def band_keys(signatures, bands=bands):
+    """one uint64 key per band of every signature (equal bands give equal keys)"""
+    rows = signatures.shape[1] // bands
+    values = signatures[:, :rows * bands].astype(np.uint64).reshape(len(signatures), bands, rows)
+    keys = np.zeros((len(signatures), bands), dtype=np.uint64)
+    for row in range(rows): # wraps around mod 2 ** 64; a collision only adds a candidate
+        keys = keys * np.uint64(1000003) + values[:, :, row]
+    return keys
+
+
+def match_signatures(new, stored, bands=bands, threshold=threshold):
+    """row of the most similar stored near duplicate of every new signature, -1 if none"""
+    matches = np.full(len(new), -1, dtype=np.int64)
+    if not len(new) or not len(stored):
+        return matches
+    new_keys, stored_keys = band_keys(new, bands), band_keys(stored, bands)
+    candidates = [set() for _ in range(len(new))]
+    for band in range(bands):
+        order = np.argsort(stored_keys[:, band], kind="stable")
+        ordered = stored_keys[order, band]
+        low = np.searchsorted(ordered, new_keys[:, band], side="left")
+        high = np.searchsorted(ordered, new_keys[:, band], side="right")
+        for i in np.flatnonzero(high > low):
+            candidates[i].update(order[low[i]:high[i]].tolist())
+
+    for i, rows in enumerate(candidates):
+        if rows:
+            rows = np.fromiter(rows, dtype=np.int64, count=len(rows))
+            similarities = (stored[rows] == new[i]).mean(axis=1)
+            best = int(np.argmax(similarities))
+            if similarities[best] >= threshold:
+                matches[i] = rows[best]
+    return matches
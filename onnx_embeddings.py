@@ -0,0 +1,167 @@
+"""ONNX Runtime embedder for BAAI/llm-embedder (alternative to HuggingFaceBgeEmbeddings in eager pytorch)
+- export_onnx: exports the model once (needs torch + transformers), optionally with dynamic int8 quantization
+    of the weights (model_int8.onnx)
+- OnnxEmbeddings: langchain Embeddings interface; only onnxruntime + tokenizers at run time
+- intra-op threads are set explicitly (threads), so several workers on one node dont oversubscribe the cores
+- dynamic batching: texts are sorted by token length and batched up to max_batch_tokens, so each batch is only
+    padded to its own longest text (the output keeps the input order)
+- CLS pooling + normalization and the bge query instruction, like _global.get_hf_embed
+
+export from the repo root: python onnx_embeddings.py [--out ./resources/onnx/llm-embedder] [--no-quantize]
+check parity / throughput: python -m benchmarks.onnx_embeddings
+"""
+
+import os
+import json
+import argparse
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+bge_query_instruction = "Represent this question for searching relevant passages: " # HuggingFaceBgeEmbeddings default
+
+
+def export_onnx(model_name, path, quantize=True, opset=17):
+    """exports model_name to path/model.onnx (+ model_int8.onnx) with its tokenizer.json"""
+    import torch
+    from transformers import AutoModel, AutoTokenizer
+
+    class Encoder(torch.nn.Module): # last hidden state only, as a plain tensor
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+
+        def forward(self, input_ids, attention_mask):
+            return self.model(input_ids=input_ids, attention_mask=attention_mask, return_dict=False)[0]
+
+    os.makedirs(path, exist_ok=True)
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    tokenizer.save_pretrained(path) # tokenizer.json is what OnnxEmbeddings loads
+    model = Encoder(AutoModel.from_pretrained(model_name)).eval()
+
+    dummy = tokenizer(["export the model"], return_tensors="pt")
+    axes = {0: "batch", 1: "sequence"}
+    with torch.no_grad():
+        torch.onnx.export(
+            model, (dummy["input_ids"], dummy["attention_mask"]), os.path.join(path, "model.onnx"),
+            input_names = ["input_ids", "attention_mask"],
+            output_names = ["last_hidden_state"],
+            dynamic_axes = {"input_ids": axes, "attention_mask": axes, "last_hidden_state": axes},
+            opset_version = opset,
+        )
+
+    if quantize:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        quantize_dynamic(os.path.join(path, "model.onnx"), os.path.join(path, "model_int8.onnx"), weight_type=QuantType.QInt8)
+
+    with open(os.path.join(path, "export.json"), "w") as f:
+        json.dump({"model_name": model_name, "quantized": quantize, "opset": opset}, f)
+
+
+class OnnxEmbeddings(Embeddings):
+    """embeddings from an onnx export of a bert-like model (export_onnx)
+
+        -quantized: use model_int8.onnx instead of model.onnx
+        -threads: onnxruntime intra-op threads (None: all cores)
+        -max_batch_tokens: max padded tokens (texts * longest text) of a batch; batch_size caps the num of texts
+        -pooling: cls (bge models) or mean
+        -model_name: the model the export in path must be of (export.json), checked when given
+        -self.model_name: model, backend and precision (e.g. BAAI/llm-embedder+onnx-int8)
+    """
+    def __init__(self, path, quantized=False, threads=None, batch_size=64, max_batch_tokens=16384, max_length=512,
+                 pooling="cls", normalize=True, query_instruction=bge_query_instruction, model_name=None):
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+
+        exported = {}
+        if os.path.exists(os.path.join(path, "export.json")):
+            with open(os.path.join(path, "export.json"), "r") as f:
+                exported = json.load(f)
+        if model_name and exported.get("model_name", model_name) != model_name:
+            raise ValueError(f"{path} is an export of {exported['model_name']}, not {model_name}; export it again with: python onnx_embeddings.py")
+        model_file = os.path.join(path, "model_int8.onnx" if quantized else "model.onnx")
+        if quantized and not os.path.exists(model_file):
+            raise ValueError(f"{path} has no int8 model (exported with --no-quantize), use the onnx backend or export it again")
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = threads or 0
+        options.inter_op_num_threads = 1
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self._session = ort.InferenceSession(model_file, options, providers=["CPUExecutionProvider"])
+        self._inputs = {i.name for i in self._session.get_inputs()}
+
+        self._tokenizer = Tokenizer.from_file(os.path.join(path, "tokenizer.json"))
+        self._tokenizer.enable_truncation(max_length)
+        self._tokenizer.no_padding() # padded per batch
+        self._pad_id = self._tokenizer.token_to_id("[PAD]") or 0
+
+        self.model_name = f"{exported.get('model_name', model_name or os.path.basename(path))}+onnx{'-int8' if quantized else ''}"
+        self.batch_size = batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.pooling = pooling
+        self.normalize = normalize
+        self.query_instruction = query_instruction
+
+    def _batches(self, lengths):
+        """batches of text positions, shortest texts first"""
+        batch, longest = [], 0
+        for i in np.argsort(lengths, kind="stable"):
+            longest_with_i = max(longest, lengths[i])
+            if batch and (len(batch) == self.batch_size or (len(batch) + 1) * longest_with_i > self.max_batch_tokens):
+                yield batch
+                batch, longest_with_i = [], lengths[i]
+            batch.append(i)
+            longest = longest_with_i
+        if batch:
+            yield batch
+
+    def _embed(self, texts):
+        if not texts:
+            return []
+        encodings = self._tokenizer.encode_batch(texts)
+        lengths = [len(encoding.ids) for encoding in encodings]
+
+        vectors = None
+        for batch in self._batches(lengths):
+            length = max(lengths[i] for i in batch)
+            input_ids = np.full((len(batch), length), self._pad_id, dtype=np.int64)
+            attention_mask = np.zeros((len(batch), length), dtype=np.int64)
+            for row, i in enumerate(batch):
+                input_ids[row, :lengths[i]] = encodings[i].ids
+                attention_mask[row, :lengths[i]] = 1
+
+            feeds = {"input_ids": input_ids, "attention_mask": attention_mask}
+            if "token_type_ids" in self._inputs:
+                feeds["token_type_ids"] = np.zeros_like(input_ids)
+            hidden = self._session.run(None, feeds)[0]
+
+            if self.pooling == "cls":
+                pooled = hidden[:, 0]
+            else:
+                pooled = (hidden * attention_mask[..., None]).sum(axis=1) / attention_mask.sum(axis=1, keepdims=True)
+            if self.normalize:
+                pooled = pooled / np.maximum(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12)
+
+            if vectors is None:
+                vectors = np.empty((len(texts), pooled.shape[1]), dtype=np.float32)
+            vectors[batch] = pooled
+
+        return vectors.tolist()
+
+    def embed_documents(self, texts):
+        return self._embed([text.replace("\n", " ") for text in texts])
+
+    def embed_query(self, text):
+        return self._embed([self.query_instruction + text.replace("\n", " ")])[0]
+
+
+if __name__ == "__main__":
+    from _global import onnx_model_path, embedding_model_name
+
+    args = argparse.ArgumentParser(description="export the embedding model to onnx")
+    args.add_argument("--model", default=embedding_model_name)
+    args.add_argument("--out", default=onnx_model_path)
+    args.add_argument("--no-quantize", action="store_true", help="skip the int8 model")
+    args = args.parse_args()
+
+    export_onnx(args.model, args.out, quantize=not args.no_quantize)
+    print(f"exported {args.model} to {args.out}")
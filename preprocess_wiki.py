@@ -2,31 +2,57 @@
 - Scrape a wikipedia page into .txt or .md
 - encodes url in the file name
 - parses out the "See also", "References", "External links" sections
+- html is converted with the lxml based MarkdownConverter (html_to_md.py) when lxml is installed, html2text otherwise
+- WikiCrawler: concurrent crawl of categories (and subcategories) through the MediaWiki api with a disk cache; reruns
+    only download the pages whose revision changed
 """
 
 
 import wikipediaapi
 import re
+import os
+import json
+import hashlib
+import threading
 import html2text
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 from _global import path_to_resources
-from bs4 import BeautifulSoup, SoupStrainer
+from html_to_md import MarkdownConverter
+
+
+sections_to_remove = ["See also", "References", "External links"]
+
+# shared converter (no state between pages); drops sections_to_remove while converting
+md_converter = MarkdownConverter(skip_sections=sections_to_remove) if MarkdownConverter.available else None
 
 
 def remove_sections(page):
     """dont include references, see also, external links"""
-    sections_to_remove = ["See also", "References", "External links"]
     for i in range(len(page.sections)-1, -1, -1):
         if page.sections[i].title in sections_to_remove:
             del page.sections[i]
 
 
 
-def parser(page):
-    """parse html file into md"""
-    # remove unessary content: see also, references, external links
-    remove_sections(page)
+def remove_sections_html(html):
+    """remove the see also, references, external links sections (h2 heading until the next h2) from page html"""
+    parts = re.split(r"(?=<h2[\s>])", html)
+    kept = []
+    for part in parts:
+        heading = re.match(r"<h2[^>]*>(.*?)</h2>", part, flags=re.DOTALL)
+        if heading and re.sub(r"<[^>]+>", "", heading.group(1)).strip() in sections_to_remove:
+            continue
+        kept.append(part)
+
+    return "".join(kept)
+
 
-    # conver to .md
+
+def html2text_maker():
+    """html to md converter settings"""
     text_maker = html2text.HTML2Text()
     text_maker.ignore_links = True
     text_maker.bypass_tables = False
@@ -34,10 +60,38 @@ def parser(page):
     text_maker.ignore_emphasis = True
     text_maker.ignore_images = True
     text_maker.body_width = 0 # dont wrap lines
+    return text_maker
+
+
 
-    soup = BeautifulSoup(page.text, "html.parser")
-    
-    return text_maker.handle(str(soup))
+def html_to_md(html):
+    """convert page html to md without the see also, references, external links sections"""
+    if md_converter:
+        return md_converter.convert(html)
+
+    # lxml not installed
+    return html2text_maker().handle(remove_sections_html(html))
+
+
+
+def parser(page):
+    """parse html file into md"""
+    # remove unessary content (see also, references, external links) and conver to .md in one pass
+    return html_to_md(page.text)
+
+
+
+def url_to_filename(url):
+    """encode url in filename"""
+    return url.replace('https://', '').replace('http://', '').replace('/', '.').strip()
+
+
+def write_page_md(path, title, url, content):
+    with open(f"{path}/{url_to_filename(url)}.md", "w") as f:
+        f.write(f"# {title}\n\n") # add title
+        f.write(f"## Introduction\n\n") # add heading for introduction
+        f.write(content)
+        f.write(f"\n\n ## Source \n\n {url}") 
 
 
 
@@ -57,16 +111,7 @@ def get_pages_in_cat_md(category, path):
 
             # parse into .md
             content = parser(page)
-
-            # encode url in filename
-            url = page.canonicalurl
-            filename = url.replace('https://', '').replace('http://', '').replace('/', '.').strip()
-
-            with open(f"{path}/{filename}.md", "w") as f:
-                f.write(f"# {page.title}\n\n") # add title
-                f.write(f"## Introduction\n\n") # add heading for introduction
-                f.write(content)
-                f.write(f"\n\n ## Source \n\n {page.canonicalurl}") 
+            write_page_md(path, page.title, page.canonicalurl, content)
         i += 1
 
     print(f"total {i} pages downloaded")
@@ -98,11 +143,198 @@ def get_pages_in_cat_txt(category, path):
     print(f"total {i} pages downloaded")
 
 
+class WikiCrawler:
+    """crawls wikipedia categories through the MediaWiki api
+
+        -category members and pages are fetched concurrently (at most concurrency requests at a time)
+        -recurses into subcategories up to depth levels (0 = only the pages directly in the categories)
+        -pages found in several categories are only downloaded once
+        -responses are always cached in cache_dir (with their ETag/Last-Modified when the server sends them, for
+            conditional requests)
+        -page changes are detected from the revision of the page (prop=info lastrevid / touched, batch_size titles
+            per request, kept in cache_dir/revisions.json): reruns only download the pages that changed
+        -a page that fails to download is skipped (and tried again on the next run); revisions.json is saved every
+            save_every pages written and when the run ends, even on an error
+        -api_url can point to a local server with canned MediaWiki responses for testing (benchmarks/wiki_crawler.py)
+    """
+    batch_size = 50 # max titles per query of the api
+    save_every = 100 # pages written between saves of revisions.json
+    def __init__(self, api_url="https://en.wikipedia.org/w/api.php", cache_dir=f"{path_to_resources}/wiki_cache",
+                 concurrency=8, user_agent="WikiMedDB (test@gmail.com)", timeout=30):
+        self.api_url = api_url
+        self.cache_dir = cache_dir
+        self.concurrency = concurrency
+        self.user_agent = user_agent
+        self.timeout = timeout
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _cache_path(self, url):
+        return os.path.join(self.cache_dir, hashlib.sha256(url.encode("utf-8")).hexdigest() + ".json")
+
+    def get(self, params):
+        """GET the api with params; returns (json response, changed) where changed is False for a 304"""
+        url = f"{self.api_url}?{urllib.parse.urlencode(sorted({**params, 'format': 'json'}.items()))}"
+        cache_path = self._cache_path(url)
+        cached = None
+        headers = {"User-Agent": self.user_agent}
+        if os.path.exists(cache_path):
+            with open(cache_path, "r") as f:
+                cached = json.load(f)
+            if cached.get("etag"):
+                headers["If-None-Match"] = cached["etag"]
+            if cached.get("last_modified"):
+                headers["If-Modified-Since"] = cached["last_modified"]
+
+        try:
+            with urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=self.timeout) as response:
+                body = response.read().decode("utf-8")
+                etag = response.headers.get("ETag")
+                last_modified = response.headers.get("Last-Modified")
+        except urllib.error.HTTPError as e:
+            if e.code == 304 and cached:
+                return json.loads(cached["body"]), False
+            raise
+
+        with open(cache_path, "w") as f:
+            json.dump({"etag": etag, "last_modified": last_modified, "body": body}, f)
+
+        return json.loads(body), cached is None or cached["body"] != body
+
+    def category_members(self, category):
+        """all pages (ns 0) and subcategories (ns 14) of a category, following api continuation"""
+        params = {
+            "action": "query",
+            "list": "categorymembers",
+            "cmtitle": f"Category:{category}",
+            "cmtype": "page|subcat",
+            "cmlimit": "500",
+        }
+        members = []
+        while True:
+            data, _ = self.get(params)
+            members.extend(data["query"]["categorymembers"])
+            if "continue" not in data:
+                return members
+            params = {**params, **data["continue"]}
+
+    def crawl(self, categories, depth=0):
+        """titles of all pages in categories and their subcategories (up to depth levels), de-duplicated"""
+        pages = {}
+        visited = {category.replace("_", " ") for category in categories}
+        level = list(categories)
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            for _ in range(depth + 1):
+                subcats = []
+                for members in pool.map(self.category_members, level):
+                    for member in members:
+                        if member["ns"] == wikipediaapi.Namespace.MAIN:
+                            pages.setdefault(member["title"], member)
+                        elif member["ns"] == wikipediaapi.Namespace.CATEGORY:
+                            subcat = member["title"].split(":", 1)[1]
+                            if subcat not in visited:
+                                visited.add(subcat)
+                                subcats.append(subcat)
+                level = subcats
+                if not level:
+                    break
+
+        return list(pages)
+
+    def revisions(self, titles):
+        """dict of title: (lastrevid, touched) of the current revision of every page (missing pages are left out)"""
+        revisions = {}
+        for start in range(0, len(titles), self.batch_size):
+            batch = titles[start:start + self.batch_size]
+            data, _ = self.get({"action": "query", "prop": "info", "redirects": "1", "titles": "|".join(batch)})
+            query = data.get("query", {})
+            # back from the normalized / redirect target title to the requested one
+            renamed = {t: t for t in batch}
+            for key in ("normalized", "redirects"):
+                for rename in query.get(key, []):
+                    renamed.update((t, rename["to"]) for t, target in list(renamed.items()) if target == rename["from"])
+            found = {page["title"]: (page.get("lastrevid"), page.get("touched")) for page in query.get("pages", {}).values() if "missing" not in page}
+            revisions.update((t, found[target]) for t, target in renamed.items() if target in found)
+        return revisions
+
+    def _load_revisions(self):
+        path = os.path.join(self.cache_dir, "revisions.json")
+        if not os.path.exists(path):
+            return {}
+        with open(path, "r") as f:
+            return json.load(f)
+
+    def _save_revisions(self, revisions):
+        path = os.path.join(self.cache_dir, "revisions.json")
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(revisions, f)
+        os.replace(f"{path}.tmp", path)
+
+    def fetch_page(self, title):
+        """returns (title, canonical url, page html, changed)"""
+        data, changed = self.get({
+            "action": "query",
+            "prop": "extracts|info",
+            "inprop": "url",
+            "redirects": "1",
+            "titles": title,
+        })
+        page = next(iter(data["query"]["pages"].values()))
+
+        return page["title"], page["canonicalurl"], page.get("extract", ""), changed
+
+    def download_md(self, categories, path, depth=0):
+        """download every page of the categories into path in .md format; pages whose revision did not change since
+        the last run (and whose file exists) are skipped without fetching them; returns the num of pages written"""
+        titles = self.crawl(categories, depth)
+        print(f"{len(titles)} pages found in {len(categories)} categories")
+
+        stored = self._load_revisions() # title: {"revision", "file"}
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            batches = [titles[i:i + self.batch_size] for i in range(0, len(titles), self.batch_size)]
+            current = {t: list(revision) for revisions in pool.map(self.revisions, batches) for t, revision in revisions.items()}
+
+        lock = threading.Lock() # stored is saved while other pages are downloaded
+        written, failed = [], []
+
+        def download(title):
+            known = stored.get(title)
+            if known and title in current and known["revision"] == current[title] and os.path.exists(known["file"]):
+                return
+            try:
+                page_title, url, html, _ = self.fetch_page(title)
+                write_page_md(path, page_title, url, html_to_md(html))
+            except Exception as e: # one bad page does not lose the others
+                print(f"failed to download {title}: {type(e).__name__}: {e}")
+                failed.append(title)
+                return
+            with lock:
+                stored[title] = {"revision": current.get(title), "file": f"{path}/{url_to_filename(url)}.md"}
+                written.append(title)
+                if len(written) % self.save_every == 0:
+                    self._save_revisions(stored)
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+                list(pool.map(download, titles))
+        finally:
+            with lock:
+                self._save_revisions(stored)
+
+        print(f"total {len(written)} pages downloaded, {len(failed)} failed, {len(titles) - len(written) - len(failed)} unchanged")
+        return len(written)
+
+
 if __name__ == '__main__':
-    get_pages_in_cat_md("Pediatrics", f"{path_to_resources}/wiki")
-    get_pages_in_cat_md("Human diseases and disorders", f"{path_to_resources}/wiki")
-    get_pages_in_cat_md("Disorders originating in the perinatal period", f"{path_to_resources}/wiki")
-    get_pages_in_cat_md("Medical_emergencies", f"{path_to_resources}/wiki")
+    WikiCrawler(concurrency=8).download_md(
+        ["Pediatrics", "Human diseases and disorders", "Disorders originating in the perinatal period", "Medical_emergencies"],
+        f"{path_to_resources}/wiki",
+        depth = 1, # also pages in the direct subcategories
+    )
+
+    #get_pages_in_cat_md("Pediatrics", f"{path_to_resources}/wiki")
+    #get_pages_in_cat_md("Human diseases and disorders", f"{path_to_resources}/wiki")
+    #get_pages_in_cat_md("Disorders originating in the perinatal period", f"{path_to_resources}/wiki")
+    #get_pages_in_cat_md("Medical_emergencies", f"{path_to_resources}/wiki")
 
 
     #get_pages_in_cat_txt("Pediatrics", f"{path_to_resources}/wiki")
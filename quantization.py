@@ -0,0 +1,60 @@
+"""Scalar quantization of chunk embeddings (float16 / int8) for compact in-memory indexes
+- int8: per-dimension offset and scale calibrated on the embeddings of the collection, x ~ offset + scale * code;
+    the range is clipped at quantiles so a few outliers dont waste the 256 levels
+- float16: plain cast, no calibration
+- the calibration is computed at ingestion (database_helper.calibrate_collection) and saved as quantization.json
+    in the db directory; vector_index exports the codes and QuantizedIndex rescores its candidates at full precision
+"""
+
+import os
+import json
+import numpy as np
+
+dtypes = ("float16", "int8")
+
+
+def calibrate(vectors, clip=0.001):
+    """per-dimension offset/scale mapping [clip, 1 - clip] quantiles of vectors to the int8 range"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    low = np.quantile(vectors, clip, axis=0)
+    high = np.quantile(vectors, 1 - clip, axis=0)
+    scale = np.maximum((high - low) / 255, 1e-8)
+    return {
+        "offset": (low + 128 * scale).astype(np.float32),
+        "scale": scale.astype(np.float32),
+        "clip": clip,
+        "num_vectors": len(vectors),
+    }
+
+
+def save_calibration(calibration, path):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w") as f:
+        json.dump({key: value.tolist() if isinstance(value, np.ndarray) else value for key, value in calibration.items()}, f)
+
+
+def load_calibration(path):
+    """calibration saved by save_calibration, None if there is none"""
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        calibration = json.load(f)
+    calibration["offset"] = np.asarray(calibration["offset"], dtype=np.float32)
+    calibration["scale"] = np.asarray(calibration["scale"], dtype=np.float32)
+    return calibration
+
+
+def quantize(vectors, dtype, calibration=None):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if dtype == "float16":
+        return vectors.astype(np.float16)
+    if dtype == "int8":
+        codes = np.rint((vectors - calibration["offset"]) / calibration["scale"])
+        return np.clip(codes, -128, 127).astype(np.int8)
+    raise ValueError(f"unknown quantization {dtype!r}, expected one of {dtypes}")
+
+
+def dequantize(codes, calibration=None):
+    if codes.dtype == np.int8:
+        return calibration["offset"] + calibration["scale"] * codes.astype(np.float32)
+    return codes.astype(np.float32)
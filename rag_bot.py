@@ -0,0 +1,356 @@
+"""RagBot: handles the different steps of RAG (used by RAG.ipynb for evaluation)
+- sections are retrieved in one batch (or concurrently) and compressed concurrently in a thread pool
+- LLM calls go through a shared rate limiter instead of fixed sleeps
+- chunks retrieved by several sections are compressed once (section_dedup.py)
+- the contexts of the handout prompt are cut to a token budget (context_budget.py)
+- all the diagnoses of the assessment are retrieved and compressed together and go in one handout (multi_diagnosis.py)
+- with partitioned_search, the query of a section only searches the chunks of matching sections (section_partitions.py)
+"""
+
+import json
+import contextvars
+from typing import List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from rate_limiter import RateLimiter, estimate_tokens
+from instrumentation import stage, trace, token_usage_handler
+from section_dedup import chunk_key, dedup_sections, group_query, render_docs, source_index, drop_repeats, dedup_stats
+from context_budget import context_token_budget, count_tokens, fit_to_budget, cut_stats
+from multi_diagnosis import Diagnoses, clean_diagnoses, merge_diagnoses, merge_section
+
+from langchain_community.llms import Ollama
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.pydantic_v1 import BaseModel, Field, validator
+from langchain_openai import ChatOpenAI
+from langsmith import traceable
+
+
+# openai limits for gpt-3.5-turbo (tier 1)
+requests_per_min = 3500
+tokens_per_min = 60000
+
+
+class CompressedDoc(BaseModel):
+    """Represents a single compressed document containing relevant information extracted for a specific query."""
+    id: int = Field(description="The unique identifier for the document, representing its position in the retrieval sequence.")
+    context: str = Field(description="The relevant text extracted verbatim from the document. Special characters are properly escaped.")
+    source: Optional[str] = Field(description="Source of the information")
+
+    @validator('context')
+    def escape_special_characters(cls, value):
+        return json.dumps(value)[1:-1]
+
+
+class CompressedDocs(BaseModel):
+    """Represents a collection of compressed documents, all containing relevant information extracted for a specific query. Use by PydanticOutputParser tool."""
+    contexts: List[CompressedDoc] = Field(description="A list of CompressedDoc objects, each representing a compressed document with extracted relevant information.")
+
+
+class RagBot:
+    """Bot that handles different steps of RAG
+
+        -llm: chat model to use instead of ChatOpenAI (e.g. fakes.FakeChatModel for offline testing)
+        -rate_limiter: shared RateLimiter for all llm calls
+        -concurrent: run retrieval + compression of all sections at the same time
+        -cache: response_cache.SemanticCache for the contexts of diagnoses seen before
+        -context_budget: max prompt tokens of the handout prompt; lowest ranked compressed docs are cut first
+        -diagnosis_matcher: diagnosis_dictionary.DiagnosisMatcher; the llm only extracts the diagnoses when it is not confident
+        -partitioned_search: search only the section partitions of each query (batch retrievers, chunks labelled at
+            ingestion by database_helper.tag_sections)
+    """
+    def __init__(self, retriever, templates, model: str = "gpt-3.5-turbo-1106", llm=None, rate_limiter=None, concurrent=True, cache=None, context_budget=context_token_budget, diagnosis_matcher=None, partitioned_search=False):
+        self._retriever = retriever
+        self._llm_gpt = llm or ChatOpenAI(model_name=model, temperature=0)
+        self._llm_compressor = self._llm_gpt.with_structured_output(CompressedDocs)
+        self._llm_diagnoses = self._llm_gpt.with_structured_output(Diagnoses)
+        self._llm_llama = Ollama(model="llama2:13b", temperature=0)
+        self._rate_limiter = rate_limiter or RateLimiter(requests_per_min, tokens_per_min)
+        self.concurrent = concurrent
+        self._cache = cache
+        self.context_budget = context_budget
+        self._diagnosis_matcher = diagnosis_matcher
+        self.partitioned_search = partitioned_search
+        self.templates = templates
+        self._queries = { # old queries
+            "definition": "definition of {diagnosis}",
+            "presentation": "manifestations of {diagnosis}",
+            "course": "natural history of {diagnosis}",
+            "management": "treatment and management for {diagnosis}",
+            "follow_up": "follow-up plan for {diagnosis}",
+            "redflags": "signs and symptoms that indicate the need to return to the emergency department for patients with {diagnosis}",
+        }
+        self.queries = {
+            "definition": "definition, description, and clinical criteria of {diagnosis}",
+            "presentation": "clinical presentation, signs, and symptoms of {diagnosis}",
+            "course": "natural history, progression, and stages of {diagnosis}",
+            "management": "treatment options, therapeutic interventions, and management strategies for {diagnosis}",
+            "follow_up": "follow-up plan and monitoring for {diagnosis}",
+            "redflags": "red flags, warning signs, and symptoms indicating need to return to emergency department for {diagnosis}",
+        }
+
+
+    def _call_llm(self, prompt, llm, inputs):
+        """formats the prompt, waits for the rate limiter then calls the llm"""
+        prompt_value = prompt.invoke(inputs)
+        self._rate_limiter.acquire(estimate_tokens(prompt_value.to_string()))
+        return llm.invoke(prompt_value, config={"callbacks": [token_usage_handler]})
+
+
+    def _map_sections(self, func, items):
+        """applies func to each (key, value) in items; concurrently if self.concurrent"""
+        if not self.concurrent:
+            return {k: func(v) for k, v in items.items()}
+
+        with ThreadPoolExecutor(max_workers=max(1, len(items))) as pool:
+            # copy_context keeps the trace/stage of the caller in the worker threads
+            futures = {k: pool.submit(contextvars.copy_context().run, func, v) for k, v in items.items()}
+            return {k: future.result() for k, future in futures.items()}
+
+
+    @traceable
+    def diagnoses_extraction(self, assessment):
+        """Extracts the list of diagnoses from physician's assessment of the patient"""
+        prompt_extract_diagnoses = ChatPromptTemplate.from_messages([
+            ("system",self.templates.extract_diagnoses_system),
+            ("human", "{assessment}")
+        ])
+
+        with stage("extract_diagnosis") as s:
+            local = self._diagnosis_matcher.extract(assessment) if self._diagnosis_matcher else None
+            s["local_hit"] = int(bool(local and local["confident"]))
+            if s["local_hit"]:
+                diagnoses = clean_diagnoses(local["diagnoses"])
+            else:
+                diagnoses = clean_diagnoses(self._call_llm(prompt_extract_diagnoses, self._llm_diagnoses, {"assessment":assessment}).diagnoses)
+            s["diagnoses"] = len(diagnoses)
+        return diagnoses
+
+
+    def diagnosis_extraction(self, assessment):
+        """Extracts the diagnoses from physician's assessment of the patient, as one string"""
+        return merge_diagnoses(self.diagnoses_extraction(assessment))
+
+
+    def make_queries(self, diagnosis):
+        """Uses the diagnosis to populate dict of queries that will be used to retreive context from db"""
+        return {key: value.format(diagnosis=diagnosis) for key, value in self.queries.items()}
+
+
+    @traceable(run_type="retriever")
+    def _retrieve_docs(self, query):
+        return self._retriever.invoke(query)
+
+
+    def get_contexts(self, queries):
+        """returns dict with tuples of (query, contexts); one batched search if the retriever supports it"""
+        with stage("retrieval") as s:
+            if hasattr(self._retriever, "batch_search"):
+                docs = self._retrieve_batch(queries)
+                contexts = {k: (query, docs[k]) for k, query in queries.items()}
+            else:
+                contexts = self._map_sections(lambda query: (query, self._retrieve_docs(query)), queries)
+            s["chunks"] = sum(len(q_c[1]) for q_c in contexts.values())
+
+        return contexts
+
+
+    @traceable(run_type="retriever")
+    def _retrieve_batch(self, queries):
+        if not self.partitioned_search:
+            return self._retriever.batch_search(queries)
+        # keys are (diagnosis, section) or section
+        sections = {key: key[1] if isinstance(key, tuple) else key for key in queries}
+        return self._retriever.batch_search(queries, sections=sections)
+
+
+    def compress_contexts(self, q_c):
+        """contextual compression with llm"""
+        prompt_compress = ChatPromptTemplate.from_messages([
+            ("system", self.templates.compress_context_system),
+            ("human", self.templates.compress_context_human)
+        ])
+
+        with stage("compression"):
+            return self._call_llm(prompt_compress, self._llm_compressor, {"query": q_c[0], "context": q_c[1]})
+
+
+    @traceable()
+    def retrieval_steps(self, assessment):
+        """all the steps to prep the contexts for final handout generation"""
+        diagnoses = self.diagnoses_extraction(assessment)
+        contexts = self.get_contexts(self.diagnosis_queries(diagnoses))
+
+        return {"contexts": self._by_section(contexts, diagnoses), "diagnosis": merge_diagnoses(diagnoses)}
+
+
+    def diagnosis_queries(self, diagnoses):
+        """dict of (diagnosis, section): query for every diagnosis"""
+        return {(diagnosis, k): query for diagnosis in diagnoses for k, query in self.make_queries(diagnosis).items()}
+
+
+    def _by_section(self, contexts, diagnoses):
+        """dict of (diagnosis, section): (query, docs) -> dict of section: (queries, docs) of all the diagnoses"""
+        return {
+            k: ("\n".join(contexts[(d, k)][0] for d in diagnoses), [doc for d in diagnoses for doc in contexts[(d, k)][1]])
+            for k in self.queries
+        }
+
+
+    def shared_compression(self, queries, contexts):
+        """compresses every unique chunk once (with the queries of all its sections) and fans the results out
+
+            -returns dict of section: CompressedDocs of the chunks the section retrieved (a shared chunk is in all its
+                sections, matched by the [id] of the rendered context, or by its text; compressed docs that match no
+                chunk of the call are dropped and logged)
+        """
+        section_docs = {k: q_c[1] for k, q_c in contexts.items()}
+        with stage("dedup") as s:
+            groups = dedup_sections(section_docs)
+            s.update(dedup_stats(section_docs, groups))
+
+        group_contexts = {i: (group_query(group, queries), render_docs(group["docs"])) for i, group in enumerate(groups)}
+        compressed = self._map_sections(self.compress_contexts, group_contexts)
+
+        ranks = {k: {chunk_key(doc): rank for rank, doc in reversed(list(enumerate(docs)))} for k, docs in section_docs.items()}
+        per_section = {k: [] for k in contexts} # (retrieval rank in the section, CompressedDoc)
+        rejected = []
+        for i, group in enumerate(groups):
+            for doc in compressed[i].contexts:
+                index = source_index(group["docs"], doc)
+                if index is None:
+                    rejected.append(doc.id)
+                    continue
+                doc = doc.copy(update={"id": index}) # copy: the validator would escape the context again
+                for section in group["doc_sections"][index]:
+                    per_section[section].append((ranks[section][chunk_key(group["docs"][index])], doc))
+        if rejected:
+            print(f"compression: dropped {len(rejected)} compressed docs with unknown ids {rejected}")
+
+        # best ranked first, as if the section was compressed alone
+        return {k: CompressedDocs(contexts=[doc for _, doc in sorted(docs, key=lambda rank_doc: rank_doc[0])]) for k, docs in per_section.items()}
+
+
+    @traceable()
+    def compression_steps(self, assessment):
+        """retrieval + compression of every section of every diagnosis (each unique chunk once); latency is bounded
+        by the slowest call when concurrent
+
+            -diagnoses (or near duplicates) in the cache are skipped
+            -by_diagnosis: dict of diagnosis: {"contexts", "compressed"} keyed by section; the full contexts of the
+                diagnosis, as if it was alone in the request (what is cached), shared chunks are in all of them
+            -contexts / compressed: the same, merged over the diagnoses
+        """
+        diagnoses = self.diagnoses_extraction(assessment)
+        by_diagnosis = {}
+        for diagnosis in diagnoses if self._cache else []:
+            with stage("context_cache") as s:
+                cached = self._cache.get(diagnosis)
+                s["cache_hit"] = cached is not None
+            if cached:
+                by_diagnosis[diagnosis] = cached
+
+        missing = [diagnosis for diagnosis in diagnoses if diagnosis not in by_diagnosis]
+        if missing:
+            queries = self.diagnosis_queries(missing)
+            contexts = self.get_contexts(queries)
+            compressed = self.shared_compression(queries, contexts)
+            for diagnosis in missing:
+                by_diagnosis[diagnosis] = {
+                    key: {k: values[(diagnosis, k)] for k in self.queries}
+                    for key, values in (("contexts", contexts), ("compressed", compressed))
+                }
+                if self._cache:
+                    self._cache.put(diagnosis, by_diagnosis[diagnosis])
+
+        by_diagnosis = {diagnosis: by_diagnosis[diagnosis] for diagnosis in diagnoses}
+        return {
+            "diagnosis": merge_diagnoses(diagnoses),
+            "diagnoses": diagnoses,
+            "by_diagnosis": by_diagnosis,
+            "contexts": self._by_section({(d, k): q_c for d, r in by_diagnosis.items() for k, q_c in r["contexts"].items()}, diagnoses),
+            "compressed": {
+                k: CompressedDocs(contexts=[doc for r in by_diagnosis.values() for doc in r["compressed"][k].contexts]) for k in self.queries
+            },
+        }
+
+
+    def prompt_contexts(self, by_diagnosis):
+        """dict of diagnosis: dict of section: CompressedDocs with every compressed chunk once (in its first diagnosis
+        and section), for the prompt of the request"""
+        kept = drop_repeats(
+            {(d, k): r["compressed"][k].contexts for d, r in by_diagnosis.items() for k in self.queries},
+            key = lambda doc: (doc.source, doc.context),
+        )
+        return {d: {k: CompressedDocs(contexts=kept[(d, k)]) for k in self.queries} for d in by_diagnosis}
+
+
+    def _handout_prompt(self):
+        return ChatPromptTemplate.from_messages([
+            ("system",self.templates.handout_generation_system),
+            ("human", self.templates.handout_generation_human),
+        ])
+
+
+    def assemble_contexts(self, by_diagnosis, md_plan):
+        """section contexts of all the diagnoses cut to the token budget
+
+            -by_diagnosis: dict of diagnosis: dict of section: CompressedDocs
+            -returns dict of section: dict of diagnosis: CompressedDocs
+            -the md plan, diagnoses and templates are always kept; every diagnosis x section gets a fair share
+        """
+        diagnoses = list(by_diagnosis)
+        contexts = {(d, k): v for d, sections in by_diagnosis.items() for k, v in sections.items()}
+        with stage("context_assembly", budget=self.context_budget) as s:
+            empty = {f"context_{k}": merge_section({d: "" for d in diagnoses}) for k in self.queries} # labels only
+            reserved = count_tokens(self._handout_prompt().invoke({**empty, "diagnosis": merge_diagnoses(diagnoses), "context_md_plan": md_plan}).to_string())
+            texts = {key: [doc.context for doc in v.contexts] for key, v in contexts.items()}
+            # the prompt has the repr of the docs: ids, sources and escaping count too
+            extra = {key: [count_tokens(str(doc)) - count_tokens(doc.context) for doc in v.contexts] for key, v in contexts.items()}
+            kept, cuts = fit_to_budget(texts, self.context_budget, reserved, extra_tokens=extra)
+            s.update(cut_stats(cuts))
+
+        # copy: the validator of CompressedDoc would escape the context again
+        return {
+            k: {d: CompressedDocs(contexts=[contexts[(d, k)].contexts[i].copy(update={"context": text}) for i, text in kept[(d, k)]]) for d in diagnoses}
+            for k in self.queries
+        }
+
+
+    @traceable()
+    def make_handout(self, assessment, md_plan):
+        with trace(), stage("request"):
+            return self._make_handout(assessment, md_plan)
+
+    def _make_handout(self, assessment, md_plan):
+        _run_input = self.compression_steps(assessment)
+        diagnosis = _run_input["diagnosis"]
+        contexts = self.assemble_contexts(self.prompt_contexts(_run_input["by_diagnosis"]), md_plan)
+        merged = {k: merge_section(v) for k, v in contexts.items()} # labelled by diagnosis when there are several
+
+        # make handout
+        with stage("generation"):
+            response = self._call_llm(self._handout_prompt(), self._llm_gpt, {
+            "diagnosis": diagnosis,
+            "context_definition": merged["definition"],
+            "context_presentation": merged["presentation"],
+            "context_course": merged["course"],
+            "context_management": merged["management"],
+            "context_follow_up": merged["follow_up"],
+            "context_redflags": merged["redflags"],
+            "context_md_plan": md_plan,
+        })
+
+        # Evaluators will expect "answer" and "contexts"
+        contexts_in_string = []
+        for by_diagnosis in contexts.values():
+            contexts_in_string.append("\n".join([doc.context for arr in by_diagnosis.values() for doc in arr.contexts]))
+        contexts_in_string = "\n\n".join(contexts_in_string) + "\n" + md_plan
+
+        return {
+            "diagnosis": diagnosis,
+            "contexts": contexts_in_string,
+            "handout": response.content
+        }
+
+    @traceable()
+    def compression(self, assessment):
+        return self.compression_steps(assessment)["compressed"]
@@ -0,0 +1,72 @@
+"""Rate limiter for LLM API calls
+- token bucket aware of both requests/min and tokens/min
+- replaces the fixed time.sleep(60) between calls
+- thread safe so the sections can share one limiter when they run concurrently
+"""
+
+import time
+import threading
+
+
+def estimate_tokens(text):
+    """rough token count (~4 characters per token), good enough for rate limiting"""
+    return max(1, len(str(text)) // 4)
+
+
+class TokenBucket:
+    """bucket with capacity units that refills continuously over period seconds"""
+    def __init__(self, capacity, period=60.0):
+        self.capacity = float(capacity)
+        self.rate = self.capacity / period
+        self._level = self.capacity
+        self._last = time.monotonic()
+
+    def _refill(self, now):
+        self._level = min(self.capacity, self._level + (now - self._last) * self.rate)
+        self._last = now
+
+    def wait_time(self, amount, now):
+        """seconds until amount units are available (0 if available now)"""
+        self._refill(now)
+        amount = min(amount, self.capacity) # a request larger than the bucket only waits for a full bucket
+        if self._level >= amount:
+            return 0.0
+        return (amount - self._level) / self.rate
+
+    def take(self, amount):
+        self._level -= min(amount, self.capacity)
+
+
+class RateLimiter:
+    """blocks callers until both the requests/min and tokens/min budgets allow the call
+
+        -requests_per_min or tokens_per_min can be None to disable that limit
+        -period: seconds the budgets are for (60; shorter in checks that cannot wait minutes)
+    """
+    def __init__(self, requests_per_min=None, tokens_per_min=None, period=60.0):
+        self._requests = TokenBucket(requests_per_min, period) if requests_per_min else None
+        self._tokens = TokenBucket(tokens_per_min, period) if tokens_per_min else None
+        self._lock = threading.Lock() # callers are served in the order they acquire the lock
+
+    def acquire(self, tokens=1):
+        """wait until a request using tokens can be sent; returns the seconds spent waiting"""
+        waited = 0.0
+        with self._lock:
+            while True:
+                now = time.monotonic()
+                wait = 0.0
+                if self._requests:
+                    wait = max(wait, self._requests.wait_time(1, now))
+                if self._tokens:
+                    wait = max(wait, self._tokens.wait_time(tokens, now))
+                if wait <= 0:
+                    break
+                time.sleep(wait)
+                waited += wait
+
+            if self._requests:
+                self._requests.take(1)
+            if self._tokens:
+                self._tokens.take(tokens)
+
+        return waited
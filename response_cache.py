@@ -0,0 +1,135 @@
+"""Cache of diagnosis-level results (compressed section contexts)
+- keyed on the normalized diagnosis; with an embedding function, near-duplicate diagnoses are matched by embedding
+    similarity, unless their qualifiers conflict (qualifier_conflicts): viral vs bacterial pharyngitis or type 1 vs
+    type 2 diabetes embed close to each other and must not share contexts
+- LRU + TTL eviction
+- the whole cache is dropped when the corpus version changes (chunks added to / deleted from the collection)
+"""
+
+import re
+import time
+import threading
+from collections import OrderedDict
+import numpy as np
+
+
+def normalize_diagnosis(diagnosis):
+    """lower case, no punctuation, single spaces"""
+    diagnosis = getattr(diagnosis, "content", diagnosis) # AIMessage from the extraction chain
+    return " ".join(re.sub(r"[^\w\s]", " ", str(diagnosis).lower()).split())
+
+
+# alternatives of a qualifier; two diagnoses naming different alternatives are different diagnoses
+qualifier_conflicts = [
+    ("viral", "bacterial"),
+    ("type 1", "type 2"),
+    ("acute", "chronic"),
+    ("left", "right"),
+]
+_qualifiers = [[(q, re.compile(rf"\b{q}\b")) for q in alternatives] for alternatives in qualifier_conflicts]
+
+
+def conflicting(a, b):
+    """normalized diagnoses a and b name different alternatives of a qualifier (a diagnosis without the qualifier
+    conflicts with none)"""
+    for alternatives in _qualifiers:
+        in_a = {q for q, pattern in alternatives if pattern.search(a)}
+        in_b = {q for q, pattern in alternatives if pattern.search(b)}
+        if in_a and in_b and in_a != in_b:
+            return True
+    return False
+
+
+class SemanticCache:
+    """LRU/TTL cache keyed on the diagnosis
+
+        -emb_func: embeds the diagnosis to match near duplicates (None for exact matches only)
+        -threshold: min cosine similarity for a near duplicate to count as a hit; a near duplicate whose qualifiers
+            conflict (conflicting) is never a hit
+        -max_size: num of diagnoses kept (least recently used is evicted)
+        -ttl: seconds an entry is valid (None for no expiry)
+        -version_func: returns the current corpus version; the cache is cleared when it changes
+    """
+    def __init__(self, emb_func=None, threshold=0.9, max_size=256, ttl=24*3600, version_func=None):
+        self._emb_func = emb_func
+        self.threshold = threshold
+        self.max_size = max_size
+        self.ttl = ttl
+        self._version_func = version_func
+        self._version = version_func() if version_func else None
+        self._entries = OrderedDict() # normalized diagnosis: (value, vector, created)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+
+    def _embed(self, key):
+        if self._emb_func is None:
+            return None
+        vector = np.asarray(self._emb_func.embed_query(key), dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def _check_version(self):
+        if self._version_func is None:
+            return
+        version = self._version_func()
+        if version != self._version:
+            self._entries.clear()
+            self._version = version
+
+    def _evict_expired(self, now):
+        if self.ttl is None:
+            return
+        for key in [k for k, (_, _, created) in self._entries.items() if now - created > self.ttl]:
+            del self._entries[key]
+
+    def get(self, diagnosis):
+        """cached value for the diagnosis (or a near duplicate of it), None if not cached"""
+        key = normalize_diagnosis(diagnosis)
+        with self._lock:
+            self._check_version()
+            self._evict_expired(time.time())
+
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key][0]
+
+            candidates = [(k, vector) for k, (_, vector, _) in self._entries.items() if vector is not None]
+
+        vector = self._embed(key) if candidates else None # embed outside the lock
+        if vector is not None:
+            keys, vectors = zip(*candidates)
+            similarities = np.stack(vectors) @ vector
+            for best in np.argsort(-similarities):
+                if similarities[best] < self.threshold:
+                    break
+                if conflicting(key, keys[best]):
+                    continue
+                with self._lock:
+                    if keys[best] in self._entries:
+                        self._entries.move_to_end(keys[best])
+                        self.hits += 1
+                        self.semantic_hits += 1
+                        return self._entries[keys[best]][0]
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, diagnosis, value):
+        key = normalize_diagnosis(diagnosis)
+        vector = self._embed(key)
+        with self._lock:
+            self._check_version()
+            self._entries[key] = (value, vector, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {"size": len(self._entries), "hits": self.hits, "semantic_hits": self.semantic_hits, "misses": self.misses}
@@ -0,0 +1,144 @@
+"""Batched retrieval from the vector database
+- all the queries of a diagnosis are embedded in one embed_documents forward pass
+- one multi-query search against the chroma collection instead of one search per query
+- returns the same docs as db.as_retriever(search_type="similarity", search_kwargs={"k":k})
+- IndexRetriever searches an in-memory export of the collection (vector_index.py) instead of chroma
+- HybridRetriever fuses the dense results with bm25 results (lexical_index.py) by reciprocal rank fusion
+- batch_search(queries, sections): the query of a section only searches the section partitions that can answer it
+    (section_partitions.py); one search per section type instead of one for all the queries
+"""
+
+from langchain_core.documents import Document
+from instrumentation import stage
+from section_partitions import search_partitions, partition_where
+
+
+def _groups(num, sections):
+    """dict of section type (None: no partition) -> positions of the queries of that type"""
+    groups = {}
+    for i, section in enumerate(sections or [None] * num):
+        groups.setdefault(section if section in search_partitions else None, []).append(i)
+    return groups
+
+
+class BatchRetriever:
+    """retriever that searches many queries at once
+
+        -db: Chroma vector store
+        -emb_func: embedding function used to build the collection (e.g. hf_embed)
+        -invoke(query) keeps the single query interface of db.as_retriever()
+    """
+    def __init__(self, db, emb_func, k=4):
+        self._db = db
+        self._emb_func = emb_func
+        self.k = k
+
+    def embed_queries(self, queries):
+        """embeds all queries in one forward pass; adds the query instruction like embed_query does"""
+        instruction = getattr(self._emb_func, "query_instruction", "")
+        with stage("embed_queries", queries=len(queries)):
+            return self._emb_func.embed_documents([instruction + query.replace("\n", " ") for query in queries])
+
+    def search_by_vectors(self, vectors, k=None, sections=None):
+        """one multi-query similarity search per section type (sections: one per vector, None for all the
+        partitions); returns a list of docs for each vector"""
+        docs = [None] * len(vectors)
+        with stage("vector_search") as s:
+            for section, positions in _groups(len(vectors), sections).items():
+                for i, found in zip(positions, self._search([vectors[i] for i in positions], k or self.k, section)):
+                    docs[i] = found
+            s["chunks"] = sum(map(len, docs))
+        return docs
+
+    def _search(self, vectors, k, section):
+        results = self._db._collection.query(
+            query_embeddings = vectors,
+            n_results = k,
+            where = partition_where(section) if section else None,
+            include = ["documents", "metadatas", "distances"],
+        )
+        return [
+            [Document(page_content=text, metadata=metadata or {}) for text, metadata in zip(texts, metadatas)]
+            for texts, metadatas in zip(results["documents"], results["metadatas"])
+        ]
+
+    def batch_search(self, queries, sections=None):
+        """dict of key: query -> dict of key: list of docs
+
+            -sections: dict of key: section type of the query (keys without one search every partition)
+        """
+        keys = list(queries)
+        vectors = self.embed_queries([queries[key] for key in keys])
+        docs = self.search_by_vectors(vectors, sections=[sections.get(key) for key in keys] if sections else None)
+
+        return dict(zip(keys, docs))
+
+    def invoke(self, query, config=None):
+        return self.batch_search({"query": query})["query"]
+
+
+class IndexRetriever(BatchRetriever):
+    """BatchRetriever that searches a vector_index.ExactIndex / HNSWIndex instead of the chroma collection
+
+        -index: e.g. vector_index.open_index("./resources/index_wiki", mode="exact")
+        -emb_func: embedding function the collection was built with
+    """
+    def __init__(self, index, emb_func, k=4):
+        super().__init__(None, emb_func, k)
+        self._index = index
+
+    def _search(self, vectors, k, section):
+        indices, _ = self._index.search(vectors, k, search_partitions[section] if section else None)
+        return [
+            [Document(page_content=self._index.texts[i], metadata=self._index.metadatas[i]) for i in row]
+            for row in indices.tolist()
+        ]
+
+
+def _doc_key(doc):
+    return doc.metadata.get("source"), doc.page_content
+
+
+def reciprocal_rank_fusion(rankings, k, rrf_k=60):
+    """top k docs of several rankings (lists of docs, best first) by sum of 1 / (rrf_k + rank)"""
+    scores, docs = {}, {}
+    for ranking in rankings:
+        for rank, doc in enumerate(ranking):
+            key = _doc_key(doc)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (rrf_k + rank + 1)
+            docs.setdefault(key, doc)
+    return [docs[key] for key in sorted(scores, key=scores.get, reverse=True)[:k]]
+
+
+class HybridRetriever:
+    """dense + bm25 retrieval fused by reciprocal rank fusion
+
+        -dense: BatchRetriever or IndexRetriever
+        -lexical: lexical_index.BM25Index of the same chunks
+        -candidates: num of docs taken from each retriever before fusing (k docs are returned)
+        -rrf_k: rank constant of the fusion (higher: lower ranks count more)
+    """
+    def __init__(self, dense, lexical, k=4, candidates=20, rrf_k=60):
+        self._dense = dense
+        self._lexical = lexical
+        self.k = k
+        self.candidates = candidates
+        self.rrf_k = rrf_k
+
+    def batch_search(self, queries, sections=None):
+        """dict of key: query -> dict of key: list of docs; sections: like BatchRetriever.batch_search"""
+        keys = list(queries)
+        texts = [queries[key] for key in keys]
+        types = [sections.get(key) for key in keys] if sections else [None] * len(keys)
+        dense = self._dense.search_by_vectors(self._dense.embed_queries(texts), k=self.candidates, sections=types)
+        with stage("lexical_search") as s:
+            lexical = [
+                self._lexical.search(text, self.candidates, search_partitions.get(section))
+                for text, section in zip(texts, types)
+            ]
+            s["chunks"] = sum(len(docs) for docs in lexical)
+
+        return {key: reciprocal_rank_fusion([d, l], self.k, self.rrf_k) for key, d, l in zip(keys, dense, lexical)}
+
+    def invoke(self, query, config=None):
+        return self.batch_search({"query": query})["query"]
@@ -0,0 +1,95 @@
+"""De-duplication of retrieved chunks across the sections of a handout (between retrieval and compression)
+- the section queries all target the same diagnosis, so they often retrieve the same chunks
+- every unique chunk (same source + content hash) is compressed once: it goes in the compressor call of the first
+    section that retrieved it, and that call also gets the queries of the other sections the chunk serves
+- at most one compressor call per section (fewer when all the chunks of a section were already taken)
+- gather gives every section the results of all the calls that compressed its chunks: its full context, the same as
+    if it had been retrieved alone (this is what is cached per diagnosis)
+- drop_repeats removes the chunks already in an earlier section when the prompt of a request is assembled, so the
+    final prompt has no repeated chunks
+- the chunks of a call are rendered with an [id] marker (render_docs); a compressed doc is mapped back to its chunk by
+    that id, or by its text when the id is not one of the call (source_index)
+"""
+
+import json
+from embedding_cache import content_hash
+
+
+def chunk_key(doc):
+    return doc.metadata.get("source"), content_hash(doc.page_content)
+
+
+def dedup_sections(section_docs):
+    """dict of section: docs -> list of groups, one per compressor call
+
+        group: {"section": section of the call, "sections": all the sections its chunks serve (call section first),
+                "docs": unique chunks, "doc_sections": sections served by each chunk}
+        -sections and docs keep the order of section_docs and of the retrieval ranking
+    """
+    served = {} # chunk key: (doc, sections)
+    for section, docs in section_docs.items():
+        for doc in docs:
+            _, sections = served.setdefault(chunk_key(doc), (doc, []))
+            if section not in sections:
+                sections.append(section)
+
+    groups = {}
+    for doc, sections in served.values():
+        group = groups.setdefault(sections[0], {"section": sections[0], "sections": [sections[0]], "docs": [], "doc_sections": []})
+        group["docs"].append(doc)
+        group["doc_sections"].append(sections)
+        group["sections"].extend(s for s in sections if s not in group["sections"])
+    return list(groups.values())
+
+
+def group_query(group, queries):
+    """the query of the call section, followed by the queries of the other sections its chunks serve, one per line"""
+    if len(group["sections"]) == 1:
+        return queries[group["section"]]
+    return "\n".join(f"- {queries[section]}" for section in group["sections"])
+
+
+def render_docs(docs):
+    """context of a compressor call: every chunk preceded by its [id], its position in the call"""
+    return "\n\n".join(f"[{i}] {doc!r}" for i, doc in enumerate(docs))
+
+
+def source_index(docs, compressed):
+    """position in docs of the chunk a CompressedDoc was extracted from: its id when it is one of docs, else the only
+    chunk that contains its text; None when neither (the llm made the id up)"""
+    if 0 <= compressed.id < len(docs):
+        return compressed.id
+    try:
+        text = json.loads(f'"{compressed.context}"').strip() # the context is json escaped by CompressedDoc
+    except ValueError:
+        text = compressed.context.strip()
+    matches = [i for i, doc in enumerate(docs) if text and text in doc.page_content]
+    return matches[0] if len(matches) == 1 else None
+
+
+def gather(groups, results, sections):
+    """dict of section: results of the calls that compressed a chunk the section retrieved (results: one per group,
+    same order)"""
+    gathered = {section: [] for section in sections}
+    for group, result in zip(groups, results):
+        for section in group["sections"]:
+            gathered[section].append(result)
+    return gathered
+
+
+def drop_repeats(contexts, key=lambda item: item):
+    """dict of section: items without the items (same key) already in an earlier section, in the order of contexts"""
+    seen, kept = set(), {}
+    for section, items in contexts.items():
+        kept[section] = []
+        for item in items:
+            if key(item) not in seen:
+                seen.add(key(item))
+                kept[section].append(item)
+    return kept
+
+
+def dedup_stats(section_docs, groups):
+    retrieved = sum(len(docs) for docs in section_docs.values())
+    unique = sum(len(group["docs"]) for group in groups)
+    return {"chunks": retrieved, "unique_chunks": unique, "duplicates": retrieved - unique, "calls": len(groups)}
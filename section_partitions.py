@@ -0,0 +1,60 @@
+"""Section partitions of the collection: every chunk is labelled at ingestion with the kind of section it is from
+- the label comes from the header path of the chunk (Header2 > Header3 > Header4 metadata of
+    database_helper.split_md_document), most specific header first
+- labels: the six sections of the handout (definition, presentation, course, management, follow_up, redflags),
+    general (no header / not recognised: searched by every query) and other (history, society and culture, ...:
+    searched by none)
+- each section query searches only the partitions that can answer it (search_partitions), e.g. redflags searches
+    redflags (warning signs, complications), presentation and course chunks but not definitions
+- chroma: where filter on the section metadata; exported indexes (vector_index.py): contiguous row ranges
+"""
+
+import re
+
+title_key = "Title"
+header_keys = ["Header4", "Header3", "Header2"] # most specific first
+general = "general"
+other = "other"
+
+# first match wins, so the more specific kinds come first (e.g. "signs of complications" is redflags)
+section_keywords = [
+    ("redflags", r"red flag|warning sign|when to (?:seek|see|call|go|return)|emergenc|complication|danger sign"),
+    ("follow_up", r"follow.?up|monitoring|prevention|preventi|screening|outlook|recovery|aftercare|home care|self.?care|living with"),
+    ("management", r"treatment|management|therap|medication|drug|surgery|surgical|procedure|vaccin|antibiotic|care\b"),
+    ("course", r"prognosis|course|natural history|progression|stage|outcome|duration|mortality"),
+    ("presentation", r"sign|symptom|presentation|clinical feature|manifestation|diagnos|examination|investigation|test|imaging"),
+    ("definition", r"introduction|summary|definition|classification|type|overview|description|terminology|cause|etiology|aetiology|pathophysiology|pathogenesis|mechanism|risk factor"),
+    (other, r"history|society|culture|etymology|research|epidemiology|economic|see also|reference|external link|further reading|animals|notable"),
+]
+_patterns = [(label, re.compile(pattern, re.IGNORECASE)) for label, pattern in section_keywords]
+
+sections = ["definition", "presentation", "course", "management", "follow_up", "redflags"]
+labels = sections + [general, other]
+
+# partitions searched by the query of each section (general: chunks that could be about anything)
+search_partitions = {
+    "definition": ["definition", general],
+    "presentation": ["presentation", "redflags", general],
+    "course": ["course", "redflags", general],
+    "management": ["management", "follow_up", general],
+    "follow_up": ["follow_up", "management", "course", general],
+    "redflags": ["redflags", "presentation", "course", general],
+}
+
+
+def classify_section(metadata):
+    """section label of a chunk from its header path; the intro of a page (title only, or the ## Introduction that
+    preprocess_wiki adds) is a definition"""
+    headers = [metadata[key] for key in header_keys if metadata.get(key)]
+    if not headers:
+        return "definition" if metadata.get(title_key) else general
+    for header in headers:
+        for label, pattern in _patterns:
+            if pattern.search(header):
+                return label
+    return general
+
+
+def partition_where(section):
+    """chroma where filter of the partitions searched by the query of section"""
+    return {"section": {"$in": search_partitions[section]}}
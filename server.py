@@ -0,0 +1,305 @@
+"""Serving layer: HTTP API + gradio UI in front of main.generate_stream
+- bounded request queue: at most workers requests run at once and queue_size more wait; anything beyond that gets
+    an immediate 429 (Retry-After) instead of piling up
+- per request timeout (queue wait included): 504, and the pipeline of the request is stopped at its next event
+- query embeddings of concurrent requests are micro-batched: calls arriving within batch_window seconds of each
+    other share one hf_embed.embed_documents call (one forward pass)
+- the gradio UI (/ui) goes through the same queue as the API
+
+endpoints:
+- POST /generate {"assessment", "plan"} -> {"diagnosis", "handout"}
+- POST /generate/stream -> the generate_stream events as json lines
+- GET /health (queue state), GET /metrics (prometheus, instrumentation.py)
+
+run from the repo root: python server.py [--port 7860] [--workers 4] [--queue-size 16] [--timeout 120]
+load test with the fake llm: python -m benchmarks.server
+"""
+
+import os
+import json
+import time
+import asyncio
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from langchain_core.embeddings import Embeddings
+from instrumentation import metrics
+from multi_diagnosis import no_diagnosis_message
+
+server_workers = int(os.getenv("RAG_SERVER_WORKERS", "4")) # requests running at once
+server_queue_size = int(os.getenv("RAG_SERVER_QUEUE_SIZE", "16")) # requests waiting for a worker
+request_timeout = float(os.getenv("RAG_REQUEST_TIMEOUT", "120")) # seconds, queue wait included
+embed_batch_window = float(os.getenv("RAG_EMBED_BATCH_WINDOW_MS", "5")) / 1000 # seconds
+
+
+class MicroBatchEmbeddings(Embeddings):
+    """embedding function that merges the calls of concurrent threads into one emb_func.embed_documents call
+
+        -the first caller waits window seconds for others to join, then embeds all their texts at once
+        -a batch is closed early when it reaches max_batch texts
+        -calls / texts: num of emb_func calls and of texts embedded, to see how much batching happened
+    """
+    def __init__(self, emb_func, window=embed_batch_window, max_batch=256):
+        self.emb_func = emb_func
+        self.window = window
+        self.max_batch = max_batch
+        self.model_name = getattr(emb_func, "model_name", type(emb_func).__name__)
+        self.query_instruction = getattr(emb_func, "query_instruction", "")
+        self.calls = 0
+        self.texts = 0
+        self._lock = threading.Lock()
+        self._pending = None # batch collecting texts: {"texts", "done", "vectors", "error"}
+
+    def embed_documents(self, texts):
+        if not texts:
+            return []
+
+        with self._lock:
+            batch = self._pending
+            leader = batch is None or len(batch["texts"]) + len(texts) > self.max_batch
+            if leader:
+                batch = self._pending = {"texts": [], "done": threading.Event(), "vectors": None, "error": None}
+            start = len(batch["texts"])
+            batch["texts"].extend(texts)
+
+        if leader:
+            time.sleep(self.window)
+            with self._lock:
+                if self._pending is batch:
+                    self._pending = None
+                self.calls += 1
+                self.texts += len(batch["texts"])
+            try:
+                batch["vectors"] = self.emb_func.embed_documents(batch["texts"])
+            except Exception as e:
+                batch["error"] = e
+            finally:
+                batch["done"].set()
+        else:
+            batch["done"].wait()
+
+        if batch["error"] is not None:
+            raise batch["error"]
+        return batch["vectors"][start:start + len(texts)]
+
+    def embed_query(self, text):
+        """same as the query embedding of HuggingFaceBgeEmbeddings: instruction + text, batched like documents"""
+        return self.embed_documents([self.query_instruction + text.replace("\n", " ")])[0]
+
+
+class Overloaded(Exception):
+    """all workers are busy and the queue is full (HTTP 429)"""
+
+
+class Job:
+    """one queued request; the worker thread hands its events to the event loop that submitted it"""
+    def __init__(self, loop, timeout):
+        self.submitted = time.monotonic()
+        self.deadline = self.submitted + timeout
+        self.cancelled = False # set when the request timed out or the client went away; the worker stops
+        self._loop = loop
+        self._events = asyncio.Queue()
+
+    def put(self, event):
+        self._loop.call_soon_threadsafe(self._events.put_nowait, event)
+
+    async def events(self):
+        """the generate_stream events; raises TimeoutError at the deadline"""
+        try:
+            while True:
+                try:
+                    event = await asyncio.wait_for(self._events.get(), max(self.deadline - time.monotonic(), 0))
+                except asyncio.TimeoutError:
+                    raise TimeoutError("request timed out")
+                if event is None:
+                    return
+                if event["stage"] == "error":
+                    raise RuntimeError(event["error"])
+                yield event
+        finally:
+            self.cancelled = True
+
+    async def result(self):
+        """{"diagnosis", "handout"}, and a "detail" message when the handout is the generic one (no diagnosis found)"""
+        result = {"diagnosis": None, "handout": ""}
+        async for event in self.events():
+            if event["stage"] == "diagnosis":
+                result["diagnosis"] = event["diagnosis"]
+                if not event["diagnoses"]:
+                    result["detail"] = no_diagnosis_message
+            elif event["stage"] == "handout":
+                result["handout"] = event["text"]
+        return result
+
+
+class RequestQueue:
+    """runs stream_func(assessment, plan) on workers threads with at most queue_size requests waiting
+
+        -submit raises Overloaded right away when there is no room
+        -counters: accepted, rejected, timed_out, cancelled (client went away), failed, completed
+    """
+    def __init__(self, stream_func, workers=server_workers, queue_size=server_queue_size, timeout=request_timeout):
+        self._stream_func = stream_func
+        self.workers = workers
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self._pool = ThreadPoolExecutor(workers, thread_name_prefix="rag-worker")
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+        self._lock = threading.Lock()
+        self.running = 0
+        self.counts = {"accepted": 0, "rejected": 0, "timed_out": 0, "cancelled": 0, "failed": 0, "completed": 0}
+
+    def _count(self, name):
+        with self._lock:
+            self.counts[name] += 1
+        metrics.inc(name, "server")
+
+    def submit(self, assessment, plan):
+        """queues a request (call from the event loop that will read the events)"""
+        if not self._slots.acquire(blocking=False):
+            self._count("rejected")
+            raise Overloaded(f"{self.workers} requests running and {self.queue_size} waiting")
+        self._count("accepted")
+        job = Job(asyncio.get_running_loop(), self.timeout)
+        self._pool.submit(self._run, job, assessment, plan)
+        return job
+
+    def _stopped(self, job):
+        if time.monotonic() > job.deadline:
+            self._count("timed_out")
+        elif job.cancelled:
+            self._count("cancelled")
+        else:
+            return False
+        return True
+
+    def _run(self, job, assessment, plan):
+        metrics.observe("queue_wait", time.monotonic() - job.submitted)
+        with self._lock:
+            self.running += 1
+        try:
+            if self._stopped(job): # timed out while waiting, skip the work
+                return
+            for event in self._stream_func(assessment, plan):
+                job.put(event)
+                if self._stopped(job):
+                    return # closes the generator, which stops the pipeline of the request
+            self._count("completed")
+        except Exception as e:
+            self._count("failed")
+            job.put({"stage": "error", "error": f"{type(e).__name__}: {e}"})
+        finally:
+            job.put(None)
+            with self._lock:
+                self.running -= 1
+            self._slots.release()
+
+    def state(self):
+        with self._lock:
+            waiting = self.counts["accepted"] - sum(self.counts[k] for k in ("timed_out", "cancelled", "failed", "completed")) - self.running
+            return {"workers": self.workers, "queue_size": self.queue_size, "running": self.running,
+                    "waiting": max(waiting, 0), **self.counts}
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+def create_app(requests, ui=True):
+    """fastapi app with the API (and the gradio UI at /ui) in front of the request queue"""
+    from fastapi import FastAPI, Request
+    from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse
+    from pydantic import BaseModel
+
+    class HandoutRequest(BaseModel):
+        assessment: str
+        plan: str = ""
+
+    app = FastAPI(title="Discharge Instruction Generator")
+
+    @app.exception_handler(Overloaded)
+    async def overloaded(request: Request, e: Overloaded):
+        return JSONResponse({"detail": f"server busy: {e}"}, status_code=429, headers={"Retry-After": "1"})
+
+    @app.post("/generate")
+    async def generate(body: HandoutRequest):
+        job = requests.submit(body.assessment, body.plan)
+        try:
+            return await job.result()
+        except TimeoutError as e:
+            return JSONResponse({"detail": str(e)}, status_code=504)
+        except RuntimeError as e:
+            return JSONResponse({"detail": str(e)}, status_code=500)
+
+    @app.post("/generate/stream")
+    async def generate_stream(body: HandoutRequest):
+        job = requests.submit(body.assessment, body.plan) # before the response starts, so a 429 can still be sent
+
+        async def lines():
+            try:
+                async for event in job.events():
+                    yield json.dumps(event) + "\n"
+            except (TimeoutError, RuntimeError) as e:
+                yield json.dumps({"stage": "error", "error": str(e)}) + "\n"
+
+        return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+    @app.get("/health")
+    async def health():
+        return requests.state()
+
+    @app.get("/metrics")
+    async def prometheus():
+        return PlainTextResponse(metrics.to_prometheus())
+
+    if ui:
+        import gradio as gr
+        from main import build_demo, ui_update
+
+        async def stream_to_ui(assessment, plan):
+            try:
+                job = requests.submit(assessment, plan)
+            except Overloaded:
+                raise gr.Error("The server is busy, please try again in a moment.")
+            status, handout = [], ""
+            try:
+                async for event in job.events():
+                    progress, handout = ui_update(status, event)
+                    yield progress, handout
+            except (TimeoutError, RuntimeError) as e:
+                raise gr.Error(str(e))
+            yield "\n".join(status + ["done"]), handout
+
+        app = gr.mount_gradio_app(app, build_demo(stream_to_ui), path="/ui")
+
+    return app
+
+
+def micro_batch_embeddings(window=embed_batch_window):
+    """routes every hf_embed call (retrieval, context cache) through one MicroBatchEmbeddings"""
+    from _global import get_hf_embed, set_singleton
+    emb_func = get_hf_embed()
+    if not isinstance(emb_func, MicroBatchEmbeddings):
+        emb_func = MicroBatchEmbeddings(emb_func, window)
+        set_singleton(get_hf_embed, emb_func)
+    return emb_func
+
+
+if __name__ == "__main__":
+    import uvicorn
+    import main
+
+    args = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    args.add_argument("--host", default="127.0.0.1")
+    args.add_argument("--port", type=int, default=7860)
+    args.add_argument("--workers", type=int, default=server_workers)
+    args.add_argument("--queue-size", type=int, default=server_queue_size)
+    args.add_argument("--timeout", type=float, default=request_timeout)
+    args.add_argument("--batch-window-ms", type=float, default=embed_batch_window * 1000)
+    args.add_argument("--no-ui", action="store_true")
+    args = args.parse_args()
+
+    micro_batch_embeddings(args.batch_window_ms / 1000)
+    main.warm_up()
+    requests = RequestQueue(main.generate_stream, args.workers, args.queue_size, args.timeout)
+    print(f"serving on http://{args.host}:{args.port} ({args.workers} workers, queue of {args.queue_size})" + ("" if args.no_ui else ", UI at /ui"))
+    uvicorn.run(create_app(requests, ui=not args.no_ui), host=args.host, port=args.port)
@@ -0,0 +1,223 @@
+"""Single-file snapshot of main_collection for serving nodes: open in milliseconds, no chroma store or resources needed
+- one file: magic, json header (format version, model name, corpus version, section partitions, array layout), then
+    64-byte aligned raw arrays: float32 vectors, their squared norms, and the ids / texts / metadatas as utf-8 blobs
+    with uint64 offsets
+- the indexes main otherwise reads from db_directory are built from the same rows and stored in the file too: the bm25
+    postings (lexical_index.py) and the diagnosis dictionary (diagnosis_dictionary.py), so they always have the corpus
+    version of the vectors; the section labels are the partitions of the header
+- rows in the order of a vector_index export (grouped by section partition)
+- SnapshotIndex memory-maps the file read-only: the vectors are searched in place (zero copy) and texts / metadatas
+    are decoded when a result is read, so opening does not depend on the corpus size and every worker of a node
+    shares the same pages of the os page cache
+- import_snapshot rebuilds a chroma collection (with its bm25 index, diagnosis dictionary and section labels) from a
+    snapshot, for nodes that ingest
+
+from the repo root:
+    python snapshot.py export [--db-dir ./resources/db_wiki] [--out ./resources/wiki.snapshot]
+    python snapshot.py import [--snapshot ./resources/wiki.snapshot] [--db-dir ./resources/db_wiki]
+"""
+
+import os
+import json
+import struct
+import tempfile
+import argparse
+import numpy as np
+from vector_index import ExactIndex, export_collection, load_meta, load_docs
+from lexical_index import BM25Index
+from diagnosis_dictionary import DiagnosisMatcher
+
+magic = b"RAGSNAP\0"
+format_version = 2
+alignment = 64
+
+
+class SnapshotVersionError(ValueError):
+    pass
+
+
+def _align(offset):
+    return -(-offset // alignment) * alignment
+
+
+def _blob(items):
+    """(uint64 offsets, bytes) of utf-8 encoded items"""
+    encoded = [item.encode() for item in items]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.uint64)
+    np.cumsum([len(e) for e in encoded], out=offsets[1:])
+    return offsets, b"".join(encoded)
+
+
+def write_snapshot(index_dir, path, batch_size=8192):
+    """packs a vector_index export (directory) into the snapshot file path"""
+    meta = load_meta(index_dir)
+    ids, texts, metadatas = load_docs(index_dir)
+    vectors = np.load(os.path.join(index_dir, "vectors.npy"), mmap_mode="r")
+
+    lexical = BM25Index.build(texts, metadatas)
+    terms = sorted(lexical.terms, key=lexical.terms.get)
+    matcher = DiagnosisMatcher.build(zip(texts, metadatas))
+
+    arrays = {"vectors": (np.dtype(np.float32), (meta["count"], meta["dim"])), "sq_norms": (np.dtype(np.float32), (meta["count"],))}
+    blobs = {
+        "bm25_terms": np.frombuffer("\n".join(terms).encode(), dtype=np.uint8), # tokens are \w+, never a newline
+        "bm25_offsets": lexical.offsets,
+        "bm25_docs": lexical.docs,
+        "bm25_weights": lexical.weights,
+        "diagnoses": np.frombuffer(json.dumps(matcher.names).encode(), dtype=np.uint8),
+    }
+    for name, items in [("ids", ids), ("texts", texts), ("metadatas", map(json.dumps, metadatas))]:
+        offsets, data = _blob(items)
+        blobs[f"{name}_offsets"], blobs[name] = offsets, np.frombuffer(data, dtype=np.uint8)
+    arrays.update((name, (array.dtype, array.shape)) for name, array in blobs.items())
+
+    layout, end = {}, 0
+    for name, (dtype, shape) in arrays.items():
+        layout[name] = {"offset": end, "dtype": dtype.str, "shape": list(shape)}
+        end = _align(end + dtype.itemsize * int(np.prod(shape)))
+    header = json.dumps({
+        "format_version": format_version,
+        "count": meta["count"],
+        "dim": meta["dim"],
+        "model_name": meta["model_name"],
+        "corpus_version": meta["corpus_version"],
+        "space": meta["space"],
+        "partitions": meta.get("partitions", {}),
+        "bm25": {"k1": lexical.k1, "b": lexical.b},
+        "arrays": layout, # offsets from the start of the data (end of the header, aligned)
+    }).encode()
+    data_start = _align(len(magic) + 8 + len(header))
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(magic + struct.pack("<Q", len(header)) + header)
+        for name in arrays:
+            f.seek(data_start + layout[name]["offset"])
+            if name == "vectors":
+                for start in range(0, len(vectors), batch_size): # the vectors may not fit in memory
+                    f.write(np.ascontiguousarray(vectors[start:start + batch_size]).tobytes())
+            elif name == "sq_norms":
+                for start in range(0, len(vectors), batch_size):
+                    block = np.asarray(vectors[start:start + batch_size])
+                    f.write(np.einsum("ij,ij->i", block, block).astype(np.float32).tobytes())
+            else:
+                f.write(blobs[name].tobytes())
+        f.truncate(data_start + end)
+    os.replace(tmp_path, path) # dont leave a half written snapshot if interrupted
+    return meta["count"]
+
+
+def export_snapshot(db, path, model_name=None, corpus_version=None):
+    """snapshot of a chroma vector store (exported with vector_index.export_collection first)"""
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(path))) as index_dir:
+        export_collection(db, index_dir, model_name, corpus_version)
+        return write_snapshot(index_dir, path)
+
+
+def read_header(path):
+    """(header, offset of the arrays in the file)"""
+    with open(path, "rb") as f:
+        if f.read(len(magic)) != magic:
+            raise SnapshotVersionError(f"{path} is not a snapshot")
+        size = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(size))
+    if header["format_version"] != format_version:
+        raise SnapshotVersionError(f"{path} has snapshot format {header['format_version']}, expected {format_version}: export it again")
+    return header, _align(len(magic) + 8 + size)
+
+
+class _Blobs:
+    """read-only sequence over a memory-mapped blob; an item is decoded when it is accessed"""
+    def __init__(self, data, offsets, decode):
+        self._data = data
+        self._offsets = offsets
+        self._decode = decode
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        if not -len(self) <= i < len(self):
+            raise IndexError(i)
+        i %= len(self)
+        return self._decode(self._data[self._offsets[i]:self._offsets[i + 1]].tobytes().decode())
+
+
+class SnapshotIndex(ExactIndex):
+    """ExactIndex over a snapshot file (vectors, norms and docs memory-mapped, nothing loaded up front)
+
+        -meta: the header of the snapshot (model_name, corpus_version, partitions, ...)
+        -lexical_index(), diagnosis_matcher(): the bm25 index and diagnosis dictionary of the same rows
+    """
+    def __init__(self, path):
+        self.path = path
+        self.meta, data_start = read_header(path)
+        self._map = np.memmap(path, dtype=np.uint8, mode="r")
+        self._arrays = arrays = {
+            name: np.ndarray(tuple(array["shape"]), dtype=np.dtype(array["dtype"]), buffer=self._map, offset=data_start + array["offset"])
+            for name, array in self.meta["arrays"].items()
+        }
+        self.vectors = arrays["vectors"]
+        self._sq_norms = arrays["sq_norms"]
+        self.ids = _Blobs(arrays["ids"], arrays["ids_offsets"], str)
+        self.texts = _Blobs(arrays["texts"], arrays["texts_offsets"], str)
+        self.metadatas = _Blobs(arrays["metadatas"], arrays["metadatas_offsets"], json.loads)
+
+    def lexical_index(self):
+        """BM25Index over the rows of the snapshot (postings memory-mapped)"""
+        arrays = self._arrays
+        terms = arrays["bm25_terms"].tobytes().decode().split("\n") if len(arrays["bm25_terms"]) else []
+        index = BM25Index(self.texts, self.metadatas, terms, arrays["bm25_offsets"], arrays["bm25_docs"], arrays["bm25_weights"], **self.meta["bm25"])
+        labels = np.empty(len(self), dtype=object) # from the partitions, instead of decoding every metadata
+        for label, (start, end) in self.meta["partitions"].items():
+            labels[start:end] = label
+        index._labels = labels.astype(str)
+        return index
+
+    def diagnosis_matcher(self):
+        return DiagnosisMatcher(json.loads(self._arrays["diagnoses"].tobytes()))
+
+
+def import_snapshot(path, db_directory, emb_func, batch_size=5000):
+    """chroma collection of the chunks of a snapshot in db_directory (embeddings are not recomputed), with the indexes
+    built at ingestion; the corpus version of the snapshot is kept"""
+    from database_helper import (
+        open_collection, tag_sections, calibrate_collection, build_lexical_index, build_diagnosis_dictionary,
+    )
+    index = SnapshotIndex(path)
+    db = open_collection(db_directory, emb_func)
+    for start in range(0, len(index), batch_size):
+        rows = range(start, min(len(index), start + batch_size))
+        db._collection.upsert(
+            ids = [index.ids[i] for i in rows],
+            embeddings = index.vectors[start:rows.stop].tolist(),
+            documents = [index.texts[i] for i in rows],
+            metadatas = [index.metadatas[i] or None for i in rows],
+        )
+
+    if index.meta["corpus_version"]:
+        with open(os.path.join(db_directory, "corpus_version"), "w") as f:
+            f.write(index.meta["corpus_version"])
+    tag_sections(db, db_directory)
+    calibrate_collection(db, db_directory)
+    build_lexical_index(db, db_directory)
+    build_diagnosis_dictionary(db, db_directory)
+    return len(index)
+
+
+if __name__ == "__main__":
+    from _global import path_to_resources, embedding_name
+
+    args = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    args.add_argument("command", choices=["export", "import"])
+    args.add_argument("--db-dir", default=f"{path_to_resources}/db_wiki")
+    args.add_argument("--snapshot", "--out", default=f"{path_to_resources}/wiki.snapshot")
+    args = args.parse_args()
+
+    if args.command == "export":
+        from database_helper import open_collection, get_corpus_version
+        count = export_snapshot(open_collection(args.db_dir, None), args.snapshot, embedding_name, get_corpus_version(args.db_dir))
+        print(f"exported {count} chunks to {args.snapshot} ({os.path.getsize(args.snapshot) / 1e6:.1f} MB)")
+    else:
+        count = import_snapshot(args.snapshot, args.db_dir, None)
+        print(f"imported {count} chunks from {args.snapshot} into {args.db_dir}")
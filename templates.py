@@ -99,6 +99,11 @@ You are a doctor extracting diagnosis from a provided assessment. Only output th
 """
 
 
+extract_diagnoses_system = """
+You are a doctor extracting the diagnoses from a provided assessment. List every distinct diagnosis of the assessment, most important first, including the secondary ones (e.g. a viral pharyngitis along with an asthma exacerbation). Do not list symptoms or findings that are part of a listed diagnosis. Only output the diagnoses, DO NOT output any other texts.
+"""
+
+
 compress_context_system = """
 You are a summary robot tasked with extracting relevant information from each document to answer a given query. Documents are presented in an array of Document objects. Each Document object contains two attributes: 'page_content' (the text content of the document) and 'metadata' (additional information about the document).
 
@@ -107,8 +112,8 @@ Your task is to extract information verbatim from the 'page_content' of each Doc
 Format the output as a CompressedDocs Pydantic model.
 
 # Input Structure
-- QUERY: A specific question or topic that needs to be addressed.
-- CONTEXT: An array of Document objects.
+- QUERY: A specific question or topic that needs to be addressed, or a list of them (one per line). Extract the information that addresses any of them.
+- CONTEXT: Document objects, each preceded by its id in square brackets (e.g. [0]). Use that id as the id of the CompressedDoc extracted from the Document.
   - Document:
     - page_content: The textual content of the document. Special characters should be escaped in JSON compatible format.
     - metadata: Additional information such as title, headers, etc.
@@ -121,4 +126,24 @@ compress_context_human = """
 
 # CONTEXT
 {context}
-"""
\ No newline at end of file
+"""
+
+# queries and single-string templates used by main.py (built from the templates above)
+queries_ddx = {
+    "definition": "definition, description, and clinical criteria of {diagnosis}",
+    "presentation": "clinical presentation, signs, and symptoms of {diagnosis}",
+    "course": "natural history, progression, and stages of {diagnosis}",
+    "management_supportive": "treatment options, therapeutic interventions, and management strategies for {diagnosis}",
+    "follow_up": "follow-up plan and monitoring for {diagnosis}",
+    "redflags": "red flags, warning signs, and symptoms indicating need to return to emergency department for {diagnosis}",
+}
+
+extract_diagnosis = extract_diagnosis_system + "\n# ASSESSMENT\n{assessment}\n"
+
+extract_diagnoses = extract_diagnoses_system + "\n# ASSESSMENT\n{assessment}\n"
+
+compress_context = compress_context_system + compress_context_human
+
+discharge_instructions = handout_generation_system_with_references + handout_generation_human
+
+discharge_instructions_2 = handout_generation_system + handout_generation_human
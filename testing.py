@@ -4,14 +4,18 @@ evaluate by asking for human evaluation
 """
 
 import os
+import time
 import random
 import json
-import gradio as gr
-from main import generate
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 
 def create_test_set(dir, write=False, dir_save=None):
     """generates the handouts from the patient cases in test_set"""
+    from main import generate # loads the models, only needed when generating
+
     print("generating handouts")
     test_set = {}
     for filename in os.listdir(dir):
@@ -36,6 +40,110 @@ def create_test_set(dir, write=False, dir_save=None):
 
 
 
+def _templates_version():
+    """hash of all the prompt templates, so handouts are regenerated after a prompt change"""
+    import templates
+    texts = [f"{k}={v}" for k, v in sorted(vars(templates).items()) if isinstance(v, (str, dict)) and not k.startswith("_")]
+    return hashlib.sha256("\n".join(texts).encode("utf-8")).hexdigest()
+
+
+def _is_transient(e):
+    """errors worth retrying (rate limits, timeouts, connection problems, 5xx)"""
+    return isinstance(e, (TimeoutError, ConnectionError)) or type(e).__name__ in (
+        "RateLimitError", "APITimeoutError", "APIConnectionError", "InternalServerError", "ServiceUnavailableError",
+    )
+
+
+def _write_atomic(path, text):
+    with open(f"{path}.tmp", "w") as file:
+        file.write(text)
+    os.replace(f"{path}.tmp", path)
+
+
+def create_test_set_batch(dir, dir_save, workers=4, retries=3, backoff=5.0, generate_func=None):
+    """generates the handouts from the patient cases in test_set with a pool of workers
+
+        -each handout is saved to dir_save as soon as it is done ({disease}.txt + {disease}.meta.json with the input hash)
+        -cases whose handout is saved with the same input hash (case + prompt templates) are skipped, so a crashed
+            or rate limited run can be resumed
+        -transient errors are retried with exponential backoff
+        -generate_func: defaults to main.generate
+    """
+    if generate_func is None:
+        from main import generate as generate_func
+
+    os.makedirs(dir_save, exist_ok=True)
+    version = _templates_version()
+    print_lock = threading.Lock()
+
+    cases = {}
+    for filename in sorted(os.listdir(dir)):
+        if filename.endswith('.json'):
+            with open(os.path.join(dir,filename), 'r') as file:
+                cases[filename.replace(".json","")] = json.load(file)
+
+    def input_hash(data):
+        return hashlib.sha256(json.dumps([data['assessment'], data['plan'], version]).encode("utf-8")).hexdigest()
+
+    def is_done(disease, data):
+        meta_path = os.path.join(dir_save, f"{disease}.meta.json")
+        if not os.path.exists(meta_path) or not os.path.exists(os.path.join(dir_save, f"{disease}.txt")):
+            return False
+        with open(meta_path, 'r') as file:
+            return json.load(file).get("input_hash") == input_hash(data)
+
+    def run(disease, data):
+        for attempt in range(retries + 1):
+            try:
+                start = time.perf_counter()
+                handout = generate_func(data['assessment'], data['plan'])
+                break
+            except Exception as e:
+                if attempt == retries or not _is_transient(e):
+                    raise
+                wait = backoff * 2**attempt * (1 + random.random())
+                with print_lock:
+                    print(f"{disease}: {type(e).__name__}, retrying in {wait:.0f}s")
+                time.sleep(wait)
+
+        # checkpoint right away
+        _write_atomic(os.path.join(dir_save, f"{disease}.txt"), handout)
+        _write_atomic(os.path.join(dir_save, f"{disease}.meta.json"), json.dumps({
+            "input_hash": input_hash(data),
+            "seconds": time.perf_counter() - start,
+            "attempts": attempt + 1,
+        }))
+        return handout
+
+    todo = {disease: data for disease, data in cases.items() if not is_done(disease, data)}
+    print(f"generating handouts: {len(todo)} to generate, {len(cases) - len(todo)} already done")
+
+    start = time.perf_counter()
+    failed = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(run, disease, data): disease for disease, data in todo.items()}
+        for future in as_completed(futures):
+            disease = futures[future]
+            try:
+                future.result()
+                with print_lock:
+                    print(f"done: {disease}")
+            except Exception as e:
+                failed[disease] = repr(e)
+                with print_lock:
+                    print(f"failed: {disease} ({e!r})")
+
+    elapsed = time.perf_counter() - start
+    generated = len(todo) - len(failed)
+    print(f"generated {generated}, skipped {len(cases) - len(todo)}, failed {len(failed)} in {elapsed:.1f}s "
+          f"({generated / elapsed * 60 if elapsed else 0:.1f} handouts/min, {workers} workers)")
+    print(f"generated handout saved at {dir_save}")
+
+    test_set = read_test_set(dir_save)
+    return {disease: handout for disease, handout in test_set.items() if disease in cases and disease not in failed}
+
+
+
 def write_test_case(dir):
     """write jason files"""
     while True:
@@ -82,6 +190,8 @@ def save_test_results(results, dir):
 
 
 def render(generator, results):
+    import gradio as gr
+
     with gr.Blocks() as demo:
         gr.Markdown("""
             # Handout comparator 
@@ -194,3 +304,4 @@ if __name__ == '__main__':
     #write_test_case("./test_set/cases")
 
     #ts_llm = create_test_set("./test_set/cases", write=True, dir_save="./test_set/llm")
+    #ts_llm = create_test_set_batch("./test_set/cases", "./test_set/llm", workers=4)
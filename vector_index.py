@@ -0,0 +1,342 @@
+"""In-memory vector index over an export of main_collection (no sqlite/chroma at query time)
+- export_collection: writes vectors.npy (one contiguous float32 matrix), sq_norms.npy (squared norm of every row),
+    docs.jsonl (text + metadata) and meta.json
+- ExactIndex: brute force, one matmul + argpartition for all the queries of a request; vectors are memory-mapped
+- HNSWIndex: approximate search with hnswlib (optional dependency); the graph is built once and saved next to the vectors
+- QuantizedIndex: float16 / int8 codes in memory (2x / 4x smaller), candidates rescored with the memory-mapped
+    float32 vectors; exported with quantization=[...] (int8 uses the calibration from quantization.py)
+- distances are squared l2 like the chroma collection, so results match db.as_retriever(search_type="similarity")
+- retrieval.IndexRetriever uses an index as a drop-in for BatchRetriever / db.as_retriever()
+- rows are grouped by section label (section_partitions.py), so search(..., labels=[...]) only scans the row
+    ranges of those partitions (hnsw: one graph per partition)
+
+export from the repo root: python vector_index.py [--db-dir ./resources/db_wiki] [--out ./resources/index_wiki] [--hnsw]
+    [--quantization float16 int8]
+"""
+
+import os
+import json
+import glob
+import shutil
+import argparse
+from collections import Counter
+import numpy as np
+from quantization import dtypes, calibrate, quantize, dequantize, save_calibration, load_calibration
+from section_partitions import labels as section_labels, general
+
+try:
+    import hnswlib
+except ImportError: # only the exact index is available
+    hnswlib = None
+
+
+def export_collection(db, path, model_name=None, corpus_version=None, quantization=(), calibration=None, batch_size=5000):
+    """exports the vectors, texts and metadata of a chroma vector store to the directory path
+
+        -quantization: also export vectors_float16.npy / vectors_int8.npy (and the squared norms of the decoded codes)
+            for QuantizedIndex
+        -calibration: int8 calibration (quantization.json of the db directory); computed from the vectors if None
+    """
+    os.makedirs(path, exist_ok=True)
+    collection = db._collection
+    count = collection.count()
+
+    # rows grouped by section label: every partition is one contiguous range of rows
+    row_labels = []
+    for offset in range(0, count, batch_size):
+        batch = collection.get(offset=offset, limit=batch_size, include=["metadatas"])
+        row_labels.extend((metadata or {}).get("section", general) for metadata in batch["metadatas"])
+    sizes = Counter(row_labels)
+    partitions, start = {}, 0
+    for label in [l for l in section_labels if l in sizes] + sorted(set(sizes) - set(section_labels)):
+        partitions[label] = [start, start + sizes[label]]
+        start += sizes[label]
+    next_row = {label: first for label, (first, _) in partitions.items()}
+    positions = np.empty(count, dtype=np.int64)
+    for row, label in enumerate(row_labels):
+        positions[row] = next_row[label]
+        next_row[label] += 1
+
+    vectors, sq_norms = None, None
+    parts = {label: open(os.path.join(path, f"docs.{label}.tmp"), "w") for label in partitions}
+    for offset in range(0, count, batch_size):
+        batch = collection.get(offset=offset, limit=batch_size, include=["embeddings", "documents", "metadatas"])
+        embeddings = np.asarray(batch["embeddings"], dtype=np.float32)
+        if vectors is None: # written straight to disk, the collection may not fit in memory twice
+            vectors = np.lib.format.open_memmap(os.path.join(path, "vectors.npy"), mode="w+", dtype=np.float32, shape=(count, embeddings.shape[1]))
+            sq_norms = np.lib.format.open_memmap(os.path.join(path, "sq_norms.npy"), mode="w+", dtype=np.float32, shape=(count,))
+        vectors[positions[offset:offset + len(embeddings)]] = embeddings
+        sq_norms[positions[offset:offset + len(embeddings)]] = np.einsum("ij,ij->i", embeddings, embeddings)
+        for chunk_id, text, metadata, label in zip(batch["ids"], batch["documents"], batch["metadatas"], row_labels[offset:]):
+            parts[label].write(json.dumps({"id": chunk_id, "text": text, "metadata": metadata or {}}) + "\n")
+    with open(os.path.join(path, "docs.jsonl"), "w") as f:
+        for label, part in parts.items():
+            part.close()
+            with open(part.name, "r") as p:
+                shutil.copyfileobj(p, f)
+            os.remove(part.name)
+
+    if vectors is not None:
+        vectors.flush()
+        sq_norms.flush()
+        for dtype in quantization:
+            if dtype == "int8":
+                calibration = calibration or calibrate(vectors[::max(1, count // 100000)]) # on a sample of at most ~100k
+                save_calibration(calibration, os.path.join(path, "quantization.json"))
+            codes = np.lib.format.open_memmap(os.path.join(path, f"vectors_{dtype}.npy"), mode="w+", dtype=dtype, shape=vectors.shape)
+            code_norms = np.lib.format.open_memmap(os.path.join(path, f"sq_norms_{dtype}.npy"), mode="w+", dtype=np.float32, shape=(count,))
+            for start in range(0, count, batch_size):
+                codes[start:start + batch_size] = quantize(vectors[start:start + batch_size], dtype, calibration)
+                decoded = dequantize(codes[start:start + batch_size], calibration)
+                code_norms[start:start + batch_size] = np.einsum("ij,ij->i", decoded, decoded)
+            codes.flush()
+            code_norms.flush()
+
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump({
+            "count": count,
+            "dim": 0 if vectors is None else vectors.shape[1],
+            "model_name": model_name,
+            "corpus_version": corpus_version,
+            "space": "l2",
+            "quantization": list(quantization),
+            "partitions": partitions,
+        }, f, indent=2)
+
+    for graph_path in glob.glob(os.path.join(path, "hnsw*.bin")): # built for the old vectors
+        os.remove(graph_path)
+
+    return count
+
+
+def load_meta(path):
+    with open(os.path.join(path, "meta.json"), "r") as f:
+        return json.load(f)
+
+
+def load_docs(path):
+    """ids, texts and metadatas in the row order of vectors.npy"""
+    ids, texts, metadatas = [], [], []
+    with open(os.path.join(path, "docs.jsonl"), "r") as f:
+        for line in f:
+            doc = json.loads(line)
+            ids.append(doc["id"])
+            texts.append(doc["text"])
+            metadatas.append(doc["metadata"])
+    return ids, texts, metadatas
+
+
+def _load_sq_norms(path, filename, compute):
+    """squared norms saved by export_collection (memory-mapped); computed with compute() for older exports"""
+    norms_path = os.path.join(path, filename)
+    if os.path.exists(norms_path):
+        return np.load(norms_path, mmap_mode="r")
+    return compute()
+
+
+class ExactIndex:
+    """brute force search over the memory-mapped vectors
+
+        -search(queries, k, labels=None) -> (indices, squared l2 distances), both of shape (num queries, k), nearest
+            first; with labels, only the rows of those section partitions are scanned
+    """
+    def __init__(self, path):
+        self.path = path
+        self.meta = load_meta(path)
+        self.ids, self.texts, self.metadatas = load_docs(path)
+        self.vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r")
+        self._sq_norms = _load_sq_norms(path, "sq_norms.npy", lambda: np.einsum("ij,ij->i", self.vectors, self.vectors))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def memory_bytes(self):
+        """size of the arrays searched (the vectors are memory-mapped, so this is what ends up in the page cache)"""
+        return self.vectors.nbytes + self._sq_norms.nbytes
+
+    def partition_ranges(self, labels=None):
+        """(start, end) row ranges of the partitions of labels; every row without labels or partitions in the export"""
+        partitions = self.meta.get("partitions")
+        if labels is None or not partitions:
+            return [(0, len(self))]
+        return [tuple(partitions[label]) for label in labels if label in partitions]
+
+    def _distances(self, queries, start, end):
+        """|q - x|^2 - |q|^2 for the rows start:end"""
+        return self._sq_norms[None, start:end] - 2 * (queries @ self.vectors[start:end].T)
+
+    def _nearest(self, queries, k, ranges):
+        """(indices, distances without |q|^2) of the k nearest rows of ranges, nearest first"""
+        rows = np.concatenate([np.arange(start, end) for start, end in ranges] + [np.zeros(0, dtype=np.int64)])
+        k = min(k, len(rows))
+        if not k:
+            return np.zeros((len(queries), 0), dtype=np.int64), np.zeros((len(queries), 0), dtype=np.float32)
+        # |q - x|^2 = |q|^2 - 2 q.x + |x|^2
+        distances = np.concatenate([self._distances(queries, start, end) for start, end in ranges], axis=1)
+        top = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        top_distances = np.take_along_axis(distances, top, axis=1)
+        order = np.argsort(top_distances, axis=1)
+        return rows[np.take_along_axis(top, order, axis=1)], np.take_along_axis(top_distances, order, axis=1)
+
+    def search(self, queries, k, labels=None):
+        queries = np.asarray(queries, dtype=np.float32)
+        indices, distances = self._nearest(queries, k, self.partition_ranges(labels))
+        return indices, distances + np.einsum("ij,ij->i", queries, queries)[:, None]
+
+
+class HNSWIndex(ExactIndex):
+    """approximate search with hnswlib graphs (built and saved as hnsw.bin on first use)
+
+        -ef: size of the candidate list at query time (higher: better recall, slower)
+        -m, ef_construction: graph parameters used when building
+        -search with labels: one graph per section partition (hnsw_<label>.bin, built the first time the partition is
+            searched), the results of the partitions are merged
+    """
+    available = hnswlib is not None
+
+    def __init__(self, path, ef=64, m=16, ef_construction=200):
+        if not self.available:
+            raise ImportError("HNSWIndex needs hnswlib: pip install hnswlib")
+        super().__init__(path)
+        self.ef = ef
+        self.m = m
+        self.ef_construction = ef_construction
+        self.graph = self._graph("hnsw.bin", 0, len(self))
+        self._partition_graphs = {}
+
+    def _graph(self, filename, start, end):
+        """graph of the rows start:end, labelled with their row index"""
+        graph = hnswlib.Index(space="l2", dim=self.vectors.shape[1])
+        graph_path = os.path.join(self.path, filename)
+        if os.path.exists(graph_path):
+            graph.load_index(graph_path, max_elements=end - start)
+        else:
+            graph.init_index(max_elements=end - start, M=self.m, ef_construction=self.ef_construction)
+            graph.add_items(self.vectors[start:end], np.arange(start, end))
+            graph.save_index(graph_path)
+        return graph
+
+    def memory_bytes(self):
+        graphs = glob.glob(os.path.join(self.path, "hnsw*.bin")) # graphs + their copy of the vectors
+        return super().memory_bytes() + sum(map(os.path.getsize, graphs))
+
+    def _query(self, graph, queries, k):
+        graph.set_ef(max(self.ef, k))
+        indices, distances = graph.knn_query(queries, k=k)
+        return indices.astype(np.int64), distances
+
+    def search(self, queries, k, labels=None):
+        queries = np.asarray(queries, dtype=np.float32)
+        if labels is None or not self.meta.get("partitions"):
+            return self._query(self.graph, queries, min(k, len(self)))
+
+        results = []
+        for label in labels:
+            if label not in self.meta["partitions"]:
+                continue
+            start, end = self.meta["partitions"][label]
+            if label not in self._partition_graphs:
+                self._partition_graphs[label] = self._graph(f"hnsw_{label}.bin", start, end)
+            results.append(self._query(self._partition_graphs[label], queries, min(k, end - start)))
+        if not results:
+            return np.zeros((len(queries), 0), dtype=np.int64), np.zeros((len(queries), 0), dtype=np.float32)
+        indices = np.concatenate([r[0] for r in results], axis=1)
+        distances = np.concatenate([r[1] for r in results], axis=1)
+        order = np.argsort(distances, axis=1)[:, :k]
+        return np.take_along_axis(indices, order, axis=1), np.take_along_axis(distances, order, axis=1)
+
+
+class QuantizedIndex(ExactIndex):
+    """search on float16 / int8 codes held in memory, then full precision rescoring of the top candidates
+
+        -dtype: float16 or int8 (exported with export_collection(..., quantization=[dtype]))
+        -rescore: k * rescore candidates are rescored with the float32 vectors (memory-mapped, only those rows
+            are read); 0 to return the quantized ranking
+        -block_size: codes are converted to float32 this many rows at a time
+    """
+    def __init__(self, path, dtype="int8", rescore=4, block_size=8192):
+        self.path = path
+        self.meta = load_meta(path)
+        self.ids, self.texts, self.metadatas = load_docs(path)
+        self.vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r")
+        self.codes = np.load(os.path.join(path, f"vectors_{dtype}.npy")) # resident
+        self.calibration = load_calibration(os.path.join(path, "quantization.json")) if dtype == "int8" else None
+        self.rescore = rescore
+        self.block_size = block_size
+        self._sq_norms = _load_sq_norms(path, f"sq_norms_{dtype}.npy", lambda: np.concatenate([
+            np.einsum("ij,ij->i", block, block) for block in map(self._decode, range(0, len(self.codes), block_size))
+        ]) if len(self.codes) else np.zeros(0, dtype=np.float32))
+
+    def _decode(self, start):
+        return dequantize(self.codes[start:start + self.block_size], self.calibration)
+
+    def memory_bytes(self):
+        return self.codes.nbytes + self._sq_norms.nbytes
+
+    def _distances(self, queries, start, end):
+        # q.(offset + scale * code) = q.offset + (q * scale).code, so the codes are only cast, not decoded
+        if self.calibration is not None:
+            scaled, bias = queries * self.calibration["scale"], queries @ self.calibration["offset"]
+        else:
+            scaled, bias = queries, np.zeros(len(queries), dtype=np.float32)
+        distances = np.empty((len(queries), end - start), dtype=np.float32)
+        for block_start in range(start, end, self.block_size):
+            block = self.codes[block_start:min(end, block_start + self.block_size)].astype(np.float32)
+            distances[:, block_start - start:block_start - start + len(block)] = (
+                self._sq_norms[block_start:block_start + len(block)] - 2 * (scaled @ block.T + bias[:, None])
+            )
+        return distances
+
+    def search(self, queries, k, labels=None):
+        queries = np.asarray(queries, dtype=np.float32)
+        num_candidates = k * self.rescore if self.rescore else k
+        candidates, distances = self._nearest(queries, num_candidates, self.partition_ranges(labels))
+        k = min(k, candidates.shape[1])
+
+        sq_queries = np.einsum("ij,ij->i", queries, queries)[:, None]
+        if not self.rescore:
+            return candidates, distances + sq_queries
+
+        indices = np.empty((len(queries), k), dtype=np.int64)
+        exact = np.empty((len(queries), k), dtype=np.float32)
+        for i, rows in enumerate(candidates):
+            rows = np.sort(rows) # sequential reads of the memory-mapped vectors
+            vectors = np.asarray(self.vectors[rows])
+            d = np.einsum("ij,ij->i", vectors, vectors) - 2 * (vectors @ queries[i])
+            order = np.argsort(d)[:k]
+            indices[i], exact[i] = rows[order], d[order]
+        return indices, exact + sq_queries
+
+
+index_types = {"exact": ExactIndex, "hnsw": HNSWIndex}
+
+
+def open_index(path, mode="exact", **kwargs):
+    """index of an exported collection; mode is exact, hnsw, float16 or int8"""
+    if mode in dtypes:
+        return QuantizedIndex(path, dtype=mode, **kwargs)
+    if mode not in index_types:
+        raise ValueError(f"unknown index mode {mode!r}, expected one of {list(index_types) + list(dtypes)}")
+    return index_types[mode](path, **kwargs)
+
+
+if __name__ == "__main__":
+    from _global import path_to_resources, embedding_name
+    from database_helper import open_collection, get_corpus_version
+
+    args = argparse.ArgumentParser(description="export main_collection to an in-memory vector index")
+    args.add_argument("--db-dir", default=f"{path_to_resources}/db_wiki")
+    args.add_argument("--out", default=f"{path_to_resources}/index_wiki")
+    args.add_argument("--hnsw", action="store_true", help="also build the hnsw graph")
+    args.add_argument("--quantization", nargs="*", default=[], choices=dtypes, help="also export float16 / int8 codes")
+    args = args.parse_args()
+
+    count = export_collection(
+        open_collection(args.db_dir, None), args.out, embedding_name, get_corpus_version(args.db_dir),
+        quantization = args.quantization,
+        calibration = load_calibration(os.path.join(args.db_dir, "quantization.json")), # computed at ingestion
+    )
+    print(f"exported {count} chunks to {args.out}")
+    if args.hnsw:
+        HNSWIndex(args.out)
+        print("hnsw graph built")